@@ -13,10 +13,22 @@ try:
     from .package_sync_helpers import tools
     from .package_sync_helpers import online
     from .package_sync_helpers import offline
+    from .package_sync_helpers import state
+    from .package_sync_helpers import copier
+    from .package_sync_helpers import snapshots
+    from .package_sync_helpers import metrics
+    from .package_sync_helpers import removal
+    from .package_sync_helpers import cleanup
 except ValueError:
     from package_sync_helpers import tools
     from package_sync_helpers import online
     from package_sync_helpers import offline
+    from package_sync_helpers import state
+    from package_sync_helpers import copier
+    from package_sync_helpers import snapshots
+    from package_sync_helpers import metrics
+    from package_sync_helpers import removal
+    from package_sync_helpers import cleanup
 
 sync_queue = online.Queue()
 
@@ -69,19 +81,7 @@ class PsyncLocalBackupListCommand(sublime_plugin.WindowCommand):
     def backup_pkg_list(self, backup_path):
         if backup_path is not None:
             try:
-                package_control_settings = sublime.load_settings(
-                    "Package Control.sublime-settings")
-                installed_packages = package_control_settings.get(
-                    "installed_packages") or []
-
-                if os.path.isfile(backup_path):
-                    os.remove(backup_path)
-                elif not os.path.exists(os.path.dirname(backup_path)):
-                    os.makedirs(os.path.dirname(backup_path))
-
-                with open(backup_path, "w") as _backupFile:
-                    json.dump(
-                        {"installed_packages": installed_packages}, _backupFile, indent=4)
+                offline.create_list_backup(backup_path)
 
                 tools.log("PackageSync: Backup of installed packages list created at %s" %
                       backup_path)
@@ -136,16 +136,9 @@ class PsyncLocalRestoreListCommand(sublime_plugin.WindowCommand):
             try:
                 tools.log("PackageSync: Restoring package list from %s" %
                       backup_path)
-                with open(backup_path, "r") as f:
-                    _installed_packages = json.load(f)["installed_packages"]
-
-                    _package_control_settings = sublime.load_settings(
-                        "Package Control.sublime-settings")
-                    _package_control_settings.set(
-                        "installed_packages", _installed_packages)
-                    sublime.save_settings("Package Control.sublime-settings")
+                offline.restore_list_backup(backup_path)
 
-                tools.install_new_packages()
+                cleanup.install_new_packages()
 
             except Exception as e:
                 tools.log(
@@ -202,11 +195,9 @@ class PsyncLocalBackupFolderCommand(sublime_plugin.WindowCommand):
     def backup_folder(self, backup_path):
         if backup_path is not None:
             try:
-                offline.create_temp_backup()
-
-                if os.path.isdir(backup_path):
-                    shutil.rmtree(backup_path, True)
-                shutil.copytree(tools.temp_backup_folder, backup_path)
+                failed = offline.backup_to_folder(backup_path)
+                if failed:
+                    tools.log("PackageSync: Could not back up %s" % ", ".join(failed), force=True)
 
                 tools.log("PackageSync: Backup of packages & settings created at %s" %
                       backup_path)
@@ -272,12 +263,9 @@ class PsyncLocalRestoreFolderCommand(sublime_plugin.WindowCommand):
                     tools.log("PackageSync: PackageSync.sublime-settings backed up to %s" %
                           packagesync_settings_backup, force=True)
 
-                if os.path.exists(tools.temp_restore_folder):
-                    shutil.rmtree(tools.temp_restore_folder, True)
                 # Copy to temp restore folder & restore as per the preserve
                 # setting
-                shutil.copytree(backup_path, tools.temp_restore_folder)
-                offline.restore_from_temp()
+                offline.restore_from_folder(backup_path)
 
                 # Restore PackageSync user settings if they were backed up
                 if os.path.exists(packagesync_settings_backup) and not os.path.exists(packagesync_settings_original):
@@ -286,7 +274,7 @@ class PsyncLocalRestoreFolderCommand(sublime_plugin.WindowCommand):
                     tools.log("PackageSync: PackageSync.sublime-settings restored from %s" %
                           packagesync_settings_backup, force=True)
 
-                tools.install_new_packages()
+                cleanup.install_new_packages()
 
             except Exception as e:
                 tools.log(
@@ -344,31 +332,7 @@ class PsyncLocalBackupZipCommand(sublime_plugin.WindowCommand):
     def backup_zip(self, backup_path):
         if backup_path is not None:
             try:
-                offline.create_temp_backup()
-
-                temp_zip_file_path = os.path.join(
-                    tempfile.gettempdir(), str(time.time())) + ".zip"
-
-                # create temp backup zip from the temp backup
-                z = zipfile.ZipFile(temp_zip_file_path, 'w')
-                basePath = tools.temp_backup_folder.rstrip("\\/") + ""
-                basePath = basePath.rstrip("\\/")
-
-                for root, dirs, files in os.walk(tools.temp_backup_folder):
-                    for item in (files + dirs):
-                        itemPath = os.path.join(root, item)
-                        inZipPath = itemPath.replace(
-                            basePath, "", 1).lstrip("\\/")
-                        z.write(itemPath, inZipPath)
-
-                # close the temp backup file
-                z.close()
-
-                if os.path.isfile(backup_path):
-                    os.remove(backup_path)
-                elif not os.path.exists(os.path.dirname(backup_path)):
-                    os.makedirs(os.path.dirname(backup_path))
-                shutil.move(temp_zip_file_path, backup_path)
+                offline.create_zip_backup(backup_path)
 
                 tools.log("PackageSync: Zip backup of packages & settings created at %s" %
                       backup_path)
@@ -435,19 +399,9 @@ class PsyncLocalRestoreZipCommand(sublime_plugin.WindowCommand):
                     tools.log("PackageSync: PackageSync.sublime-settings backed up to %s" %
                           packagesync_settings_backup, force=True)
 
-                if os.path.exists(tools.temp_restore_folder):
-                    shutil.rmtree(tools.temp_restore_folder, True)
-
-                # Extract to temp restore folder & then perform restore operation
-                # as per the preserve setting
-                #
-                # Sublime 2 has Python 2.6.9 as interpreter. So using with zipfile.ZipFile would not work
-                # Therefore explicitly open & close the zip file for operation
-                z = zipfile.ZipFile(backup_path, "r")
-                z.extractall(tools.temp_restore_folder)
-                z.close()
-
-                offline.restore_from_temp()
+                # Write the members which differ from the existing files
+                # straight into the User folder, as per the preserve setting
+                offline.restore_from_zip(backup_path)
 
                 # Restore PackageSync user settings if they were backed up
                 if os.path.exists(packagesync_settings_backup) and not os.path.exists(packagesync_settings_original):
@@ -456,7 +410,7 @@ class PsyncLocalRestoreZipCommand(sublime_plugin.WindowCommand):
                     tools.log("PackageSync: PackageSync.sublime-settings restored from %s" %
                           packagesync_settings_backup, force=True)
 
-                tools.install_new_packages()
+                cleanup.install_new_packages()
 
             except Exception as e:
                 tools.log(
@@ -466,6 +420,121 @@ class PsyncLocalRestoreZipCommand(sublime_plugin.WindowCommand):
             tools.packagesync_cancelled()
 
 
+class PsyncLocalBackupSnapshotCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        psync_settings = tools.get_psync_settings()
+
+        try:
+            repository = snapshots.get_snapshot_repository(psync_settings)
+            snapshot_id = repository.create(
+                tools.user_settings_folder, tools.get_path_filter(psync_settings),
+                copier.get_copy_engine(psync_settings))
+
+            freed = repository.prune(psync_settings["snapshot_retention"])
+            if freed:
+                tools.log("PackageSync: Removed old snapshots, %d bytes freed" % freed)
+
+            tools.log("PackageSync: Snapshot %s of packages & settings created at %s" %
+                      (snapshot_id, repository.path))
+        except Exception as e:
+            tools.log("PackageSync: Error while backing up packages to snapshot", force=True)
+            tools.log("PackageSync: Error message: %s" % str(e), force=True)
+
+
+class PsyncLocalRestoreSnapshotCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        self.repository = snapshots.get_snapshot_repository()
+
+        # Latest snapshot first
+        self.snapshot_ids = list(reversed(self.repository.list_snapshots()))
+        if not self.snapshot_ids:
+            sublime.error_message("No snapshots found @ %s" % self.repository.path)
+            return
+
+        items = []
+        for snapshot_id in self.snapshot_ids:
+            try:
+                items += [[snapshot_id, self.repository.describe(snapshot_id)]]
+            except Exception as e:
+                items += [[snapshot_id, "Unreadable: %s" % str(e)]]
+
+        self.window.show_quick_panel(items, self.on_done)
+
+    def on_done(self, index):
+        if index == -1:
+            tools.packagesync_cancelled()
+            return
+
+        self.restore_snapshot(self.snapshot_ids[index])
+
+    def restore_snapshot(self, snapshot_id):
+        try:
+            tools.log(
+                "PackageSync: Restoring package list & user settings from snapshot %s" % snapshot_id, force=True)
+            # Backup PackageSync user settings before restore operation
+            packagesync_settings_backup = os.path.join(
+                tempfile.gettempdir(), str(time.time()))
+            packagesync_settings_original = os.path.join(
+                tools.user_settings_folder, "PackageSync.sublime-settings")
+            # Verify that user setting are present before backing up
+            if os.path.exists(packagesync_settings_original):
+                shutil.copy2(
+                    packagesync_settings_original, packagesync_settings_backup)
+                tools.log("PackageSync: PackageSync.sublime-settings backed up to %s" %
+                      packagesync_settings_backup, force=True)
+
+            if os.path.exists(tools.temp_restore_folder):
+                shutil.rmtree(tools.temp_restore_folder, True)
+
+            # Write the snapshot to temp restore folder & restore as per the
+            # preserve setting
+            try:
+                failed = self.repository.restore(
+                    snapshot_id, tools.temp_restore_folder, copier.get_copy_engine(tools.get_psync_settings()))
+                if failed:
+                    tools.log("PackageSync: Could not read %s, nothing has been restored" % ", ".join(failed),
+                              force=True)
+                else:
+                    offline.restore_from_temp()
+            finally:
+                shutil.rmtree(tools.temp_restore_folder, True)
+
+            # Restore PackageSync user settings if they were backed up
+            if os.path.exists(packagesync_settings_backup) and not os.path.exists(packagesync_settings_original):
+                shutil.copy2(
+                    packagesync_settings_backup, packagesync_settings_original)
+                tools.log("PackageSync: PackageSync.sublime-settings restored from %s" %
+                      packagesync_settings_backup, force=True)
+
+            cleanup.install_new_packages()
+
+        except Exception as e:
+            tools.log(
+                "PackageSync: Error while restoring packages from snapshot", force=True)
+            tools.log("PackageSync: Error message: %s" % str(e), force=True)
+
+
+class PsyncLocalUndoRestoreCommand(sublime_plugin.WindowCommand):
+
+    def is_enabled(self):
+        return os.path.isdir(offline.get_rollback_folder())
+
+    def run(self):
+        if sublime.ok_cancel_dialog(
+                "Swap the User folder with the one from before the last restore?") != True:
+            tools.packagesync_cancelled()
+            return
+
+        try:
+            if offline.undo_restore():
+                tools.log("PackageSync: User folder from before the last restore swapped back in", force=True)
+        except Exception as e:
+            tools.log("PackageSync: Error while undoing the last restore", force=True)
+            tools.log("PackageSync: Error message: %s" % str(e), force=True)
+
+
 class PsyncOnlineSyncEnableCommand(sublime_plugin.WindowCommand):
 
     def is_enabled(self):
@@ -554,6 +623,34 @@ class PsyncOnlinePushItemCommand(sublime_plugin.ApplicationCommand):
         sync_queue.add(t)
 
 
+class PsyncOnlinePullItemsCommand(sublime_plugin.ApplicationCommand):
+
+    def is_enabled(self):
+        s = tools.get_psync_settings()
+        return s.get("online_sync_enabled", False) and s.get("online_sync_folder", False) and os.path.isdir(s.get("online_sync_folder"))
+
+    def run(self, items):
+        tools.log("PsyncOnlinePullItemsCommand %s items" % len(items))
+
+        # Start a single thread to pull the whole batch of items
+        t = online.Sync(mode=["pull"], items=items)
+        sync_queue.add(t)
+
+
+class PsyncOnlinePushItemsCommand(sublime_plugin.ApplicationCommand):
+
+    def is_enabled(self):
+        s = tools.get_psync_settings()
+        return s.get("online_sync_enabled", False) and s.get("online_sync_folder", False) and os.path.isdir(s.get("online_sync_folder"))
+
+    def run(self, items):
+        tools.log("PsyncOnlinePushItemsCommand %s items" % len(items))
+
+        # Start a single thread to push the whole batch of items
+        t = online.Sync(mode=["push"], items=items)
+        sync_queue.add(t)
+
+
 class PsyncOnlineSyncFolderCommand(sublime_plugin.WindowCommand):
 
     def is_enabled(self):
@@ -596,16 +693,16 @@ class PsyncOnlineSyncFolderCommand(sublime_plugin.WindowCommand):
                 if os.path.isfile(last_run_file):
                     os.remove(last_run_file)
 
-                # Reset last-run file for PackageSync
-                last_run_file = os.path.join(
-                    sublime.packages_path(), "User", "PackageSync.last-run")
-                if os.path.isfile(last_run_file):
-                    os.remove(last_run_file)
+                # Reset last-run data for PackageSync
+                state.get_sync_state().reset()
 
                 sublime.save_settings("PackageSync.sublime-settings")
                 sublime.status_message(
                     "online_sync_folder has been set to \n %s" % path)
 
+                # The on_change listener is detached, so drop the settings snapshot here
+                tools.invalidate_psync_settings()
+
                 # Restart watcher
                 tools.pause_watcher(local=False)
                 tools.stop_watcher(local=False)
@@ -626,6 +723,43 @@ class PsyncOnlineSyncFolderCommand(sublime_plugin.WindowCommand):
             "Online Sync Folder", sync_folder, get_sync_folder_on_done, None, tools.packagesync_cancelled)
 
 
+class PsyncOnlineSyncFormatCommand(sublime_plugin.WindowCommand):
+
+    def is_enabled(self, format="packed"):
+        s = tools.get_psync_settings()
+        return s.get("online_sync_enabled", False) and s.get("online_sync_format") != format \
+            and not sync_queue.has("migrate_online")
+
+    def run(self, format="packed"):
+        # Machines still syncing with loose files would delete them locally
+        remove_loose = format == "packed" and sublime.ok_cancel_dialog(
+            "Remove the loose files from the online sync folder once they are packed?\n\n"
+            "Only do so if all machines syncing with this folder use the packed format.", "Remove")
+
+        settings = sublime.load_settings("PackageSync.sublime-settings")
+        settings.set("online_sync_format", format)
+        sublime.save_settings("PackageSync.sublime-settings")
+        tools.invalidate_psync_settings()
+
+        sync_queue.add(online.Migrate(remove_loose), "migrate_online")
+
+
+class PsyncShowSyncStatsCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        report = metrics.get_metrics().report()
+
+        report += "\nSync queue\n"
+        for key, value in sorted(sync_queue.metrics().items()):
+            report += "  %-22s %s\n" % (key, round(value, 3) if isinstance(value, float) else value)
+
+        view = self.window.new_file()
+        view.set_name("PackageSync Stats")
+        view.set_scratch(True)
+        view.run_command("append", {"characters": report})
+        view.set_read_only(True)
+
+
 def plugin_loaded():
     tools.init_paths()
 
@@ -651,6 +785,16 @@ def plugin_unloaded():
     # Stop folder watcher
     tools.stop_watcher()
 
+    # Drop pending sync jobs & package removals
+    sync_queue.stop()
+    removal.get_package_remover().stop()
+
+    # Write pending sync state to PackageSync.last-run
+    state.get_sync_state().close()
+
+    # Write pending timings to PackageSync.metrics.jsonl
+    metrics.get_metrics().close()
+
 
 if sublime.version()[0] == "2":
     plugin_loaded()
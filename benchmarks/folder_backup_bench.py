@@ -0,0 +1,108 @@
+"""Compare incremental folder backups against deleting & copying the whole tree.
+
+Usage: python benchmarks/folder_backup_bench.py [number_of_files]
+
+Builds a synthetic User folder (10k files by default), then reports the time
+and the number of bytes written of a first backup, of a backup in which
+nothing changed & of one after 1% of the files were modified.
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+from package_sync_helpers import headless
+
+headless.install(tempfile.mkdtemp(prefix="psync_bench_packages_"))
+headless.load_settings("PackageSync.sublime-settings").set("include_files", ["*"])
+
+from package_sync_helpers import copier
+from package_sync_helpers import offline
+from package_sync_helpers import tools
+
+EXTENSIONS = [".sublime-settings", ".json", ".py", ".tmTheme", ".png", ".md"]
+
+
+class WriteCounter(object):
+
+    """Counts the bytes copied through copier.copy_data."""
+
+    def __init__(self):
+        self.bytes_written = 0
+        self.lock = threading.Lock()
+        self.copy_data = copier.copy_data
+
+    def __enter__(self):
+        def copy_data(source, target):
+            self.copy_data(source, target)
+            with self.lock:
+                self.bytes_written += os.path.getsize(target)
+
+        copier.copy_data = copy_data
+        return self
+
+    def __exit__(self, *exc_info):
+        copier.copy_data = self.copy_data
+
+
+def create_user_folder(root, number_of_files):
+    random.seed(42)
+    for index in range(number_of_files):
+        folder = os.path.join(root, "Package%d" % (index % 100))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(os.path.join(folder, "file%d%s" % (index, random.choice(EXTENSIONS))), "wb") as f:
+            f.write(os.urandom(random.randint(100, 4000)))
+
+
+def full_backup(backup_path):
+    if os.path.isdir(backup_path):
+        shutil.rmtree(backup_path, True)
+    copier.get_copy_engine(tools.get_psync_settings()).copy_tree(
+        tools.user_settings_folder, backup_path, tools.get_path_filter(), copier.clone_file)
+
+
+def measure(label, backup, backup_path):
+    with WriteCounter() as counter:
+        start = time.time()
+        backup(backup_path)
+        elapsed = time.time() - start
+    print("  %-28s %10.0f %12.1f" % (label, elapsed * 1000, counter.bytes_written / 1048576.0))
+
+
+def main():
+    number_of_files = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    root = tempfile.mkdtemp(prefix="psync_bench_")
+    try:
+        tools.user_settings_folder = os.path.join(root, "User")
+        create_user_folder(tools.user_settings_folder, number_of_files)
+        full_path = os.path.join(root, "full")
+        incremental_path = os.path.join(root, "incremental")
+
+        print("Folder backups of %d files" % number_of_files)
+        print("  %-28s %10s %12s" % ("run", "time (ms)", "written (MB)"))
+
+        measure("full, first run", full_backup, full_path)
+        measure("incremental, first run", offline.create_folder_backup, incremental_path)
+        measure("full, unchanged", full_backup, full_path)
+        measure("incremental, unchanged", offline.create_folder_backup, incremental_path)
+
+        files = sorted(tools.PathFilter(["*"]).walk(tools.user_settings_folder))
+        for absolute_path, relative_path in random.sample(files, len(files) // 100):
+            with open(absolute_path, "ab") as f:
+                f.write(b"changed")
+
+        measure("full, 1% changed", full_backup, full_path)
+        measure("incremental, 1% changed", offline.create_folder_backup, incremental_path)
+    finally:
+        shutil.rmtree(root, True)
+
+
+if __name__ == "__main__":
+    main()
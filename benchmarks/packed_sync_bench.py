@@ -0,0 +1,108 @@
+"""Compare online syncs through loose files against a packed online sync folder.
+
+Usage: python benchmarks/packed_sync_bench.py [number_of_files]
+
+For both values of online_sync_format, one machine pushes a synthetic User
+folder (10k files by default) to an online sync folder & a second machine
+pulls it. Reported are the time of the first, an unchanged & a sync after 1%
+of the files were modified, along with the number of files in the online
+sync folder, which is what a cloud client has to track.
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+from package_sync_helpers import headless
+
+headless.install(tempfile.mkdtemp(prefix="psync_bench_packages_"))
+
+from package_sync_helpers import hashing
+from package_sync_helpers import online
+from package_sync_helpers import scanner
+from package_sync_helpers import state
+from package_sync_helpers import tools
+
+EXTENSIONS = [".sublime-settings", ".json", ".py", ".tmTheme", ".png", ".md"]
+
+
+def create_user_folder(root, number_of_files):
+    random.seed(42)
+    for index in range(number_of_files):
+        folder = os.path.join(root, "Package%d" % (index % 100))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(os.path.join(folder, "file%d%s" % (index, random.choice(EXTENSIONS))), "wb") as f:
+            f.write(os.urandom(random.randint(100, 4000)))
+
+
+def use_machine(packages_path, online_folder, online_sync_format):
+    """Switch to the Packages folder of another machine & forget the state of the previous one."""
+    headless.install(packages_path)
+    tools.init_paths()
+
+    state.get_sync_state().close()
+    scanner._scan_index = None
+    state._sync_state = None
+    hashing._hash_cache = None
+
+    settings = headless.load_settings("PackageSync.sublime-settings")
+    settings.set("include_files", ["*"])
+    settings.set("online_sync_folder", online_folder)
+    settings.set("online_sync_format", online_sync_format)
+    tools.invalidate_psync_settings()
+
+
+def count_files(path):
+    return sum(len(files) for root, dirs, files in os.walk(path))
+
+
+def measure(label, machine, mode, online_folder):
+    use_machine(*machine)
+    start = time.time()
+    online.Sync(mode).run()
+    elapsed = time.time() - start
+    print("  %-28s %10.0f %12d" % (label, elapsed * 1000, count_files(online_folder)))
+
+
+def main():
+    number_of_files = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    root = tempfile.mkdtemp(prefix="psync_bench_")
+    try:
+        print("Online syncs of %d files" % number_of_files)
+        print("  %-28s %10s %12s" % ("run", "time (ms)", "online files"))
+
+        for online_sync_format in ("files", "packed"):
+            online_folder = os.path.join(root, online_sync_format, "Online")
+            os.makedirs(online_folder)
+            first = (os.path.join(root, online_sync_format, "First", "Packages"), online_folder, online_sync_format)
+            second = (os.path.join(root, online_sync_format, "Second", "Packages"), online_folder, online_sync_format)
+            create_user_folder(os.path.join(first[0], "User"), number_of_files)
+
+            measure("%s, push first run" % online_sync_format, first, ["push"], online_folder)
+            measure("%s, pull first run" % online_sync_format, second, ["pull"], online_folder)
+            measure("%s, push unchanged" % online_sync_format, first, ["push"], online_folder)
+            measure("%s, pull unchanged" % online_sync_format, second, ["pull"], online_folder)
+
+            files = sorted(tools.PathFilter(["*"]).walk(os.path.join(first[0], "User")))
+            for absolute_path, relative_path in random.sample(files, len(files) // 100):
+                with open(absolute_path, "ab") as f:
+                    f.write(b"changed")
+                os.utime(absolute_path, (time.time() + 2, time.time() + 2))
+
+            measure("%s, push 1%% changed" % online_sync_format, first, ["push"], online_folder)
+            measure("%s, pull 1%% changed" % online_sync_format, second, ["pull"], online_folder)
+
+        state.get_sync_state().close()
+    finally:
+        headless.drain(10)
+        shutil.rmtree(root, True)
+
+
+if __name__ == "__main__":
+    main()
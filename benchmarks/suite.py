@@ -0,0 +1,249 @@
+"""Time the hot paths of PackageSync on synthetic User folders.
+
+Usage: python benchmarks/suite.py [--sizes 1000,10000,100000] [--repeat 3]
+                                  [--output results.json] [--baseline baseline.json]
+                                  [--save-baseline] [--tolerance 0.25]
+
+For every size a Packages folder with a User folder of that many files of
+varied sizes is generated & the editor API is replaced by the headless
+stand-in. The best time of --repeat runs of every benchmark is written to
+--output. With a baseline from an earlier run (see --save-baseline), every
+benchmark slower than the baseline by more than --tolerance is reported as
+a regression & the exit status is 1. Baselines are only comparable on the
+same machine, so none is committed.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from package_sync_helpers import headless
+
+headless.install(tempfile.mkdtemp(prefix="psync_bench_packages_"))
+
+from package_sync_helpers import tools
+from package_sync_helpers import online
+from package_sync_helpers import offline
+from package_sync_helpers import scanner
+from package_sync_helpers import state
+from package_sync_helpers import hashing
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+#: (folder pattern, extension, smallest size, largest size, share of files)
+FILE_KINDS = [
+    ("Package%03d", ".sublime-settings", 100, 8000, 30),
+    ("Package%03d", ".sublime-keymap", 100, 4000, 10),
+    ("Package%03d", ".py", 200, 20000, 20),
+    ("Package%03d/themes", ".tmTheme", 2000, 60000, 10),
+    ("Package%03d/icons", ".png", 200, 30000, 20),
+    ("Package%03d", ".md", 100, 3000, 5),
+    ("Package%03d/__pycache__", ".pyc", 200, 20000, 5),
+]
+
+
+def create_user_folder(root, number_of_files):
+    """Fill root with number_of_files files, some of which are not synced."""
+    random.seed(number_of_files)
+    kinds = [kind for kind in FILE_KINDS for _ in range(kind[4])]
+    folders = max(1, number_of_files // 100)
+
+    for index in range(number_of_files):
+        folder_pattern, extension, smallest, largest, share = kinds[index % len(kinds)]
+        folder = os.path.join(root, folder_pattern % (index % folders))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        with open(os.path.join(folder, "file%d%s" % (index, extension)), "wb") as f:
+            f.write(os.urandom(random.randint(smallest, largest) // 2) * 2)
+
+
+class Sandbox(object):
+
+    """A Packages folder with a synthetic User folder & an online sync folder."""
+
+    def __init__(self, number_of_files):
+        self.root = tempfile.mkdtemp(prefix="psync_bench_")
+        self.packages_path = os.path.join(self.root, "Packages")
+        self.online_folder = os.path.join(self.root, "Online")
+        self.zip_path = os.path.join(self.root, "Backup.zip")
+
+        headless.install(self.packages_path)
+        tools.init_paths()
+        tools.temp_restore_folder = os.path.join(self.root, "temp_restore")
+        self.reset()
+
+        create_user_folder(tools.user_settings_folder, number_of_files)
+        os.makedirs(self.online_folder)
+
+        settings = headless.load_settings("PackageSync.sublime-settings")
+        settings.set("online_sync_folder", self.online_folder)
+        settings.set("online_sync_enabled", True)
+        headless.save_settings("PackageSync.sublime-settings")
+        tools.invalidate_psync_settings()
+
+    def reset(self):
+        """Forget the in-memory state of the previous sandbox or run."""
+        scanner._scan_index = None
+        state._sync_state = None
+        hashing._hash_cache = None
+        tools.invalidate_psync_settings()
+
+    def clear_online_folder(self):
+        shutil.rmtree(self.online_folder, True)
+        os.makedirs(self.online_folder)
+        state.get_sync_state().reset()
+
+    def close(self):
+        headless.drain(10)
+        shutil.rmtree(self.root, True)
+
+
+def benchmarks(sandbox):
+    """Return (name, setup, run) for every benchmark, in the order they are run."""
+    user_folder = tools.user_settings_folder
+
+    def find_files():
+        online.Sync(["push"]).find_files(user_folder)
+
+    def find_files_cold():
+        sandbox.reset()
+        online.Sync(["push"]).find_files(user_folder)
+
+    watcher = {}
+
+    def watcher_setup():
+        psync_settings = tools.get_psync_settings()
+        watcher["watcher"] = tools.Watcher(user_folder, None, psync_settings["include_files"],
+                                           psync_settings["ignore_files"], psync_settings["ignore_dirs"])
+        watcher["watcher"].pause = True
+
+    def watcher_loop():
+        watcher["watcher"].loop()
+
+    def push_all_initial():
+        online.Sync(["push"]).push_all()
+
+    def push_all_unchanged():
+        online.Sync(["push"]).push_all()
+
+    def pull_all_unchanged():
+        online.Sync(["pull"]).pull_all()
+
+    def backup_zip():
+        offline.create_zip_backup(sandbox.zip_path)
+
+    def restore_setup():
+        shutil.rmtree(tools.temp_restore_folder, True)
+        shutil.copytree(tools.user_settings_folder, tools.temp_restore_folder,
+                        ignore=tools.get_path_filter().copytree_ignore(tools.user_settings_folder))
+
+    def restore_from_temp():
+        offline.restore_from_temp()
+
+    return [
+        ("find_files_cold", None, find_files_cold),
+        ("find_files", None, find_files),
+        ("watcher_loop", watcher_setup, watcher_loop),
+        ("push_all_initial", sandbox.clear_online_folder, push_all_initial),
+        ("push_all_unchanged", None, push_all_unchanged),
+        ("pull_all_unchanged", None, pull_all_unchanged),
+        ("backup_zip", None, backup_zip),
+        ("restore_from_temp", restore_setup, restore_from_temp),
+    ]
+
+
+def run_size(number_of_files, repeat):
+    start = time.time()
+    sandbox = Sandbox(number_of_files)
+    print("%d files (generated in %.1f s)" % (number_of_files, time.time() - start))
+
+    results = {}
+    try:
+        for name, setup, run in benchmarks(sandbox):
+            timings = []
+            for _ in range(repeat):
+                if setup is not None:
+                    setup()
+                start = time.time()
+                run()
+                timings += [time.time() - start]
+
+            results[name] = min(timings)
+            print("  %-20s %10.1f ms" % (name, results[name] * 1000))
+    finally:
+        sandbox.close()
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print the change against baseline & return the regressions."""
+    regressions = []
+    print("Compared to baseline (tolerance %d%%)" % (tolerance * 100))
+    for size, timings in sorted(results.items(), key=lambda item: int(item[0])):
+        for name, seconds in sorted(timings.items()):
+            previous = baseline.get(size, {}).get(name)
+            if not previous:
+                continue
+
+            change = seconds / previous - 1
+            regressed = change > tolerance
+            if regressed:
+                regressions += ["%s/%s" % (size, name)]
+            print("  %7s %-20s %10.1f ms %10.1f ms %+7.0f%%%s" % (
+                size, name, previous * 1000, seconds * 1000, change * 100, "  REGRESSION" if regressed else ""))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the hot paths of PackageSync.")
+    parser.add_argument("--sizes", default="1000,10000",
+                        help="comma separated numbers of files, e.g. 1000,10000,100000")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the best one counts")
+    parser.add_argument("--output", default=os.path.join(BENCHMARK_DIR, "results.json"))
+    parser.add_argument("--baseline", default=os.path.join(BENCHMARK_DIR, "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="slowdown against the baseline reported as a regression")
+    args = parser.parse_args()
+
+    results = {}
+    for size in args.sizes.split(","):
+        results[str(int(size))] = run_size(int(size), args.repeat)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created": time.time(),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4, sort_keys=True)
+    print("Results written to %s" % args.output)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+        print("Baseline written to %s" % args.baseline)
+        return 0
+
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.tolerance):
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
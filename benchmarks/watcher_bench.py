@@ -0,0 +1,153 @@
+"""Compare the snapshot based Watcher.loop against the previous polling loop.
+
+Usage: python benchmarks/watcher_bench.py [number_of_files]
+
+Builds a synthetic User folder (20k files by default), then reports the time
+and the number of file system calls of a poll in which nothing changed.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+from package_sync_helpers import headless
+
+headless.install(tempfile.mkdtemp(prefix="psync_bench_packages_"))
+
+from package_sync_helpers import tools
+
+INCLUDE_FILES = ["*.sublime-*", "*.tmLanguage", "*.tmTheme", "*.tmPreferences",
+                 "*.json", "*.png", "*.txt", "*.py", "*.md"]
+IGNORE_FILES = ["*.DS_Store", "*.last-run", "Package Control.ca-list", "Package Control.ca-bundle",
+                "Package Control.system-ca-bundle", "*.sublime-package"]
+IGNORE_DIRS = ["Package Control.cache", "Package Control.ca-cert"]
+EXTENSIONS = [".sublime-settings", ".json", ".py", ".tmTheme", ".png", ".md", ".pyc"]
+
+
+class LegacyWatcher(object):
+
+    """The polling loop as it was before the snapshot diff."""
+
+    def __init__(self, dir_to_watch):
+        self.dir_to_watch = dir_to_watch
+        self.path_filter = tools.PathFilter(INCLUDE_FILES, IGNORE_FILES, IGNORE_DIRS)
+        self.files_map = {}
+        self.update_files()
+
+    def get_sync_items(self):
+        return [{"key": relative_path, "path": absolute_path, "version": os.path.getmtime(absolute_path)}
+                for absolute_path, relative_path in self.path_filter.walk(self.dir_to_watch)]
+
+    def loop(self):
+        self.update_files()
+        for key, value in self.files_map.items():
+            if os.path.getmtime(value["path"]) != value["version"]:
+                value["version"] = os.path.getmtime(value["path"])
+
+    def update_files(self):
+        sync_items = [item for item in self.get_sync_items() if item["key"] not in self.files_map]
+        for key, value in self.files_map.copy().items():
+            if not os.path.exists(value["path"]):
+                del self.files_map[key]
+        for item in sync_items:
+            self.files_map[item["key"]] = item
+
+
+class SyscallCounter(object):
+
+    """Count the stat & directory listing calls made through the os module."""
+
+    def __init__(self):
+        self.count = 0
+        self.originals = {}
+
+    def wrap(self, function):
+        def wrapper(*args, **kwargs):
+            self.count += 1
+            return function(*args, **kwargs)
+        return wrapper
+
+    def wrap_scandir(self, function):
+        counter = self
+
+        class Entry(object):
+
+            def __init__(self, entry):
+                self.entry = entry
+                self.name = entry.name
+                self.path = entry.path
+
+            def stat(self):
+                counter.count += 1
+                return self.entry.stat()
+
+            def is_dir(self):
+                return self.entry.is_dir()
+
+            def is_symlink(self):
+                return self.entry.is_symlink()
+
+        def wrapper(*args, **kwargs):
+            self.count += 1
+            return [Entry(entry) for entry in function(*args, **kwargs)]
+        return wrapper
+
+    def __enter__(self):
+        for name in ("stat", "lstat", "listdir"):
+            self.originals[name] = getattr(os, name)
+            setattr(os, name, self.wrap(self.originals[name]))
+        self.originals["scandir"] = os.scandir
+        os.scandir = self.wrap_scandir(self.originals["scandir"])
+        return self
+
+    def __exit__(self, *exc_info):
+        for name, function in self.originals.items():
+            setattr(os, name, function)
+
+
+def create_tree(root, number_of_files):
+    for index in range(number_of_files):
+        folder = os.path.join(root, "Package%03d" % (index % 200), "sub%d" % (index % 5))
+        if index % 50 == 0:
+            folder = os.path.join(root, "Package Control.cache")
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(os.path.join(folder, "file%d%s" % (index, EXTENSIONS[index % len(EXTENSIONS)])), "w") as f:
+            f.write("x" * (index % 512))
+
+
+def measure(watcher, rounds=5):
+    with SyscallCounter() as counter:
+        watcher.loop()
+    timings = []
+    for _ in range(rounds):
+        start = time.time()
+        watcher.loop()
+        timings += [time.time() - start]
+    return min(timings), counter.count
+
+
+def main():
+    number_of_files = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    root = tempfile.mkdtemp(prefix="psync_bench_")
+    try:
+        create_tree(root, number_of_files)
+
+        legacy = LegacyWatcher(root)
+        watcher = tools.Watcher(root, None, INCLUDE_FILES, IGNORE_FILES, IGNORE_DIRS)
+        watcher.pause = True
+
+        print("Watcher.loop on %d files (%d synced)" % (number_of_files, len(watcher.files_map)))
+        for name, instance in (("legacy", legacy), ("snapshot", watcher)):
+            seconds, calls = measure(instance)
+            print("  %-8s %8.1f ms per poll %8d file system calls" % (name, seconds * 1000, calls))
+    finally:
+        shutil.rmtree(root, True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Compare zip backup compression policies on a synthetic User folder.
+
+Usage: python benchmarks/zip_compression_bench.py [scale]
+
+The generated folder mimics a typical User folder: settings & keymaps, small
+plugins, color schemes, syntax definitions & a few images. scale multiplies
+the number of files (default 1, about 1000 files).
+"""
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from package_sync_helpers import headless
+
+headless.install(tempfile.mkdtemp(prefix="psync_bench_packages_"))
+
+from package_sync_helpers import offline
+from package_sync_helpers import tools
+
+POLICIES = [
+    ("stored", {"method": "stored", "overrides": {}}),
+    ("deflate-1", {"method": "deflate", "level": 1, "overrides": {}}),
+    ("deflate-6", {"method": "deflate", "level": 6, "overrides": {}}),
+    ("deflate-9", {"method": "deflate", "level": 9, "overrides": {}}),
+    ("bzip2", {"method": "bzip2", "level": 9, "overrides": {}}),
+    ("lzma", {"method": "lzma", "overrides": {}}),
+    ("default", {}),
+]
+
+WORDS = ["color_scheme", "font_size", "tab_size", "translate_tabs_to_spaces", "ignored_packages",
+         "word_wrap", "rulers", "scope", "foreground", "background", "keys", "command", "args"]
+
+
+def random_text(size):
+    words = []
+    length = 0
+    while length < size:
+        word = random.choice(WORDS)
+        words += [word]
+        length += len(word) + 1
+    return " ".join(words)
+
+
+def create_user_folder(root, scale):
+    random.seed(42)
+    layout = [
+        ("Package%d.sublime-settings", 300, lambda: json.dumps(
+            {random.choice(WORDS) + str(i): random_text(random.randint(10, 200)) for i in range(random.randint(5, 80))},
+            indent=4)),
+        ("Default (Linux)%d.sublime-keymap", 50, lambda: json.dumps(
+            [{"keys": ["ctrl+%d" % i], "command": random.choice(WORDS)} for i in range(random.randint(10, 200))],
+            indent=4)),
+        ("plugin%d.py", 150, lambda: "import sublime\n\n" + "\n".join(
+            "def %s_%d():\n    return %r\n" % (random.choice(WORDS), i, random_text(60)) for i in range(random.randint(5, 60)))),
+        ("Scheme%d.tmTheme", 40, lambda: "<plist><dict>%s</dict></plist>" % "".join(
+            "<key>%s</key><string>#%06x</string>" % (random.choice(WORDS), random.randint(0, 0xffffff))
+            for i in range(random.randint(100, 2000)))),
+        ("Syntax%d.sublime-syntax", 40, lambda: random_text(random.randint(2000, 60000))),
+        ("icons/icon%d.png", 400, lambda: os.urandom(random.randint(500, 40000))),
+        ("notes%d.md", 20, lambda: random_text(random.randint(500, 5000))),
+    ]
+
+    for name, count, content in layout:
+        for index in range(count * scale):
+            path = os.path.join(root, name % index)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            data = content()
+            with open(path, "wb") as f:
+                f.write(data if isinstance(data, bytes) else data.encode("utf8"))
+
+
+def main():
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    root = tempfile.mkdtemp(prefix="psync_bench_")
+    try:
+        user_folder = os.path.join(root, "User")
+        create_user_folder(user_folder, scale)
+        files = list(tools.PathFilter(["*"]).walk(user_folder))
+        total_size = sum(os.path.getsize(path) for path, _ in files)
+
+        print("Zip backups of %d files, %.1f MB" % (len(files), total_size / 1048576.0))
+        print("  %-10s %10s %8s %12s %12s" % ("policy", "size (MB)", "ratio", "backup (ms)", "restore (ms)"))
+
+        for name, compression in POLICIES:
+            policy = offline.CompressionPolicy.from_settings({"zip_compression": compression})
+            zip_path = os.path.join(root, name + ".zip")
+
+            start = time.time()
+            z = zipfile.ZipFile(zip_path, "w")
+            for absolute_path, relative_path in files:
+                policy.write(z, absolute_path, relative_path)
+            z.close()
+            backup_time = time.time() - start
+
+            restore_folder = os.path.join(root, "restore_" + name)
+            start = time.time()
+            z = zipfile.ZipFile(zip_path, "r")
+            z.extractall(restore_folder)
+            z.close()
+            restore_time = time.time() - start
+
+            size = os.path.getsize(zip_path)
+            print("  %-10s %10.2f %7.1f%% %12.0f %12.0f" % (
+                name, size / 1048576.0, 100.0 * size / total_size, backup_time * 1000, restore_time * 1000))
+            shutil.rmtree(restore_folder, True)
+    finally:
+        shutil.rmtree(root, True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""Back up, restore & sync the User folder without running Sublime Text.
+
+Usage:
+    python -m package_sync_helpers [--packages-path PATH] [--settings FILE] [--verbose]
+        backup {list,folder,zip,snapshot} PATH
+        restore {list,folder,zip,snapshot} PATH [--snapshot ID]
+        sync [--pull] [--push] [--override] [--folder PATH]
+        migrate {packed,files} [--folder PATH] [--remove-loose]
+
+The Packages folder of Sublime Text is found at its default location unless
+--packages-path is given. --settings points to a JSON file with PackageSync
+settings, which take precedence over the PackageSync.sublime-settings of the
+User folder. Nothing is ever prompted for. Missing packages are installed
+by Package Control on the next start of Sublime Text.
+
+Exit status is 0 on success, 1 if the backup or any file could not be
+handled & 2 on invalid arguments.
+"""
+import argparse
+import os
+import shutil
+import sys
+import time
+
+if __package__ in (None, ""):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from package_sync_helpers import headless
+
+#: Data folders of Sublime Text, newest first, by platform
+DATA_FOLDERS = {
+    "darwin": [os.path.join("~", "Library", "Application Support", name) for name in ("Sublime Text", "Sublime Text 3")],
+    "win32": [os.path.join(os.environ.get("APPDATA", "~"), name) for name in ("Sublime Text", "Sublime Text 3")],
+    "linux": [os.path.join("~", ".config", name) for name in ("sublime-text", "sublime-text-3")],
+}
+
+
+class CommandError(Exception):
+    pass
+
+
+def find_packages_path():
+    for data_folder in DATA_FOLDERS.get(sys.platform, DATA_FOLDERS["linux"]):
+        packages_path = os.path.join(os.path.expanduser(data_folder), "Packages")
+        if os.path.isdir(packages_path):
+            return packages_path
+
+    return None
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m package_sync_helpers",
+        description="Back up, restore & sync Sublime Text packages & user settings.")
+    parser.add_argument("--packages-path", help="Packages folder of Sublime Text")
+    parser.add_argument("--settings", help="JSON file with PackageSync settings")
+    parser.add_argument("--verbose", action="store_true", help="log every file handled")
+
+    commands = parser.add_subparsers(dest="command")
+
+    backup = commands.add_parser("backup", help="back up the User folder")
+    backup.add_argument("type", choices=["list", "folder", "zip", "snapshot"])
+    backup.add_argument("path", help="backup file, folder or snapshot repository")
+
+    restore = commands.add_parser("restore", help="restore the User folder from a backup")
+    restore.add_argument("type", choices=["list", "folder", "zip", "snapshot"])
+    restore.add_argument("path", help="backup file, folder or snapshot repository")
+    restore.add_argument("--snapshot", help="snapshot to restore, the latest by default")
+
+    sync = commands.add_parser("sync", help="sync once with the online sync folder")
+    sync.add_argument("--pull", action="store_true", help="only pull from the online sync folder")
+    sync.add_argument("--push", action="store_true", help="only push to the online sync folder")
+    sync.add_argument("--override", action="store_true", help="copy files even if they are not newer")
+    sync.add_argument("--folder", help="online sync folder, instead of online_sync_folder")
+
+    migrate = commands.add_parser("migrate", help="convert the online sync folder to another format")
+    migrate.add_argument("format", choices=["packed", "files"])
+    migrate.add_argument("--folder", help="online sync folder, instead of online_sync_folder")
+    migrate.add_argument("--remove-loose", action="store_true",
+                         help="remove the packed loose files, once all machines use the packed format")
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error("a command is required")
+
+    args.packages_path = args.packages_path or find_packages_path()
+    if args.packages_path is None or not os.path.isdir(args.packages_path):
+        parser.error("Packages folder not found, please pass --packages-path")
+
+    return args
+
+
+def load_settings(args):
+    """Apply the settings of the command line on top of the User settings."""
+    settings = headless.load_settings("PackageSync.sublime-settings")
+
+    if args.settings:
+        with open(args.settings, "r", encoding="utf8") as f:
+            for key, value in headless.load_sublime_json(f.read()).items():
+                settings.set(key, value)
+
+    settings.set("prompt_for_location", False)
+    if args.verbose:
+        settings.set("debug", True)
+    if getattr(args, "folder", None):
+        settings.set("online_sync_folder", os.path.abspath(args.folder))
+    if args.command == "migrate":
+        settings.set("online_sync_format", args.format)
+
+
+def backup(args, tools, offline, copier, snapshots):
+    path = os.path.abspath(args.path)
+    psync_settings = tools.get_psync_settings()
+
+    failed = []
+    if args.type == "list":
+        offline.create_list_backup(path)
+    elif args.type == "folder":
+        failed = offline.backup_to_folder(path)
+    elif args.type == "zip":
+        offline.create_zip_backup(path)
+    else:
+        repository = snapshots.SnapshotRepository(path)
+        snapshot_id = repository.create(
+            tools.user_settings_folder, tools.get_path_filter(psync_settings), copier.get_copy_engine(psync_settings))
+        repository.prune(psync_settings["snapshot_retention"])
+        print("Snapshot %s created" % snapshot_id)
+
+    return failed
+
+
+def restore(args, tools, offline, copier, snapshots):
+    path = os.path.abspath(args.path)
+    if not os.path.exists(path):
+        raise CommandError("Backup not found @ %s" % path)
+
+    # Keep the PackageSync settings, even if the User folder is replaced
+    packagesync_settings = os.path.join(tools.user_settings_folder, "PackageSync.sublime-settings")
+    packagesync_settings_data = None
+    if os.path.isfile(packagesync_settings):
+        with open(packagesync_settings, "rb") as f:
+            packagesync_settings_data = f.read()
+
+    failed = []
+    if args.type == "list":
+        offline.restore_list_backup(path)
+    elif args.type == "folder":
+        failed = offline.restore_from_folder(path)
+    elif args.type == "zip":
+        failed = offline.restore_from_zip(path)
+    else:
+        repository = snapshots.SnapshotRepository(path)
+        snapshot_ids = repository.list_snapshots()
+        snapshot_id = args.snapshot or (snapshot_ids[-1] if snapshot_ids else None)
+        if snapshot_id not in snapshot_ids:
+            raise CommandError("Snapshot %s not found @ %s" % (snapshot_id, path))
+
+        try:
+            failed = repository.restore(
+                snapshot_id, tools.temp_restore_folder, copier.get_copy_engine(tools.get_psync_settings()))
+            if not failed:
+                failed = offline.restore_from_temp()
+        finally:
+            shutil.rmtree(tools.temp_restore_folder, True)
+
+    if packagesync_settings_data is not None and not os.path.exists(packagesync_settings):
+        with open(packagesync_settings, "wb") as f:
+            f.write(packagesync_settings_data)
+
+    return failed
+
+
+def sync(args, tools, online):
+    psync_settings = tools.get_psync_settings()
+    if not os.path.isdir(psync_settings["online_sync_folder"] or ""):
+        raise CommandError("Online sync folder not found, please pass --folder or set online_sync_folder")
+
+    mode = [name for name in ("pull", "push") if getattr(args, name)] or ["pull", "push"]
+    online.Sync(mode, args.override).run()
+
+    return []
+
+
+def migrate(args, tools, online):
+    psync_settings = tools.get_psync_settings()
+    if not os.path.isdir(psync_settings["online_sync_folder"] or ""):
+        raise CommandError("Online sync folder not found, please pass --folder or set online_sync_folder")
+
+    online.Migrate(args.remove_loose).run()
+
+    return []
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    headless.install(args.packages_path)
+    load_settings(args)
+
+    from package_sync_helpers import tools
+    from package_sync_helpers import offline
+    from package_sync_helpers import online
+    from package_sync_helpers import copier
+    from package_sync_helpers import snapshots
+    from package_sync_helpers import state
+    from package_sync_helpers import metrics
+    from package_sync_helpers import removal
+
+    tools.init_paths()
+
+    start = time.time()
+    try:
+        if args.command == "backup":
+            failed = backup(args, tools, offline, copier, snapshots)
+        elif args.command == "restore":
+            failed = restore(args, tools, offline, copier, snapshots)
+        elif args.command == "migrate":
+            failed = migrate(args, tools, online)
+        else:
+            failed = sync(args, tools, online)
+    except CommandError as e:
+        print("PackageSync: %s" % str(e))
+        return 1
+
+    # Let the package removals & the work handed to the main thread finish,
+    # then persist the sync state
+    removal.get_package_remover().wait(60)
+    headless.drain(30)
+    state.get_sync_state().close()
+    metrics.get_metrics().close()
+
+    if failed:
+        print("PackageSync: %s failed for %s" % (args.command, ", ".join(failed)))
+        return 1
+
+    print("PackageSync: %s done in %.2f s" % (args.command, time.time() - start))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
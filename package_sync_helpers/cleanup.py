@@ -0,0 +1,182 @@
+import sublime
+
+import os
+import sys
+import threading
+import time
+
+try:
+    from . import tools
+    from . import metrics
+except ValueError:
+    from package_sync_helpers import tools
+    from package_sync_helpers import metrics
+
+#: Milliseconds during which install requests are merged into one cleanup run
+CLEANUP_DELAY = 1000
+
+#: Seconds between the checks whether Package Control finished installing
+CLEANUP_POLL_INTERVAL = 1
+
+#: Seconds without changes to the packages on disk after which the installs are taken as done
+CLEANUP_SETTLE_TIME = 30
+
+#: Seconds after which a cleanup run is taken as done in any case
+CLEANUP_TIMEOUT = 600
+
+_package_cleanup = None
+_package_cleanup_lock = threading.Lock()
+
+
+def get_package_cleanup():
+    global _package_cleanup
+
+    with _package_cleanup_lock:
+        if _package_cleanup is None:
+            _package_cleanup = PackageCleanup()
+
+    return _package_cleanup
+
+
+def install_new_packages():
+    """Let Package Control install the packages missing from installed_packages."""
+    get_package_cleanup().request()
+
+
+def list_packages():
+    """Return the names of the packages on disk, both packed & unpacked."""
+    packages = set()
+    try:
+        packages.update(name[:-len(".sublime-package")] for name in os.listdir(sublime.installed_packages_path())
+                        if name.endswith(".sublime-package"))
+    except OSError:
+        pass
+
+    try:
+        packages.update(name for name in os.listdir(sublime.packages_path())
+                        if os.path.isdir(os.path.join(sublime.packages_path(), name)))
+    except OSError:
+        pass
+
+    return packages
+
+
+def get_package_control_cleanup():
+    module_name = "Package Control.package_control.package_cleanup" if sublime.version()[0] == "3" \
+        else "package_control.package_cleanup"
+    return sys.modules[module_name].PackageCleanup
+
+
+class PackageCleanup(object):
+
+    """Runs the PackageCleanup of Package Control for batches of install requests.
+
+    Every restore & every pulled Package Control.sublime-settings asks for
+    missing packages to be installed. Requests made within CLEANUP_DELAY of
+    the first one are handled by one cleanup run, and requests made while a
+    run is in progress by exactly one more run once it finished.
+
+    Package Control installs the missing packages after its cleanup thread
+    ended, so a run lasts until Package Control wrote its last-run file
+    again, or until the packages on disk stopped changing. The packages a
+    run installed are logged & kept in `installed_packages`.
+    """
+
+    def __init__(self, delay=CLEANUP_DELAY):
+        self.delay = delay
+
+        self.lock = threading.Lock()
+        self.scheduled = False
+        self.running = False
+        self.rerun = False
+        self.requests = 0
+        self.installed_packages = []
+
+    def request(self):
+        with self.lock:
+            self.requests += 1
+            if self.running:
+                self.rerun = True
+                return
+            if self.scheduled:
+                return
+            self.scheduled = True
+
+        sublime.set_timeout(self.start, self.delay)
+
+    def start(self):
+        """Start a cleanup run, on the main thread."""
+        with self.lock:
+            self.scheduled = False
+            self.running = True
+            requests, self.requests = self.requests, 0
+
+        try:
+            # Add PackageSync to the installed packages list if it has been removed
+            tools.add_packagesync_to_installed_packages()
+
+            # Remove the last-run file in order to trigger the package
+            # installation
+            pkg_control_last_run = os.path.join(
+                sublime.packages_path(), "User", "Package Control.last-run")
+            if os.path.isfile(pkg_control_last_run):
+                os.remove(pkg_control_last_run)
+
+            previous_packages = list_packages()
+            cleanup_thread = get_package_control_cleanup()()
+            cleanup_thread.start()
+
+        except KeyError:
+            tools.log("PackageSync: Package Control is not loaded, it installs the missing packages on its next start")
+            self.finish()
+            return
+
+        except Exception as e:
+            tools.log(
+                "PackageSync: Error while installing packages via Package Control.", force=True)
+            tools.log("PackageSync: Error message: %s" % str(e), force=True)
+            self.finish()
+            return
+
+        tools.log("PackageSync: Package Control cleanup started for %d request(s)" % requests)
+
+        # Wait for the cleanup off the main thread
+        waiter = threading.Thread(target=self.wait,
+                                  args=(cleanup_thread, pkg_control_last_run, previous_packages, time.time(), requests))
+        waiter.daemon = True
+        waiter.start()
+
+    def wait(self, cleanup_thread, pkg_control_last_run, previous_packages, start, requests):
+        cleanup_thread.join()
+
+        # Wait for the installs Package Control schedules once the cleanup ended
+        packages = list_packages()
+        changed = time.time()
+        while not os.path.isfile(pkg_control_last_run) and time.time() - start < CLEANUP_TIMEOUT:
+            time.sleep(CLEANUP_POLL_INTERVAL)
+            current_packages = list_packages()
+            if current_packages != packages:
+                packages = current_packages
+                changed = time.time()
+            elif time.time() - changed >= CLEANUP_SETTLE_TIME:
+                break
+
+        installed_packages = sorted(list_packages() - previous_packages)
+        metrics.get_metrics().record("packages.cleanup", time.time() - start,
+                                     requests=requests, installed=len(installed_packages))
+        if installed_packages:
+            tools.log("PackageSync: Package Control installed %s" % ", ".join(installed_packages), force=True)
+
+        with self.lock:
+            self.installed_packages = installed_packages
+
+        self.finish()
+
+    def finish(self):
+        with self.lock:
+            self.running = False
+            rerun, self.rerun = self.rerun, False
+            self.scheduled = rerun
+
+        if rerun:
+            sublime.set_timeout(self.start, self.delay)
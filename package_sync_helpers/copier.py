@@ -0,0 +1,227 @@
+import collections
+import concurrent.futures
+import errno
+import os
+import shutil
+import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from . import tools
+except ValueError:
+    from package_sync_helpers import tools
+
+#: Number of files copied at the same time, unless configured otherwise
+DEFAULT_WORKERS = 4
+
+#: Number of bytes handed to a single copy_file_range/sendfile call
+CHUNK_SIZE = 8 * 1024 * 1024
+
+#: errno values telling that the kernel can not copy between the two files
+_UNSUPPORTED_ERRORS = set(getattr(errno, name, None) for name in (
+    "ENOSYS", "EXDEV", "EINVAL", "ENOTSUP", "EOPNOTSUPP", "ENOTSOCK", "EBADF", "EPERM")) - set([None])
+
+#: ioctl request making a file share the data blocks of another one on Linux
+FICLONE = 0x40049409
+
+#: Ways of copying a file, cheapest first
+CLONE_STRATEGIES = ("reflink", "hardlink", "copy")
+
+#: errno values telling that a file system can not reflink or hardlink at all
+_UNSUPPORTED_CLONE_ERRORS = set(getattr(errno, name, None) for name in (
+    "ENOSYS", "EXDEV", "EINVAL", "ENOTSUP", "EOPNOTSUPP", "ENOTTY", "EPERM")) - set([None])
+
+#: Strategies found not to work, by (source device, target device)
+_unsupported_strategies = collections.defaultdict(set)
+
+_copy_engine = None
+_copy_engine_lock = threading.Lock()
+
+
+def copy_data(source, target):
+    """Copy the contents of source to target.
+
+    The data is copied inside the kernel through os.copy_file_range or
+    os.sendfile where available, which also allows file systems to share
+    blocks or copy server side.
+    """
+    with open(source, "rb") as fsrc:
+        with open(target, "wb") as fdst:
+            for kernel_copy in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+                if kernel_copy is None:
+                    continue
+
+                try:
+                    if kernel_copy is os.copy_file_range:
+                        while kernel_copy(fsrc.fileno(), fdst.fileno(), CHUNK_SIZE):
+                            pass
+                    else:
+                        offset = 0
+                        while True:
+                            sent = kernel_copy(fdst.fileno(), fsrc.fileno(), offset, CHUNK_SIZE)
+                            if not sent:
+                                break
+                            offset += sent
+                    return
+                except OSError as e:
+                    if e.errno not in _UNSUPPORTED_ERRORS:
+                        raise
+
+                    # Start over with the next way of copying
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+
+def copy_file(source, target):
+    """Copy source to target including its metadata, like shutil.copy2."""
+    copy_data(source, target)
+    shutil.copystat(source, target)
+
+
+def reflink_file(source, target):
+    """Make target share the data blocks of source, as on btrfs or xfs.
+
+    Raises OSError where the file system does not support it.
+    """
+    if fcntl is None or not sys.platform.startswith("linux"):
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported")
+
+    with open(source, "rb") as fsrc:
+        with open(target, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(source, target)
+
+
+def hardlink_file(source, target):
+    if os.path.lexists(target):
+        os.remove(target)
+    os.link(source, target)
+
+
+def clone_file(source, target, hardlink=False):
+    """Copy source to target as cheaply as the file systems allow. Returns the strategy used.
+
+    A reflink shares the data blocks of source until either file is changed,
+    so it is tried first. A hardlink shares the file itself, changes to
+    source included, so it is only used with hardlink=True, for copies which
+    are only read & removed soon after. A real copy is the last resort.
+    Strategies failing for a pair of file systems are not tried again.
+    """
+    devices = (os.stat(source).st_dev, os.stat(os.path.dirname(target) or ".").st_dev)
+    unsupported = _unsupported_strategies[devices]
+
+    for strategy in CLONE_STRATEGIES:
+        if strategy in unsupported or (strategy == "hardlink" and not hardlink):
+            continue
+
+        if strategy == "copy":
+            copy_file(source, target)
+            return strategy
+
+        try:
+            if strategy == "reflink":
+                reflink_file(source, target)
+            else:
+                hardlink_file(source, target)
+            return strategy
+        except OSError as e:
+            # Only give up on the file system if the error is not about this file
+            if e.errno in _UNSUPPORTED_CLONE_ERRORS and strategy not in unsupported:
+                unsupported.add(strategy)
+                tools.log("PackageSync: No %s copies from %s to %s, falling back" % (
+                    strategy, os.path.dirname(source), os.path.dirname(target)))
+
+
+def link_file(source, target):
+    """Like `clone_file`, but hardlinks are allowed. For transient, read-only copies only."""
+    return clone_file(source, target, hardlink=True)
+
+
+def get_copy_engine(psync_settings=None):
+    global _copy_engine
+
+    max_workers = DEFAULT_WORKERS
+    if psync_settings is not None:
+        max_workers = psync_settings.get("copy_workers", DEFAULT_WORKERS)
+
+    with _copy_engine_lock:
+        if _copy_engine is None or _copy_engine.max_workers != max_workers:
+            _copy_engine = CopyEngine(max_workers)
+
+    return _copy_engine
+
+
+class CopyEngine(object):
+
+    """Copies many files through a bounded pool of threads.
+
+    Jobs are (source, target, payload) tuples. All target folders are created
+    upfront, and the results are handed back in the order of the jobs so that
+    callers can commit their state updates in order.
+    """
+
+    def __init__(self, max_workers=DEFAULT_WORKERS):
+        self.max_workers = max(1, int(max_workers))
+
+    def run(self, jobs, function=copy_file):
+        """Yield (job, result, error) for every job, in order.
+
+        function(source, target) is run for each job & its return value is
+        passed on as result. error is the exception raised by it, if any.
+        """
+        jobs = list(jobs)
+
+        # Create every target folder once, before any file is copied
+        for target_dir in sorted(set(os.path.dirname(job[1]) for job in jobs)):
+            if target_dir and not os.path.isdir(target_dir):
+                os.makedirs(target_dir, exist_ok=True)
+
+        if self.max_workers == 1 or len(jobs) < 2:
+            for job in jobs:
+                try:
+                    yield job, function(job[0], job[1]), None
+                except Exception as e:
+                    yield job, None, e
+            return
+
+        # Keep a bounded number of copies in flight
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as executor:
+            pending = collections.deque()
+            for job in jobs:
+                pending.append((job, executor.submit(function, job[0], job[1])))
+                if len(pending) >= self.max_workers * 4:
+                    yield self.result(*pending.popleft())
+
+            while pending:
+                yield self.result(*pending.popleft())
+
+    def result(self, job, future):
+        try:
+            return job, future.result(), None
+        except Exception as e:
+            return job, None, e
+
+    def copy_tree(self, source_dir, target_dir, path_filter=None, function=copy_file):
+        """Copy the files below source_dir which match path_filter to target_dir.
+
+        function(source, target) copies a single file, see `run`. Returns
+        the relative paths of the files that could not be copied.
+        """
+        if path_filter is None:
+            path_filter = tools.PathFilter(["*"])
+
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+
+        jobs = [(absolute_path, os.path.join(target_dir, relative_path), relative_path)
+                for absolute_path, relative_path in path_filter.walk(source_dir)]
+
+        return [job[2] for job, result, error in self.run(jobs, function) if error is not None]
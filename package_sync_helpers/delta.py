@@ -0,0 +1,140 @@
+import os
+import shutil
+
+try:
+    from . import copier
+    from . import hashing
+    from . import metrics
+except ValueError:
+    from package_sync_helpers import copier
+    from package_sync_helpers import hashing
+    from package_sync_helpers import metrics
+
+#: Files smaller than this (in bytes) are copied as a whole, unless configured otherwise
+DEFAULT_THRESHOLD = 1024 * 1024
+
+#: Size of the blocks compared & reused
+BLOCK_SIZE = 64 * 1024
+
+#: Bytes searched ahead for the next matching block once a block does not match
+RESYNC_DISTANCE = 4 * 1024 * 1024
+
+
+def block_digest(block):
+    digest = hashing.new_hash()
+    digest.update(block)
+    return digest.digest()
+
+
+def block_signatures(data, block_size):
+    """Return {checksum: offset} of the blocks of data."""
+    signatures = {}
+    for offset in range(0, len(data), block_size):
+        signatures.setdefault(block_digest(data[offset:offset + block_size]), offset)
+
+    return signatures
+
+
+def match_blocks(source, target, block_size=BLOCK_SIZE):
+    """Yield the pieces source is made of, as (offset, size) of equal data in target or literal bytes.
+
+    Blocks of source are matched against the data following the previous
+    match in target, then looked up by checksum among all blocks of target.
+    Where neither matches, the next block of target is searched for further
+    on in source & the block of source further on in target, so that
+    contents shifted by inserted or removed bytes line up again.
+    """
+    signatures = block_signatures(target, block_size)
+
+    position = 0
+    literal_start = 0
+    next_offset = 0
+    while position < len(source):
+        block = source[position:position + block_size]
+
+        offset = next_offset if target[next_offset:next_offset + len(block)] == block else None
+        if offset is None:
+            offset = signatures.get(block_digest(block))
+            if offset is not None and target[offset:offset + len(block)] != block:
+                offset = None
+
+        # Bytes removed from source: the block follows later in target
+        if offset is None and len(block) == block_size:
+            offset = target.find(block, next_offset, next_offset + RESYNC_DISTANCE)
+            if offset == -1:
+                offset = None
+
+        if offset is not None:
+            if literal_start < position:
+                yield source[literal_start:position]
+            yield (offset, len(block))
+
+            position += len(block)
+            literal_start = position
+            next_offset = offset + len(block)
+            continue
+
+        # Bytes inserted into source: the next block of target follows later in source
+        following = target[next_offset:next_offset + block_size]
+        index = -1
+        if len(following) == block_size:
+            index = source.find(following, position + 1, position + RESYNC_DISTANCE)
+
+        if index == -1:
+            position += block_size
+            next_offset += block_size
+        else:
+            position = index
+
+    if literal_start < len(source):
+        yield source[literal_start:]
+
+
+def update_file(source, target, block_size=BLOCK_SIZE):
+    """Make target a copy of source, reusing the blocks of target which source still contains.
+
+    The new contents are written to a temp file next to target, which then
+    replaces it, so Sublime & cloud clients never read a half written file
+    & hardlinks to target are left alone. Returns the number of bytes which
+    had to be taken from source.
+    """
+    with open(source, "rb") as f:
+        source_data = f.read()
+    with open(target, "rb") as f:
+        target_data = f.read()
+
+    literal_bytes = 0
+    temp_path = target + ".psync-tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            for piece in match_blocks(source_data, target_data, block_size):
+                if isinstance(piece, tuple):
+                    f.write(target_data[piece[0]:piece[0] + piece[1]])
+                else:
+                    f.write(piece)
+                    literal_bytes += len(piece)
+
+        shutil.copystat(source, temp_path)
+        os.replace(temp_path, target)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return literal_bytes
+
+
+def copy_file(source, target, threshold=DEFAULT_THRESHOLD):
+    """Copy source to target, through `update_file` if target exists & source is large enough.
+
+    A threshold of 0 turns block updates off.
+    """
+    if not threshold or not os.path.isfile(target):
+        return copier.copy_file(source, target)
+
+    size = os.path.getsize(source)
+    if size < threshold:
+        return copier.copy_file(source, target)
+
+    with metrics.get_metrics().span("sync.delta", bytes=size) as span:
+        span.count("literal_bytes", update_file(source, target))
@@ -0,0 +1,108 @@
+import collections
+import hashlib
+import mmap
+import os
+import threading
+
+#: Files of at least this size (in bytes) are hashed through mmap
+MMAP_THRESHOLD = 1024 * 1024
+
+#: Size of the chunks in which smaller files are read
+CHUNK_SIZE = 64 * 1024
+
+#: The mtime & size of a file as known from a scan, in place of os.stat
+FileStat = collections.namedtuple("FileStat", ["st_mtime", "st_size"])
+
+_hash_cache = None
+_hash_cache_lock = threading.Lock()
+
+
+def new_hash():
+    # blake2b is only available from Python 3.6 on
+    if hasattr(hashlib, "blake2b"):
+        return hashlib.blake2b(digest_size=20)
+    return hashlib.sha1()
+
+
+def hash_file(path, size=None):
+    """Return the hex digest of the contents of the file at path."""
+    digest = new_hash()
+
+    if size is None:
+        size = os.path.getsize(path)
+
+    with open(path, "rb") as f:
+        if size >= MMAP_THRESHOLD:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                digest.update(mapped)
+            finally:
+                mapped.close()
+        else:
+            chunk = f.read(CHUNK_SIZE)
+            while chunk:
+                digest.update(chunk)
+                chunk = f.read(CHUNK_SIZE)
+
+    return digest.hexdigest()
+
+
+def get_hash_cache():
+    global _hash_cache
+
+    with _hash_cache_lock:
+        if _hash_cache is None:
+            _hash_cache = HashCache()
+
+    return _hash_cache
+
+
+class HashCache(object):
+
+    """Content hashes of files, valid as long as their mtime & size match."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def seed(self, records):
+        """Take over the hashes stored with sync records (path, version, size, hash)."""
+        with self.lock:
+            for record in records:
+                if "hash" in record and "size" in record and record["path"] not in self.entries:
+                    self.entries[record["path"]] = (record["version"], record["size"], record["hash"])
+
+    def get(self, path, stat=None):
+        if stat is None:
+            stat = os.stat(path)
+
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is not None and entry[0] == stat.st_mtime and entry[1] == stat.st_size:
+            return entry[2]
+
+        digest = hash_file(path, stat.st_size)
+        with self.lock:
+            self.entries[path] = (stat.st_mtime, stat.st_size, digest)
+
+        return digest
+
+    def set(self, path, digest, stat=None):
+        if stat is None:
+            stat = os.stat(path)
+
+        with self.lock:
+            self.entries[path] = (stat.st_mtime, stat.st_size, digest)
+
+    def same_content(self, path_a, path_b):
+        """Check whether two files have the same contents, comparing sizes first."""
+        try:
+            stat_a = os.stat(path_a)
+            stat_b = os.stat(path_b)
+        except OSError:
+            return False
+
+        if stat_a.st_size != stat_b.st_size:
+            return False
+
+        return self.get(path_a, stat_a) == self.get(path_b, stat_b)
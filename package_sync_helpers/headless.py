@@ -0,0 +1,324 @@
+"""Stand-in for the sublime & sublime_plugin modules outside of Sublime Text.
+
+`install` registers minimal versions of both modules in sys.modules, so that
+PackageSync can be imported & run from a plain Python interpreter, e.g. by
+the benchmarks & the command line interface. Settings are read from the
+defaults of the packages & from the User folder below packages_path, with
+the same comments & trailing commas Sublime allows. set_timeout callbacks
+run on a thread of their own, like on the main thread of the editor.
+"""
+import heapq
+import itertools
+import json
+import os
+import re
+import sys
+import threading
+import time
+import types
+
+#: Match strings (kept) & comments or trailing commas (removed) in sublime JSON
+_JSON_COMMENTS = re.compile(r'("(?:\\.|[^"\\])*")|//[^\n]*|/\*.*?\*/', re.S)
+_JSON_TRAILING_COMMAS = re.compile(r'("(?:\\.|[^"\\])*")|,(?=\s*[}\]])')
+
+_package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_sublime_json(text):
+    """Parse JSON with the comments & trailing commas used in .sublime-settings files."""
+    keep_strings = lambda match: match.group(1) or ""
+    return json.loads(_JSON_TRAILING_COMMAS.sub(keep_strings, _JSON_COMMENTS.sub(keep_strings, text)))
+
+
+def command_name(class_name):
+    """Return the command name Sublime derives from a command class name."""
+    if class_name.endswith("Command"):
+        class_name = class_name[:-len("Command")]
+    return re.sub(r"(?<=[a-z0-9])([A-Z])", r"_\1", class_name).lower()
+
+
+class Settings(object):
+
+    def __init__(self, defaults, values):
+        self.defaults = defaults
+        self.values = values
+        self.callbacks = {}
+
+    def get(self, key, default=None):
+        if key in self.values:
+            return self.values[key]
+        return self.defaults.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+        for callback in list(self.callbacks.values()):
+            callback()
+
+    def has(self, key):
+        return key in self.values or key in self.defaults
+
+    def erase(self, key):
+        self.values.pop(key, None)
+
+    def add_on_change(self, tag, callback):
+        self.callbacks[tag] = callback
+
+    def clear_on_change(self, tag):
+        self.callbacks.pop(tag, None)
+
+
+class Window(object):
+
+    """Window without views. Panels are answered with cancel."""
+
+    def __init__(self):
+        self.commands = []
+
+    def run_command(self, name, args=None):
+        run_command(name, args, self)
+
+    def show_input_panel(self, caption, initial_text, on_done, on_change, on_cancel):
+        if on_cancel is not None:
+            on_cancel()
+
+    def show_quick_panel(self, items, on_done, *args, **kwargs):
+        on_done(-1)
+
+    def folders(self):
+        return []
+
+
+class MainThread(object):
+
+    """Runs set_timeout callbacks in order of their due time on one thread."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = []
+        self.counter = itertools.count()
+        self.running = 0
+        self.thread = None
+
+    def add(self, callback, delay):
+        with self.condition:
+            heapq.heappush(self.pending, (time.time() + delay / 1000.0, next(self.counter), callback))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="sublime main thread")
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending or self.pending[0][0] > time.time():
+                    self.condition.wait(self.pending[0][0] - time.time() if self.pending else None)
+                due, index, callback = heapq.heappop(self.pending)
+                self.running += 1
+
+            try:
+                callback()
+            except Exception as e:
+                print("headless: Error in set_timeout callback: %s" % str(e))
+            finally:
+                with self.condition:
+                    self.running -= 1
+                    self.condition.notify_all()
+
+    def drain(self, timeout=None):
+        """Wait until all callbacks due so far have run. Returns False on timeout."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.running or (self.pending and self.pending[0][0] <= time.time()):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+
+        return True
+
+
+_state = {
+    "packages_path": None,
+    "settings": {},
+    "version": "3211",
+    "window": None,
+    "modules": None,
+    "main_thread": MainThread(),
+}
+
+
+def packages_path():
+    return _state["packages_path"]
+
+
+def installed_packages_path():
+    return os.path.join(os.path.dirname(_state["packages_path"]), "Installed Packages")
+
+
+def load_settings(name):
+    if name not in _state["settings"]:
+        # Defaults of every package, overridden by the User folder
+        defaults = {}
+        folders = [_package_path]
+        if os.path.isdir(_state["packages_path"]):
+            folders += [os.path.join(_state["packages_path"], folder)
+                        for folder in sorted(os.listdir(_state["packages_path"])) if folder != "User"]
+
+        for folder in folders:
+            defaults.update(_read_settings(os.path.join(folder, name)))
+
+        _state["settings"][name] = Settings(
+            defaults, _read_settings(os.path.join(_state["packages_path"], "User", name)))
+
+    return _state["settings"][name]
+
+
+def _read_settings(path):
+    try:
+        with open(path, "r", encoding="utf8") as f:
+            return load_sublime_json(f.read())
+    except (IOError, OSError):
+        return {}
+
+
+def save_settings(name):
+    user_folder = os.path.join(_state["packages_path"], "User")
+    if not os.path.isdir(user_folder):
+        os.makedirs(user_folder)
+
+    with open(os.path.join(user_folder, name), "w", encoding="utf8") as f:
+        json.dump(load_settings(name).values, f, indent=4, sort_keys=True)
+
+
+def set_timeout(callback, delay=0):
+    if callback is not None:
+        _state["main_thread"].add(callback, delay)
+
+
+def run_command(name, args=None, window=None):
+    """Run an application or window command, like sublime.run_command."""
+    classes = [ApplicationCommand, WindowCommand]
+    while classes:
+        command_class = classes.pop()
+        classes += command_class.__subclasses__()
+
+        if command_name(command_class.__name__) != name:
+            continue
+
+        if issubclass(command_class, WindowCommand):
+            command = command_class(window or active_window())
+        else:
+            command = command_class()
+
+        # Like Sublime, fall back to is_enabled without the arguments
+        args = args or {}
+        try:
+            enabled = command.is_enabled(**args)
+        except TypeError:
+            enabled = command.is_enabled()
+
+        if enabled:
+            command.run(**args)
+        return
+
+    raise ValueError("Unknown command %s" % name)
+
+
+def active_window():
+    if _state["window"] is None:
+        _state["window"] = Window()
+    return _state["window"]
+
+
+def message(text):
+    print(text)
+
+
+class ApplicationCommand(object):
+
+    def is_enabled(self):
+        return True
+
+
+class WindowCommand(object):
+
+    def __init__(self, window):
+        self.window = window
+
+    def is_enabled(self):
+        return True
+
+
+class TextCommand(object):
+
+    def __init__(self, view):
+        self.view = view
+
+    def is_enabled(self):
+        return True
+
+
+class EventListener(object):
+    pass
+
+
+def create_modules():
+    sublime = types.ModuleType("sublime")
+    sublime.DIALOG_CANCEL = 0
+    sublime.DIALOG_YES = 1
+    sublime.DIALOG_NO = 2
+    sublime.version = lambda: _state["version"]
+    sublime.platform = lambda: {"win32": "windows", "darwin": "osx"}.get(sys.platform, "linux")
+    sublime.arch = lambda: "x64"
+    sublime.packages_path = packages_path
+    sublime.installed_packages_path = installed_packages_path
+    sublime.load_settings = load_settings
+    sublime.save_settings = save_settings
+    sublime.set_timeout = set_timeout
+    sublime.set_timeout_async = set_timeout
+    sublime.run_command = run_command
+    sublime.active_window = active_window
+    sublime.windows = lambda: [active_window()]
+    sublime.status_message = message
+    sublime.error_message = message
+    sublime.message_dialog = message
+    # Dialogs are confirmed, as when the user runs a command on purpose
+    sublime.ok_cancel_dialog = lambda text, ok_title="": True
+    sublime.yes_no_cancel_dialog = lambda text, yes_title="", no_title="": sublime.DIALOG_YES
+
+    sublime_plugin = types.ModuleType("sublime_plugin")
+    sublime_plugin.ApplicationCommand = ApplicationCommand
+    sublime_plugin.WindowCommand = WindowCommand
+    sublime_plugin.TextCommand = TextCommand
+    sublime_plugin.EventListener = EventListener
+
+    return sublime, sublime_plugin
+
+
+def install(packages_folder, version="3211"):
+    """Register the stand-in sublime & sublime_plugin modules.
+
+    packages_folder is the Packages folder to use, the User folder is
+    created inside it if needed. Calling it again switches to another
+    Packages folder & drops the loaded settings.
+    """
+    _state["packages_path"] = os.path.abspath(packages_folder)
+    _state["version"] = version
+    _state["settings"] = {}
+
+    user_folder = os.path.join(_state["packages_path"], "User")
+    if not os.path.isdir(user_folder):
+        os.makedirs(user_folder)
+
+    if _state["modules"] is None:
+        _state["modules"] = create_modules()
+
+    sys.modules["sublime"], sys.modules["sublime_plugin"] = _state["modules"]
+
+    return _state["modules"][0]
+
+
+def drain(timeout=None):
+    """Wait for the set_timeout callbacks that are due to run."""
+    return _state["main_thread"].drain(timeout)
@@ -0,0 +1,118 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o0004000
+
+#: Events that might change the contents, mtime or existence of a synced file
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+_event_header = struct.Struct("iIII")
+_libc = None
+
+
+def _load_libc():
+    global _libc
+
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        # Raises AttributeError if the C library does not provide inotify
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = libc
+
+    return _libc
+
+
+def is_supported():
+    if not sys.platform.startswith("linux"):
+        return False
+
+    try:
+        _load_libc()
+    except (OSError, AttributeError):
+        return False
+
+    return True
+
+
+class Inotify(object):
+
+    """Minimal ctypes binding of the Linux inotify API."""
+
+    def __init__(self):
+        self.libc = _load_libc()
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self.raise_error()
+
+    def raise_error(self, path=None):
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), path)
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            self.raise_error(path)
+        return wd
+
+    def rm_watch(self, wd):
+        # The watch is already gone if its folder has been deleted
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout=None):
+        """Return the pending events as (wd, mask, cookie, name) tuples.
+
+        Waits up to timeout seconds for the first event to arrive.
+        """
+        if self.fd is None:
+            return []
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+                offset += _event_header.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                events += [(wd, mask, cookie, os.fsdecode(name))]
+
+        return events
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
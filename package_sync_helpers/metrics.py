@@ -0,0 +1,184 @@
+import os
+import json
+import math
+import threading
+import time
+
+#: The metrics file is rotated once it grows beyond this size (in bytes)
+MAX_SIZE = 1024 * 1024
+
+#: Buffered events are written once this many are pending
+FLUSH_EVENTS = 200
+
+#: Buffered events are written at the latest this many seconds after the last write
+FLUSH_INTERVAL = 30
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    global _metrics
+
+    with _metrics_lock:
+        if _metrics is None:
+            # tools imports this module, so it is only imported here
+            try:
+                from . import tools
+            except ValueError:
+                from package_sync_helpers import tools
+
+            tools.get_state_path("PackageSync.metrics.jsonl.1")
+            _metrics = Metrics(tools.get_state_path("PackageSync.metrics.jsonl"))
+
+    return _metrics
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of the sorted list values."""
+    if not values:
+        return 0
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+
+
+class Span(object):
+
+    """Times a block of code & collects counters for it.
+
+    Use it as a context manager, as returned by `Metrics.span`. The event is
+    recorded when the block is left, also if it raised.
+    """
+
+    def __init__(self, metrics, name, counters):
+        self.metrics = metrics
+        self.name = name
+        self.counters = counters
+        self.start = None
+
+    def count(self, counter, value=1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.counters["error"] = exc_type.__name__
+        self.metrics.record(self.name, time.time() - self.start, **self.counters)
+        return False
+
+
+class Metrics(object):
+
+    """Durations & counters of sync, backup & restore operations.
+
+    Every event is one JSON line in PackageSync.metrics.jsonl, with its name,
+    end time, duration in seconds & numeric counters. Events are buffered &
+    appended in batches. Once the file grows beyond MAX_SIZE it is moved to
+    PackageSync.metrics.jsonl.1, so at most twice that size is kept.
+    """
+
+    def __init__(self, metrics_path):
+        self.metrics_path = metrics_path
+        self.previous_path = metrics_path + ".1"
+
+        self.lock = threading.Lock()
+        self.pending = []
+        self.flushed_at = time.time()
+
+    def span(self, name, **counters):
+        return Span(self, name, counters)
+
+    def record(self, name, duration, **counters):
+        event = dict(counters, name=name, time=round(time.time(), 3), duration=round(duration, 6))
+
+        with self.lock:
+            self.pending.append(event)
+            if len(self.pending) < FLUSH_EVENTS and time.time() - self.flushed_at < FLUSH_INTERVAL:
+                return
+
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            self.flushed_at = time.time()
+            if not pending:
+                return
+
+            data = "".join(json.dumps(event, sort_keys=True, separators=(",", ":")) + "\n" for event in pending)
+            try:
+                if os.path.isfile(self.metrics_path) and \
+                        os.path.getsize(self.metrics_path) + len(data) > MAX_SIZE:
+                    os.replace(self.metrics_path, self.previous_path)
+
+                with open(self.metrics_path, "a", encoding="utf8") as f:
+                    f.write(data)
+            except Exception as e:
+                # tools imports this module, so it is only imported here
+                try:
+                    from . import tools
+                except ValueError:
+                    from package_sync_helpers import tools
+                tools.log("PackageSync: Error while writing %s: %s" % (self.metrics_path, str(e)), force=True)
+
+    def close(self):
+        self.flush()
+
+    def load(self):
+        """Return all recorded events, oldest first."""
+        self.flush()
+
+        events = []
+        for path in (self.previous_path, self.metrics_path):
+            try:
+                with open(path, "r", encoding="utf8") as f:
+                    for line in f:
+                        try:
+                            events.append(json.loads(line))
+                        except ValueError:
+                            pass
+            except (IOError, OSError):
+                pass
+
+        return events
+
+    def summary(self):
+        """Return {name: {"count": n, value: (p50, p95, total)}} of all events.
+
+        Values are the duration & every numeric counter of the events.
+        """
+        values = {}
+        for event in self.load():
+            event_values = values.setdefault(event["name"], {})
+            for key, value in event.items():
+                if key not in ("name", "time") and isinstance(value, (int, float)) and not isinstance(value, bool):
+                    event_values.setdefault(key, []).append(value)
+
+        summary = {}
+        for name, event_values in values.items():
+            summary[name] = {"count": len(event_values.get("duration", []))}
+            for key, numbers in event_values.items():
+                numbers.sort()
+                summary[name][key] = (percentile(numbers, 0.5), percentile(numbers, 0.95), sum(numbers))
+
+        return summary
+
+    def report(self):
+        """Return the summary as text, one block per event name."""
+        lines = ["PackageSync Sync Stats", "",
+                 "%-24s %8s %12s %12s %12s" % ("", "count", "p50", "p95", "total")]
+
+        for name, values in sorted(self.summary().items()):
+            lines += ["", "%-24s %8d" % (name, values["count"])]
+            for key, numbers in sorted(values.items(), key=lambda item: item[0] != "duration"):
+                if key == "count":
+                    continue
+                p50, p95, total = numbers
+                if key == "duration":
+                    lines += ["  %-22s %8s %10.1fms %10.1fms %11.3fs" % ("duration", "", p50 * 1000, p95 * 1000, total)]
+                else:
+                    lines += ["  %-22s %8s %12g %12g %12g" % (key, "", p50, p95, total)]
+
+        return "\n".join(lines) + "\n"
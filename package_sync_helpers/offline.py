@@ -4,94 +4,642 @@ import os
 import fnmatch
 import shutil
 import json
+import sys
+import threading
+import time
+import zipfile
+import zlib
 
 try:
     from . import tools
+    from . import copier
+    from . import hashing
+    from . import metrics
+    from . import reconcile
+    from . import scanner
+    from . import state
 except ValueError:
     from package_sync_helpers import tools
+    from package_sync_helpers import copier
+    from package_sync_helpers import hashing
+    from package_sync_helpers import metrics
+    from package_sync_helpers import reconcile
+    from package_sync_helpers import scanner
+    from package_sync_helpers import state
 
 prompt_parameters = {}
 
+#: Name of the file listing the contents of a folder backup
+MANIFEST_NAME = "PackageSync.manifest"
+
+#: Files in a folder backup which are not part of the backed up settings
+MANIFEST_FILES = [MANIFEST_NAME + "*", "*.psync-tmp"]
+
+#: Zip restores with at least this many members are written through the copy engine's threads
+PARALLEL_RESTORE_MEMBERS = 64
+
+#: Compression methods which can be used for zip backups, by setting name
+COMPRESSION_METHODS = {
+    "stored": (zipfile.ZIP_STORED, None),
+    "deflate": (zipfile.ZIP_DEFLATED, "zlib"),
+    "bzip2": (zipfile.ZIP_BZIP2, "bz2"),
+    "lzma": (zipfile.ZIP_LZMA, "lzma"),
+}
+
+#: Compression used when zip_compression is not set
+DEFAULT_COMPRESSION = {
+    "method": "deflate",
+    "level": 6,
+    # Images & archives are compressed already
+    "overrides": {"*.png": "stored", "*.jpg": "stored", "*.gif": "stored", "*.zip": "stored",
+                  "*.sublime-package": "stored"}
+}
+
+
+class CompressionPolicy(object):
+
+    """Chooses the zip compression of each file by its name.
+
+    `overrides` maps file name patterns to a method name. Methods whose
+    compression module is missing from the Python build fall back to
+    "deflate", or to "stored" if zlib is missing as well. zipfile takes a
+    level per file from Python 3.7 on only, older versions (e.g. the one of
+    Sublime Text 3) always use the default level of each method.
+    """
+
+    def __init__(self, method="deflate", level=None, overrides={}):
+        if level is not None and sys.version_info < (3, 7):
+            tools.log("PackageSync: zip_compression level %s is ignored, it needs Python 3.7" % level)
+            level = None
+
+        self.level = level
+        self.method = self.resolve(method)
+        self.overrides = [(pattern, self.resolve(name)) for pattern, name in sorted(overrides.items())]
+
+    @classmethod
+    def from_settings(cls, psync_settings):
+        compression = dict(DEFAULT_COMPRESSION)
+        compression.update(psync_settings.get("zip_compression") or {})
+        return cls(compression.get("method", "deflate"), compression.get("level"),
+                   compression.get("overrides") or {})
+
+    @staticmethod
+    def resolve(name):
+        for candidate in (name, "deflate", "stored"):
+            compress_type, module = COMPRESSION_METHODS.get(candidate, (None, None))
+            if compress_type is None:
+                continue
+            if module is None:
+                return compress_type
+            try:
+                __import__(module)
+                return compress_type
+            except ImportError:
+                pass
+
+        return zipfile.ZIP_STORED
+
+    def get(self, relative_path):
+        """Return the compress_type to use for the file at relative_path."""
+        name = os.path.basename(relative_path)
+        for pattern, compress_type in self.overrides:
+            if fnmatch.fnmatch(name, pattern):
+                return compress_type
+
+        return self.method
+
+    def write(self, z, absolute_path, relative_path):
+        compress_type = self.get(relative_path)
+
+        if self.level is not None and compress_type != zipfile.ZIP_STORED:
+            z.write(absolute_path, relative_path, compress_type=compress_type, compresslevel=self.level)
+        else:
+            z.write(absolute_path, relative_path, compress_type=compress_type)
+
+
+def create_list_backup(backup_path):
+    """Write the installed packages list of Package Control to backup_path."""
+    package_control_settings = sublime.load_settings(
+        "Package Control.sublime-settings")
+    installed_packages = package_control_settings.get(
+        "installed_packages") or []
+
+    if os.path.isfile(backup_path):
+        os.remove(backup_path)
+    elif not os.path.exists(os.path.dirname(backup_path)):
+        os.makedirs(os.path.dirname(backup_path))
+
+    with metrics.get_metrics().span("backup.list", packages=len(installed_packages)):
+        with open(backup_path, "w") as _backupFile:
+            json.dump(
+                {"installed_packages": installed_packages}, _backupFile, indent=4)
+
+
+def restore_list_backup(backup_path):
+    """Replace the installed packages list of Package Control by the one at backup_path."""
+    with metrics.get_metrics().span("restore.list") as span:
+        with open(backup_path, "r") as f:
+            _installed_packages = json.load(f)["installed_packages"]
+        span.count("packages", len(_installed_packages))
+
+        plan = reconcile.save_installed_packages(_installed_packages)
+        span.count("installed", len(plan.install))
+        span.count("removed", len(plan.remove))
+
+
+def create_zip_backup(backup_path, compression_policy=None):
+    """Write the files matching the sync filters straight into a zip file.
 
-def create_temp_backup():
+    The archive is built next to backup_path & renamed into place once it is
+    complete, so no temp copy of the User folder is needed.
+    """
     psync_settings = tools.get_psync_settings()
+    path_filter = tools.get_path_filter(psync_settings)
+    if compression_policy is None:
+        compression_policy = CompressionPolicy.from_settings(psync_settings)
+
+    backup_dir = os.path.dirname(backup_path)
+    if not os.path.isdir(backup_dir):
+        os.makedirs(backup_dir)
+
+    temp_zip_file_path = backup_path + ".tmp"
+    with metrics.get_metrics().span("backup.zip") as span:
+        try:
+            z = zipfile.ZipFile(temp_zip_file_path, "w")
+            try:
+                for absolute_path, relative_path in path_filter.walk(tools.user_settings_folder):
+                    compression_policy.write(z, absolute_path, relative_path)
+            finally:
+                z.close()
+
+            os.replace(temp_zip_file_path, backup_path)
+        except:
+            if os.path.exists(temp_zip_file_path):
+                os.remove(temp_zip_file_path)
+            raise
+
+        span.count("files", len(z.infolist()))
+        span.count("bytes", sum(info.file_size for info in z.infolist()))
+        span.count("compressed_bytes", os.path.getsize(backup_path))
+
+
+def load_manifest(backup_path):
+    """Return {relative_path: [size, mtime, hash]} of a folder backup, or None."""
+    try:
+        with open(os.path.join(backup_path, MANIFEST_NAME), "r", encoding="utf8") as f:
+            return json.load(f)["files"]
+    except Exception:
+        return None
+
+
+def save_manifest(backup_path, files):
+    manifest_path = os.path.join(backup_path, MANIFEST_NAME)
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, "w", encoding="utf8") as f:
+        json.dump({"version": 1, "files": files}, f, sort_keys=True, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, manifest_path)
 
+
+def replace_file(source, target):
+    """Copy source over target through a temp file, so target is never half written."""
+    temp_path = target + ".psync-tmp"
     try:
-        if os.path.exists(tools.temp_backup_folder):
-            shutil.rmtree(tools.temp_backup_folder, True)
+        copier.clone_file(source, temp_path)
+        os.replace(temp_path, target)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def create_folder_backup(backup_path):
+    """Bring the folder backup at backup_path up to date with the User folder.
+
+    The manifest in the backup folder records the size, mtime & hash of
+    every file backed up. Files whose size & mtime still match on both
+    sides are left alone, changed files are copied over through a temp file
+    & renamed into place, & files no longer synced are removed. The manifest
+    is replaced last, so an interrupted backup is simply resumed by the next
+    run. Returns the relative paths of the files that could not be copied.
+    """
+    psync_settings = tools.get_psync_settings()
+    path_filter = tools.get_path_filter(psync_settings)
+    hash_cache = hashing.get_hash_cache()
+
+    if not os.path.isdir(backup_path):
+        os.makedirs(backup_path)
+
+    manifest = load_manifest(backup_path)
+    if manifest is None:
+        # Unknown contents, e.g. a backup created before manifests were used.
+        # Existing files are kept if their contents match.
+        manifest = {}
+        for absolute_path, relative_path, entry in tools.PathFilter(["*"], MANIFEST_FILES, []).scan(backup_path):
+            manifest[relative_path] = None
+
+    files = {}
+    jobs = []
+    changed = False
+    for absolute_path, relative_path, entry in path_filter.scan(tools.user_settings_folder):
+        source_stat = entry.stat()
+        target_path = os.path.join(backup_path, relative_path)
+        record = manifest.get(relative_path)
+
+        if record is not None and record[0] == source_stat.st_size and record[1] == source_stat.st_mtime:
+            try:
+                target_stat = os.stat(target_path)
+                if target_stat.st_size == record[0] and target_stat.st_mtime == record[1]:
+                    files[relative_path] = record
+                    continue
+            except OSError:
+                pass
+
+        changed = True
+        digest = hash_cache.get(absolute_path, source_stat)
+        files[relative_path] = [source_stat.st_size, source_stat.st_mtime, digest]
+
+        # Only touched, or restored from an identical copy
+        if relative_path in manifest and os.path.isfile(target_path) and \
+                hash_cache.get(target_path) == digest:
+            shutil.copystat(absolute_path, target_path)
+            continue
+
+        jobs += [(absolute_path, target_path, relative_path)]
+
+    failed = []
+    for job, result, error in copier.get_copy_engine(psync_settings).run(jobs, replace_file):
+        if error is not None:
+            failed += [job[2]]
+            # Keep whatever the backup held before
+            if job[2] in manifest:
+                files[job[2]] = manifest[job[2]]
+            else:
+                files.pop(job[2])
+
+    # Remove the files which are not synced anymore, & the folders left empty
+    removed_dirs = set()
+    for relative_path in manifest:
+        if relative_path not in files:
+            changed = True
+            try:
+                os.remove(os.path.join(backup_path, relative_path))
+            except OSError:
+                pass
+            removed_dirs.add(os.path.dirname(relative_path))
+
+    for relative_dir in sorted(removed_dirs, key=len, reverse=True):
+        while relative_dir:
+            try:
+                os.rmdir(os.path.join(backup_path, relative_dir))
+            except OSError:
+                break
+            relative_dir = os.path.dirname(relative_dir)
+
+    if changed or not os.path.exists(os.path.join(backup_path, MANIFEST_NAME)):
+        save_manifest(backup_path, files)
+
+    return failed
+
+
+def backup_to_folder(backup_path):
+    """Back up the User folder to backup_path, incrementally unless disabled.
+
+    Returns the relative paths of the files that could not be backed up.
+    """
+    psync_settings = tools.get_psync_settings()
 
-        shutil.copytree(tools.user_settings_folder, tools.temp_backup_folder)
+    with metrics.get_metrics().span("backup.folder") as span:
+        if psync_settings["incremental_folder_backup"]:
+            # Only copy what changed since the last backup
+            failed = create_folder_backup(backup_path)
 
-        for root, dirs, files in os.walk(tools.temp_backup_folder):
-            for dir in dirs:
-                if dir in psync_settings["ignore_dirs"]:
-                    shutil.rmtree(os.path.join(root, dir), True)
+        else:
+            if os.path.isdir(backup_path):
+                shutil.rmtree(backup_path, True)
 
-            for file in files:
-                absolute_path = os.path.join(root, file)
-                relative_path = os.path.relpath(
-                    absolute_path, tools.temp_backup_folder)
+            # Copy the matching files straight into the backup folder,
+            # through reflinks where the file system supports them
+            failed = copier.get_copy_engine(psync_settings).copy_tree(
+                tools.user_settings_folder, backup_path, tools.get_path_filter(psync_settings),
+                copier.clone_file)
 
-                include_matches = [
-                    fnmatch.fnmatch(relative_path, p) for p in psync_settings["include_files"]]
-                ignore_matches = [
-                    fnmatch.fnmatch(relative_path, p) for p in psync_settings["ignore_files"]]
+        span.count("failed_files", len(failed))
 
-                if any(ignore_matches) or not any(include_matches):
-                    os.remove(absolute_path)
+    return failed
 
-    except Exception as e:
-        tools.log("PackageSync: Error while creating temp backup.", force=True)
-        tools.log("PackageSync: Error message: %s" % str(e), force=True)
 
+def restore_from_folder(backup_path):
+    """Restore the User folder from the folder backup at backup_path, as per the preserve setting.
 
-def restore_from_temp():
+    Returns the relative paths of the files which could not be restored.
+    """
+    with metrics.get_metrics().span("restore.folder"):
+        if os.path.exists(tools.temp_restore_folder):
+            shutil.rmtree(tools.temp_restore_folder, True)
+
+        try:
+            failed = copier.get_copy_engine(tools.get_psync_settings()).copy_tree(
+                backup_path, tools.temp_restore_folder,
+                tools.PathFilter(["*"], MANIFEST_FILES, []))
+            if failed:
+                tools.log("PackageSync: Could not read %s, nothing has been restored" % ", ".join(failed), force=True)
+                return failed
+
+            return restore_from_temp()
+        finally:
+            shutil.rmtree(tools.temp_restore_folder, True)
+
+
+def forget_user_folder():
+    """Drop the sync state & scan index, as they describe the User folder before a restore."""
+    state.get_sync_state().reset()
+    scanner.get_scan_index().clear()
+
+
+def get_staging_folder():
+    """Return the folder in which a new User folder is built before it is swapped in.
+
+    It lives next to the Packages folder, so that it is on the same file
+    system as the User folder without being loaded as a package.
+    """
+    return os.path.join(os.path.dirname(os.path.dirname(tools.user_settings_folder)), "PackageSync.staging")
+
+
+def get_rollback_folder():
+    """Return the folder keeping the User folder as it was before the last restore."""
+    return os.path.join(os.path.dirname(os.path.dirname(tools.user_settings_folder)), "PackageSync.rollback")
+
+
+def create_staging_folder():
+    staging_folder = get_staging_folder()
+    if os.path.exists(staging_folder):
+        shutil.rmtree(staging_folder)
+    os.makedirs(staging_folder)
+
+    return staging_folder
+
+
+def swap_folders(new_folder, folder, old_folder):
+    """Move folder to old_folder & new_folder to folder, undoing the first move on failure."""
+    os.rename(folder, old_folder)
     try:
-        if tools.get_psync_settings()["preserve_packages"] == False:
-            # Delete all existing user settings & restore from temp backup
-            shutil.rmtree(tools.user_settings_folder, True)
-            shutil.copytree(
-                tools.temp_restore_folder, tools.user_settings_folder)
+        os.rename(new_folder, folder)
+    except:
+        os.rename(old_folder, folder)
+        raise
+
 
+def replace_user_folder(staging_folder, copy_engine):
+    """Swap the staged User folder in & keep the current one for rollback.
+
+    The User folder is replaced through two renames, so Sublime never sees
+    it empty or half restored. Where the folder can not be renamed, e.g.
+    because a file in it is locked, it is emptied & copied over instead.
+    The sync state & scan index are dropped, as they describe the old folder.
+    """
+    rollback_folder = get_rollback_folder()
+    if os.path.exists(rollback_folder):
+        shutil.rmtree(rollback_folder)
+
+    try:
+        if os.path.isdir(tools.user_settings_folder):
+            swap_folders(staging_folder, tools.user_settings_folder, rollback_folder)
         else:
-            for src_root, dirs, files in os.walk(tools.temp_restore_folder):
-                dst_root = src_root.replace(
-                    tools.temp_restore_folder, tools.user_settings_folder)
+            os.rename(staging_folder, tools.user_settings_folder)
+        forget_user_folder()
+        return []
+    except OSError as e:
+        tools.log("PackageSync: Could not swap in the restored User folder, copying it instead: %s" % str(e), force=True)
+
+    shutil.rmtree(tools.user_settings_folder, True)
+    failed = copy_engine.copy_tree(staging_folder, tools.user_settings_folder)
+    shutil.rmtree(staging_folder, True)
+    forget_user_folder()
 
-                if not os.path.exists(dst_root):
-                    os.mkdir(dst_root)
+    return failed
 
-                for file in files:
-                    src_file = os.path.join(src_root, file)
-                    dst_file = os.path.join(dst_root, file)
 
-                    if file == "Package Control.sublime-settings":
-                        new_installed_packages = []
+def undo_restore():
+    """Swap the User folder with the one kept by the last restore.
 
+    Running it again redoes the restore. Returns False if there is nothing to undo.
+    """
+    rollback_folder = get_rollback_folder()
+    if not os.path.isdir(rollback_folder):
+        return False
+
+    staging_folder = get_staging_folder()
+    if os.path.exists(staging_folder):
+        shutil.rmtree(staging_folder)
+
+    swap_folders(rollback_folder, tools.user_settings_folder, staging_folder)
+    os.rename(staging_folder, rollback_folder)
+    forget_user_folder()
+
+    return True
+
+
+def restore_from_temp():
+    """Restore the User folder from temp_restore_folder & remove it.
+
+    Returns the relative paths of the files which could not be restored, or
+    the User folder if the restore failed altogether.
+    """
+    psync_settings = tools.get_psync_settings()
+    copy_engine = copier.get_copy_engine(psync_settings)
+
+    with metrics.get_metrics().span("restore.temp") as span:
+        try:
+            if psync_settings["preserve_packages"] == False:
+                # Build the new User folder next to the current one & swap it in
+                staging_folder = create_staging_folder()
+                failed = copy_engine.copy_tree(
+                    tools.temp_restore_folder, staging_folder, function=copier.clone_file)
+
+                # Keep the current User folder rather than one missing files
+                if failed:
+                    tools.log("PackageSync: Restore aborted, the User folder has been kept as it was", force=True)
+                    shutil.rmtree(staging_folder, True)
+                else:
+                    failed = replace_user_folder(staging_folder, copy_engine)
+
+            else:
+                jobs = []
+                restored_packages = []
+                for src_file, relative_path in tools.PathFilter(["*"]).walk(tools.temp_restore_folder):
+                    if os.path.basename(relative_path) == "Package Control.sublime-settings":
                         with open(src_file, "r") as f:
-                            new_installed_packages = json.load(
-                                f)["installed_packages"]
-
-                        package_control_settings = sublime.load_settings(
-                            "Package Control.sublime-settings")
-                        current_installed_packages = package_control_settings.get(
-                            "installed_packages")
-                        for package_name in new_installed_packages:
-                            if package_name not in current_installed_packages:
-                                current_installed_packages.append(package_name)
-                        package_control_settings.set(
-                            "installed_packages", current_installed_packages)
-                        sublime.save_settings(
-                            "Package Control.sublime-settings")
+                            restored_packages += [json.load(f)["installed_packages"]]
 
                     else:
-                        if os.path.exists(dst_file):
-                            os.remove(dst_file)
-                        shutil.move(src_file, dst_root)
+                        jobs += [(src_file, os.path.join(tools.user_settings_folder, relative_path), relative_path)]
+
+                # Merge the packages of the backup into the installed ones at once
+                if restored_packages:
+                    reconcile.merge_installed_packages(*restored_packages)
+
+                # Copy the remaining files in parallel
+                failed = [job[2] for job, result, error in copy_engine.run(jobs) if error is not None]
+                forget_user_folder()
+
+            if failed:
+                tools.log("PackageSync: Could not restore %s" % ", ".join(failed), force=True)
+            span.count("failed_files", len(failed))
+
+        except Exception as e:
+            span.count("errors")
+            tools.log("PackageSync: Error while restoring from backup.", force=True)
+            tools.log("PackageSync: Error message: %s" % str(e), force=True)
+            failed = [tools.user_settings_folder]
+        finally:
+            shutil.rmtree(tools.temp_restore_folder, True)
+
+    return failed
+
+
+def file_crc32(path):
+    crc = 0
+    with open(path, "rb") as f:
+        chunk = f.read(1024 * 1024)
+        while chunk:
+            crc = zlib.crc32(chunk, crc)
+            chunk = f.read(1024 * 1024)
+
+    return crc & 0xffffffff
+
+
+def member_path(name):
+    """Return the relative path to restore a zip member to, or None if it points outside."""
+    relative_path = os.path.normpath(name.replace("/", os.sep))
+    if os.path.isabs(relative_path) or os.path.splitdrive(relative_path)[0] or \
+            relative_path == os.pardir or relative_path.startswith(os.pardir + os.sep):
+        return None
+
+    return relative_path
+
+
+def restore_from_zip(backup_path):
+    """Restore the User folder straight from the members of a zip backup.
+
+    A member is only written if the existing file differs in size or CRC,
+    so unchanged settings are neither rewritten nor reloaded. Changed files
+    are written to a temp file & renamed into place. Without preserving
+    packages, the whole User folder is staged & swapped in instead. Large archives are
+    restored through the threads of the copy engine, each reading from its
+    own handle on the zip file.
+
+    Returns the relative paths of the members which could not be restored.
+    """
+    start = time.time()
+    psync_settings = tools.get_psync_settings()
+    preserve_packages = psync_settings["preserve_packages"] != False
+
+    z = zipfile.ZipFile(backup_path, "r")
+    try:
+        members = [member for member in z.infolist() if not member.filename.endswith("/")]
+    finally:
+        z.close()
+
+    # Without preserving packages, the new User folder is built next to the
+    # current one & swapped in at the end
+    if preserve_packages:
+        target_folder = tools.user_settings_folder
+    else:
+        target_folder = create_staging_folder()
+
+    jobs = []
+    restored_packages = []
+    for member in members:
+        relative_path = member_path(member.filename)
+        if relative_path is None:
+            tools.log("PackageSync: Skipping %s, it points outside the User folder" % member.filename, force=True)
+            continue
+
+        if preserve_packages and os.path.basename(relative_path) == "Package Control.sublime-settings":
+            z = zipfile.ZipFile(backup_path, "r")
+            try:
+                restored_packages += [json.loads(z.read(member).decode("utf8"))["installed_packages"]]
+            finally:
+                z.close()
+            continue
+
+        jobs += [(member, os.path.join(target_folder, relative_path), relative_path)]
+
+    if restored_packages:
+        reconcile.merge_installed_packages(*restored_packages)
+
+    # Every thread reads through a zip file of its own
+    local = threading.local()
+    opened = []
+    opened_lock = threading.Lock()
+
+    def restore_member(member, target):
+        try:
+            target_stat = os.stat(target)
+            if target_stat.st_size == member.file_size and file_crc32(target) == member.CRC:
+                return False
+        except OSError:
+            pass
+
+        if getattr(local, "zip_file", None) is None:
+            local.zip_file = zipfile.ZipFile(backup_path, "r")
+            with opened_lock:
+                opened.append(local.zip_file)
+
+        temp_path = target + ".psync-tmp"
+        try:
+            with local.zip_file.open(member) as fsrc:
+                with open(temp_path, "wb") as fdst:
+                    shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+            os.replace(temp_path, target)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        return True
+
+    if len(jobs) >= PARALLEL_RESTORE_MEMBERS:
+        copy_engine = copier.get_copy_engine(psync_settings)
+    else:
+        copy_engine = copier.CopyEngine(1)
+
+    stats = {"written_files": 0, "written_bytes": 0, "skipped_files": 0, "skipped_bytes": 0}
+    failed = []
+    try:
+        for job, written, error in copy_engine.run(jobs, restore_member):
+            if error is not None:
+                failed += [job[2]]
+            elif written:
+                stats["written_files"] += 1
+                stats["written_bytes"] += job[0].file_size
+            else:
+                stats["skipped_files"] += 1
+                stats["skipped_bytes"] += job[0].file_size
+    finally:
+        for zip_file in opened:
+            zip_file.close()
+
+    if not preserve_packages:
+        # Keep the current User folder rather than one missing files
+        if failed:
+            tools.log("PackageSync: Restore aborted, the User folder has been kept as it was", force=True)
+            shutil.rmtree(target_folder, True)
+        else:
+            failed = replace_user_folder(target_folder, copy_engine)
+    else:
+        forget_user_folder()
+
+    if failed:
+        tools.log("PackageSync: Could not restore %s" % ", ".join(failed), force=True)
+
+    tools.log("PackageSync: Restored %d files (%d bytes), skipped %d unchanged files (%d bytes)" % (
+        stats["written_files"], stats["written_bytes"], stats["skipped_files"], stats["skipped_bytes"]), force=True)
+    metrics.get_metrics().record("restore.zip", time.time() - start, failed_files=len(failed), **stats)
 
-    except Exception as e:
-        tools.log("PackageSync: Error while restoring from backup.", force=True)
-        tools.log("PackageSync: Error message: %s" % str(e), force=True)
+    return failed
 
 
 def backup_with_prompt_on_done(path):
@@ -1,7 +1,7 @@
 import sublime
 import sublime_plugin
 
-import fnmatch
+import collections
 import os
 import shutil
 import sys
@@ -10,126 +10,378 @@ import time
 
 try:
     from . import tools
+    from . import scanner
+    from . import state
+    from . import hashing
+    from . import copier
+    from . import metrics
+    from . import reconcile
+    from . import removal
+    from . import cleanup
+    from . import delta
+    from . import packed
 except ValueError:
     from package_sync_helpers import tools
+    from package_sync_helpers import scanner
+    from package_sync_helpers import state
+    from package_sync_helpers import hashing
+    from package_sync_helpers import copier
+    from package_sync_helpers import metrics
+    from package_sync_helpers import reconcile
+    from package_sync_helpers import removal
+    from package_sync_helpers import cleanup
+    from package_sync_helpers import delta
+    from package_sync_helpers import packed
+
+
+#: Jobs which sync single items run before complete syncs
+PRIORITY_ITEMS = 0
+PRIORITY_SYNC = 1
+
+#: A batch growing beyond this many items is turned into a complete sync
+MAX_PENDING_ITEMS = 1000
 
 
 class Queue(object):
 
-    current = None
-    pool = []
+    """Runs sync jobs one after another on a single long-lived worker thread.
 
-    def __init__(self):
-        pass
+    Pending jobs are coalesced: complete syncs with the same key are merged,
+    & batches of items for the same mode are merged item by item, so only a
+    handful of jobs are ever pending. Batches of items are run before
+    complete syncs.
+    """
 
-    def start(self):
-        # Clear old thread
-        if self.current and self.current["thread"].is_alive():
-            sublime.set_timeout(lambda: self.start(), 500)
+    def __init__(self, max_pending_items=MAX_PENDING_ITEMS):
+        self.max_pending_items = max_pending_items
 
-        else:
-            # Reset current thread, since it ended
-            self.current = None
+        self.condition = threading.Condition()
+        self.pool = []
+        self.current = None
+        self.worker = None
+        self.stopped = False
+        self.sequence = 0
 
-            # Check for elements in pool
-            if self.pool:
-                self.current = self.pool.pop(0)
-                self.current["thread"].start()
+        self.stats = {"queued": 0, "coalesced": 0, "processed": 0,
+                      "max_depth": 0, "total_wait": 0.0, "max_wait": 0.0}
 
-                # Attemp a new start of the thread
-                sublime.set_timeout(lambda: self.start(), 500)
+    def start(self):
+        with self.condition:
+            if self.worker is None or not self.worker.is_alive():
+                self.stopped = False
+                self.worker = threading.Thread(target=self.work, name="PackageSync queue")
+                self.worker.daemon = True
+                self.worker.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.pool = []
+            self.condition.notify_all()
 
     def has(self, key):
-        pool = self.pool + [self.current] if self.current else []
-        return any([item for item in pool if item["key"] == key])
+        with self.condition:
+            jobs = self.pool + ([self.current] if self.current else [])
+            return any(job["key"] == key for job in jobs)
+
+    def depth(self):
+        with self.condition:
+            return len(self.pool)
+
+    def metrics(self):
+        with self.condition:
+            metrics = dict(self.stats, depth=len(self.pool))
+        metrics["average_wait"] = metrics["total_wait"] / metrics["processed"] if metrics["processed"] else 0.0
+        return metrics
+
+    def add(self, sync, key=None):
+        """Queue sync to be run, merging it into a pending job with the same key."""
+        if key is None:
+            key = "items_%s" % "_".join(sync.mode) if sync.items else "sync_%s" % "_".join(sync.mode)
+
+        with self.condition:
+            self.stats["queued"] += 1
+
+            # Merge with a pending job for the same key
+            for job in self.pool:
+                if job["key"] == key and self.coalesce(job, sync):
+                    self.stats["coalesced"] += 1
+                    return
+
+            self.sequence += 1
+            self.pool += [{"key": key, "sync": sync, "sequence": self.sequence, "queued_at": time.time(),
+                           "priority": PRIORITY_ITEMS if sync.items else PRIORITY_SYNC}]
+            self.stats["max_depth"] = max(self.stats["max_depth"], len(self.pool))
+            self.condition.notify_all()
 
-    def add(self, thread, key=None):
-        self.pool += [{"key": key if key else thread.name, "thread": thread}]
         self.start()
 
+    def coalesce(self, job, sync):
+        pending = job["sync"]
+
+        if not pending.items and not sync.items:
+            pending.mode = pending.mode + [mode for mode in sync.mode if mode not in pending.mode]
+            pending.override = pending.override or sync.override
+            return True
+
+        if pending.items and sync.items and pending.mode == sync.mode:
+            items = collections.OrderedDict((item["key"], item) for item in pending.items)
+            for item in sync.items:
+                merged = tools.merge_events(items.pop(item["key"], None), item)
+                if merged is not None:
+                    items[item["key"]] = merged
+            pending.items = list(items.values())
+
+            # Back-pressure: a complete sync is cheaper than a huge batch
+            if len(pending.items) > self.max_pending_items:
+                tools.log("PackageSync: %s items pending, running a complete sync instead" %
+                          len(pending.items))
+                pending.items = []
+                job["key"] = "sync_%s" % "_".join(pending.mode)
+                job["priority"] = PRIORITY_SYNC
+
+            return True
+
+        return False
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.pool and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+
+                job = min(self.pool, key=lambda job: (job["priority"], job["sequence"]))
+                self.pool.remove(job)
+                self.current = job
+
+                wait = time.time() - job["queued_at"]
+                self.stats["total_wait"] += wait
+                self.stats["max_wait"] = max(self.stats["max_wait"], wait)
+                self.condition.notify_all()
+
+            tools.log("PackageSync: Running %s after waiting %.3fs, %s jobs pending" %
+                      (job["key"], wait, len(self.pool)))
+            metrics.get_metrics().record("queue.wait", wait, pending=len(self.pool))
+            try:
+                job["sync"].run()
+            except Exception as e:
+                tools.log("PackageSync: Error while running %s" % job["key"], force=True)
+                tools.log("PackageSync: Error message: %s" % str(e), force=True)
+            finally:
+                with self.condition:
+                    self.current = None
+                    self.stats["processed"] += 1
+                    self.condition.notify_all()
+
 
-class Sync(threading.Thread):
+class Sync(object):
 
-    def __init__(self, mode=["pull", "push"], override=False, item=None):
+    def __init__(self, mode=["pull", "push"], override=False, item=None, items=None):
         psync_settings = tools.get_psync_settings()
 
         self.psync_settings = psync_settings
         self.mode = mode
-        self.item = item
+        self.items = items if items else ([item] if item else [])
         self.override = override
 
-        threading.Thread.__init__(self)
+        # Number of files which were not copied since their content matched
+        self.copies_avoided = 0
+
+        # Number & total size of the files copied
+        self.files_copied = 0
+        self.bytes_copied = 0
+
+        # PackedFolder of the online sync folder, if it uses the packed format
+        self.packed_folder = None
+
+        # The watchers also report files written in place, which scans do not see
+        for item in self.items:
+            if item.get("path"):
+                scanner.get_scan_index().invalidate(item["path"])
 
     def run(self):
+        with metrics.get_metrics().span("sync.run", items=len(self.items)) as span:
+            self.run_sync()
+
+            span.count("files_copied", self.files_copied)
+            span.count("bytes_copied", self.bytes_copied)
+            span.count("copies_avoided", self.copies_avoided)
+
+    def run_sync(self):
         sync_interval = self.psync_settings.get("online_sync_interval", 1)
 
         # Stop watcher and wait for the poll
         tools.pause_watcher(
             local="pull" in self.mode, remote="push" in self.mode)
 
-        # If no item pull and push all
-        if not self.item:
-            tools.log("PackageSync: Complete sync started.", force=True)
+        try:
+            # Packed online sync folders are read & written through their index
+            if self.psync_settings["online_sync_format"] == "packed":
+                self.packed_folder = self.open_packed_folder()
+
+            # If no item pull and push all
+            if not self.items:
+                tools.log("PackageSync: Complete sync started.", force=True)
+
+                # Fetch all items from the remote location
+                if "pull" in self.mode:
+                    with metrics.get_metrics().span("sync.pull_all"):
+                        self.pull_all()
+
+                # Push all items to the remote location
+                if "push" in self.mode:
+                    with metrics.get_metrics().span("sync.push_all"):
+                        self.push_all()
+
+                tools.log("PackageSync: Complete sync done.", force=True)
+                if self.copies_avoided:
+                    tools.log("PackageSync: %s copies avoided, contents were already up to date." %
+                              self.copies_avoided, force=True)
+            else:
+                # Pull the selected items
+                if "pull" in self.mode:
+                    with metrics.get_metrics().span("sync.pull_items", items=len(self.items)):
+                        self.pull_items(self.items)
+
+                # Push the selected items
+                if "push" in self.mode:
+                    with metrics.get_metrics().span("sync.push_items", items=len(self.items)):
+                        self.push_items(self.items)
+
+            # Persist the scan results & sync state for the next sync
+            with metrics.get_metrics().span("sync.save_state"):
+                scanner.get_scan_index().save()
+                state.get_sync_state().flush()
+        finally:
+            # Restart watcher again, even if the sync failed
+            tools.pause_watcher(
+                False, local="pull" in self.mode, remote="push" in self.mode)
 
-            # Fetch all items from the remote location
-            if "pull" in self.mode:
-                self.pull_all()
+    def find_files(self, path):
+        tools.log("PackageSync: find_files started for %s" % path)
 
-            # Push all items to the remote location
-            if "push" in self.mode:
-                self.push_all()
+        path_filter = tools.get_path_filter(self.psync_settings)
 
-            tools.log("PackageSync: Complete sync done.", force=True)
-        else:
-            # Pull the selected item
-            if "pull" in self.mode:
-                self.pull(self.item)
+        # Directories that did not change since the last scan are not listed
+        with metrics.get_metrics().span("sync.find_files") as span:
+            files = scanner.get_scan_index().scan(path, path_filter)
+            span.count("files", len(files))
 
-            # Push the selected item
-            if "push" in self.mode:
-                self.push(self.item)
+        return files
 
-        # Restart watcher again
-        tools.pause_watcher(
-            False, local="pull" in self.mode, remote="push" in self.mode)
+    def hash_files(self, resources):
+        """Add the content hash to every record returned by find_files."""
+        hash_cache = hashing.get_hash_cache()
+        for value in resources.values():
+            try:
+                # The scan already stat-ed the file
+                value["hash"] = hash_cache.get(value["path"], hashing.FileStat(value["version"], value["size"]))
+            except OSError:
+                pass
 
-    def find_files(self, path):
-        tools.log("PackageSync: find_files started for %s" % path)
+        return resources
+
+    def is_unchanged(self, source, target):
+        """Check whether copying source over target would change nothing."""
+        if hashing.get_hash_cache().same_content(source, target):
+            tools.log("PackageSync: Skipped %s, content is unchanged" % target)
+            return True
+
+        return False
+
+    def sync_file(self, source, target):
+        """Copy source to target unless their contents match.
+
+        Returns the content hash of target & whether it was copied.
+        """
+        if os.path.isfile(target) and self.is_unchanged(source, target):
+            return hashing.get_hash_cache().get(target), False
+
+        return self.copy(source, target), True
+
+    def copy(self, source, target):
+        """Copy source to target & return the content hash of target.
 
-        include_files = self.psync_settings["include_files"]
-        ignore_files = self.psync_settings["ignore_files"]
-        ignore_dirs = self.psync_settings["ignore_dirs"]
-
-        # tools.log("PackageSync: path %s" % path)
-        # tools.log("PackageSync: include_files %s" % include_files)
-        # tools.log("PackageSync: ignore_files %s" % ignore_files)
-        # tools.log("PackageSync: ignore_dirs %s" % ignore_dirs)
-
-        resources = {}
-        for root, dirs, files in os.walk(path):
-            [dirs.remove(dir)
-             for dir in dirs if dir in ignore_dirs]
-
-            for file in files:
-                absolute_path = os.path.join(root, file)
-                relative_path = os.path.relpath(absolute_path, path)
-
-                include_matches = [
-                    fnmatch.fnmatch(relative_path, p) for p in include_files]
-                ignore_matches = [
-                    fnmatch.fnmatch(relative_path, p) for p in ignore_files]
-                if any(ignore_matches) or not any(include_matches):
+        Large files already in place only get their changed blocks rewritten.
+        """
+        hash_cache = hashing.get_hash_cache()
+        digest = hash_cache.get(source)
+        delta.copy_file(source, target, self.psync_settings["delta_sync_threshold"])
+        hash_cache.set(target, digest)
+        scanner.get_scan_index().invalidate(target)
+
+        return digest
+
+    def pull_items(self, items):
+        # The remote watcher of a packed folder only reports index changes
+        if self.packed_folder is not None:
+            return self.pull_packed()
+
+        local_dir = os.path.join(sublime.packages_path(), "User")
+        self.sync_items(items, local_dir, self.pull, pull=True)
+
+    def push_items(self, items):
+        if self.packed_folder is not None:
+            return self.push_packed(items)
+
+        remote_dir = self.psync_settings.get("online_sync_folder")
+        self.sync_items(items, remote_dir, self.push, pull=False)
+
+    def sync_items(self, items, target_dir, sync_item, pull):
+        """Copy created & modified files in parallel, handle the rest one by one."""
+        sync_state = state.get_sync_state()
+        last_run_data = sync_state.get("last_run_data_local" if pull else "last_run_data_remote", {})
+
+        jobs = []
+        other_items = []
+        for item in items:
+            # Package Control settings need to be handled on their own
+            if item["type"] not in ("c", "m") or item["key"] == "Package Control.sublime-settings":
+                other_items += [item]
+            # Skip if the watcher detects a file that was just synced again
+            elif item["key"] in last_run_data and last_run_data[item["key"]]["version"] == item["version"]:
+                continue
+            else:
+                jobs += [(item["path"], os.path.join(target_dir, item["key"]), item)]
+
+        # Commit the results in order, as the copies complete
+        with metrics.get_metrics().span("sync.copy", files=len(jobs)):
+            for (source, target, item), result, error in copier.get_copy_engine(self.psync_settings).run(jobs, self.sync_file):
+                if error is not None:
+                    tools.log("PackageSync: Error while copying %s" % source, force=True)
+                    tools.log("PackageSync: Error message: %s" % str(error), force=True)
                     continue
 
-                resources[relative_path] = {"version": os.path.getmtime(
-                    absolute_path), "path": absolute_path, "dir": os.path.dirname(relative_path)}
+                record = {"dir": item["dir"], "version": item["version"],
+                          "size": os.path.getsize(target), "hash": result[0]}
+                self.count_copy(target, record["size"], result[1], item["type"])
 
-        return resources
+                if pull:
+                    sync_state.set_item(item["key"], dict(record, path=target), dict(record, path=source))
+                else:
+                    sync_state.set_item(item["key"], dict(record, path=source), dict(record, path=target))
+
+        for item in other_items:
+            with metrics.get_metrics().span("sync.pull" if pull else "sync.push"):
+                sync_item(item)
+
+    def count_copy(self, target, size, copied, item_type):
+        if copied:
+            tools.log("PackageSync: %s %s" % ("Created" if item_type == "c" else "Updated", target))
+            self.files_copied += 1
+            self.bytes_copied += size
+        else:
+            self.copies_avoided += 1
 
     def pull_all(self):
         tools.log("PackageSync: pull_all started with override = %s" %
               self.override)
 
+        if self.packed_folder is not None:
+            return self.pull_packed()
+
         local_dir = os.path.join(sublime.packages_path(), "User")
         remote_dir = self.psync_settings["online_sync_folder"]
 
@@ -137,9 +389,14 @@ class Sync(threading.Thread):
         remote_data = self.find_files(remote_dir)
 
         # Get data of last sync
-        last_run_data = tools.load_last_run_data()
-        last_run_data_local = last_run_data.get("last_run_data_local", {})
-        last_run_data_remote = last_run_data.get("last_run_data_remote", {})
+        sync_state = state.get_sync_state()
+        last_run_data_local = sync_state.get("last_run_data_local", {})
+        last_run_data_remote = sync_state.get("last_run_data_remote", {})
+
+        # Reuse the content hashes stored by the previous sync
+        hash_cache = hashing.get_hash_cache()
+        hash_cache.seed(last_run_data_local.values())
+        hash_cache.seed(last_run_data_remote.values())
 
         deleted_local_data = [
             key for key in last_run_data_local if key not in local_data]
@@ -159,15 +416,17 @@ class Sync(threading.Thread):
             elif key not in local_data:
                 diff += [dict({"type": "c", "key": key}, **value)]
             elif int(value["version"]) > int(local_data[key]["version"]) or self.override:
-                diff += [dict({"type": "m", "key": key}, **value)]
+                if self.is_unchanged(value["path"], local_data[key]["path"]):
+                    self.copies_avoided += 1
+                else:
+                    diff += [dict({"type": "m", "key": key}, **value)]
 
-        for item in diff:
-            self.pull(item)
+        self.pull_items(diff)
 
         # Set data for next last sync
-        tools.save_last_run_data(
-            last_run_data_local=self.find_files(local_dir),
-            last_run_data_remote=self.find_files(remote_dir))
+        sync_state.update(
+            last_run_data_local=self.hash_files(self.find_files(local_dir)),
+            last_run_data_remote=self.hash_files(self.find_files(remote_dir)))
 
     def pull(self, item):
         tools.log("PackageSync: pull started for %s" % item)
@@ -176,9 +435,9 @@ class Sync(threading.Thread):
         remote_dir = self.psync_settings.get("sync_folder")
 
         # Get data of last sync
-        last_run_data = tools.load_last_run_data()
-        last_run_data_local = last_run_data.get("last_run_data_local", {})
-        last_run_data_remote = last_run_data.get("last_run_data_remote", {})
+        sync_state = state.get_sync_state()
+        last_run_data_local = sync_state.get("last_run_data_local", {})
+        last_run_data_remote = sync_state.get("last_run_data_remote", {})
 
         # Make target file path and directory
         target = os.path.join(local_dir, item["key"])
@@ -200,9 +459,9 @@ class Sync(threading.Thread):
                 # Check for an updated Package Control setting file and backup
                 # old file
                 if item["key"] == "Package Control.sublime-settings":
-                    previous_installed_packages = tools.load_installed_packages(
+                    previous_installed_packages = tools.get_installed_packages_list(
                         target)
-                    installed_packages = tools.load_installed_packages(
+                    installed_packages = tools.get_installed_packages_list(
                         item["path"])
 
                 # Check if the watcher detects a file again
@@ -218,13 +477,11 @@ class Sync(threading.Thread):
             if not os.path.isdir(target_dir):
                 os.makedirs(target_dir)
 
-            shutil.copy2(item["path"], target)
-            tools.log("PackageSync: Created %s" % target)
-            #
-            last_run_data_local[item["key"]] = {
-                "path": target, "dir": item["dir"], "version": item["version"]}
-            last_run_data_remote[item["key"]] = {
-                "path": item["path"], "dir": item["dir"], "version": item["version"]}
+            digest, copied = self.sync_file(item["path"], target)
+            record = {"dir": item["dir"], "version": item["version"],
+                      "size": os.path.getsize(target), "hash": digest}
+            self.count_copy(target, record["size"], copied, item["type"])
+            sync_state.set_item(item["key"], dict(record, path=target), dict(record, path=item["path"]))
 
         # If a file was delated
         elif item["type"] == "d":
@@ -232,11 +489,7 @@ class Sync(threading.Thread):
                 os.remove(target)
                 tools.log("PackageSync: Deleted %s" % target)
 
-            try:
-                del last_run_data_local[item["key"]]
-                del last_run_data_remote[item["key"]]
-            except:
-                pass
+            sync_state.delete_item(item["key"])
 
             # Check if directory is empty and remove it if, just cosmetic issue
             if os.path.isdir(target_dir) and not os.listdir(target_dir):
@@ -247,58 +500,57 @@ class Sync(threading.Thread):
 
             if not os.path.isdir(target_dir):
                 os.mkdir(target_dir)
-            shutil.copy2(item["path"], target)
-            tools.log("PackageSync: Updated %s" % target)
-            #
-            last_run_data_local[item["key"]] = {
-                "path": target, "dir": item["dir"], "version": item["version"]}
-            last_run_data_remote[item["key"]] = {
-                "path": item["path"], "dir": item["dir"], "version": item["version"]}
-
-        # Set data for next last sync
-        tools.save_last_run_data(
-            last_run_data_local=last_run_data_local,
-            last_run_data_remote=last_run_data_remote)
+            digest, copied = self.sync_file(item["path"], target)
+            record = {"dir": item["dir"], "version": item["version"],
+                      "size": os.path.getsize(target), "hash": digest}
+            self.count_copy(target, record["size"], copied, item["type"])
+            sync_state.set_item(item["key"], dict(record, path=target), dict(record, path=item["path"]))
 
         if item["type"] != "d" and item["key"] == "Package Control.sublime-settings":
             # Handle Package Control
-            self.pull_package_control(
-                last_run_data, previous_installed_packages, installed_packages)
+            with metrics.get_metrics().span("sync.package_control"):
+                self.pull_package_control(
+                    previous_installed_packages, installed_packages)
 
-    def pull_package_control(self, last_run_data, previous_installed_packages, installed_packages):
-        # Save items to remove
-        to_install = [
-            item for item in installed_packages if item not in previous_installed_packages]
-        to_remove = [
-            item for item in previous_installed_packages if item not in installed_packages]
+    def pull_package_control(self, previous_installed_packages, installed_packages):
+        plan = reconcile.plan_packages(previous_installed_packages, installed_packages)
 
-        tools.log("PackageSync: install: %s", to_install)
-        tools.log("PackageSync: remove: %s", to_remove)
+        tools.log("PackageSync: install: %s" % plan.install)
+        tools.log("PackageSync: remove: %s" % plan.remove)
 
-        # Check for old remove_packages
-        packages_to_remove = last_run_data.get("packages_to_remove", [])
-        packages_to_remove += [item for item in to_remove if item !=
-                               "Package Control" and item not in packages_to_remove]
+        # Add to the packages a previous sync failed to remove
+        sync_state = state.get_sync_state()
+        packages_to_remove = reconcile.merge_packages(
+            sync_state.get("packages_to_remove", []),
+            [item for item in plan.remove if item not in reconcile.PROTECTED_PACKAGES])
 
-        tools.log("PackageSync: packages_to_remove %s", packages_to_remove)
+        tools.log("PackageSync: packages_to_remove %s" % packages_to_remove)
 
+        # Packages are removed in the background, the sync goes on meanwhile.
+        # They are kept in the state until they are gone, so that a removal
+        # interrupted by a restart is retried by the next sync.
         if packages_to_remove:
-            removed_packages = tools.remove_packages(packages_to_remove)
-        else:
-            removed_packages = []
+            sync_state.update(packages_to_remove=packages_to_remove)
+            removal.get_package_remover().remove(packages_to_remove, self.packages_removed)
 
         # Check if new packages are available and run package cleanup to
         # install missing packages
-        if to_install:
-            sublime.set_timeout(tools.install_new_packages(), 1000)
+        if plan.install:
+            cleanup.install_new_packages()
 
-        tools.save_last_run_data(
-            packages_to_remove=[item for item in packages_to_remove if item not in removed_packages])
+    def packages_removed(self, removed_packages):
+        removed_packages = set(removed_packages)
+        sync_state = state.get_sync_state()
+        sync_state.update(packages_to_remove=[
+            item for item in sync_state.get("packages_to_remove", []) if item not in removed_packages])
 
     def push_all(self):
         tools.log("PackageSync: push_all started with override = %s" %
               self.override)
 
+        if self.packed_folder is not None:
+            return self.push_all_packed()
+
         local_dir = os.path.join(sublime.packages_path(), "User")
         remote_dir = self.psync_settings.get("online_sync_folder")
 
@@ -306,9 +558,14 @@ class Sync(threading.Thread):
         remote_data = self.find_files(remote_dir)
 
         # Get data of last sync
-        last_run_data = tools.load_last_run_data()
-        last_run_data_local = last_run_data.get("last_run_data_local", {})
-        last_run_data_remote = last_run_data.get("last_run_data_remote", {})
+        sync_state = state.get_sync_state()
+        last_run_data_local = sync_state.get("last_run_data_local", {})
+        last_run_data_remote = sync_state.get("last_run_data_remote", {})
+
+        # Reuse the content hashes stored by the previous sync
+        hash_cache = hashing.get_hash_cache()
+        hash_cache.seed(last_run_data_local.values())
+        hash_cache.seed(last_run_data_remote.values())
 
         deleted_local_data = [
             key for key in last_run_data_local if key not in local_data]
@@ -328,15 +585,17 @@ class Sync(threading.Thread):
             elif key not in remote_data:
                 diff += [dict({"type": "c", "key": key}, **value)]
             elif int(value["version"]) > int(remote_data[key]["version"]) or self.override:
-                diff += [dict({"type": "m", "key": key}, **value)]
+                if self.is_unchanged(value["path"], remote_data[key]["path"]):
+                    self.copies_avoided += 1
+                else:
+                    diff += [dict({"type": "m", "key": key}, **value)]
 
-        for item in diff:
-            self.push(item)
+        self.push_items(diff)
 
         # Set data for next last sync
-        tools.save_last_run_data(
-            last_run_data_local=self.find_files(local_dir),
-            last_run_data_remote=self.find_files(remote_dir))
+        sync_state.update(
+            last_run_data_local=self.hash_files(self.find_files(local_dir)),
+            last_run_data_remote=self.hash_files(self.find_files(remote_dir)))
 
     def push(self, item):
         tools.log("PackageSync: push started for %s" % item)
@@ -345,9 +604,9 @@ class Sync(threading.Thread):
         remote_dir = self.psync_settings.get("online_sync_folder")
 
         # Get data of last sync
-        last_run_data = tools.load_last_run_data()
-        last_run_data_local = last_run_data.get("last_run_data_local", {})
-        last_run_data_remote = last_run_data.get("last_run_data_remote", {})
+        sync_state = state.get_sync_state()
+        last_run_data_local = sync_state.get("last_run_data_local", {})
+        last_run_data_remote = sync_state.get("last_run_data_remote", {})
 
         # Skip if file was just copied
         try:
@@ -367,24 +626,18 @@ class Sync(threading.Thread):
             if not os.path.isdir(target_dir):
                 os.makedirs(target_dir)
 
-            shutil.copy2(item["path"], target)
-            tools.log("PackageSync: Created %s" % target)
-            #
-            last_run_data_local[item["key"]] = {
-                "path": item["path"], "dir": item["dir"], "version": item["version"]}
-            last_run_data_remote[item["key"]] = {
-                "path": target, "dir": item["dir"], "version": item["version"]}
+            digest, copied = self.sync_file(item["path"], target)
+            record = {"dir": item["dir"], "version": item["version"],
+                      "size": os.path.getsize(target), "hash": digest}
+            self.count_copy(target, record["size"], copied, item["type"])
+            sync_state.set_item(item["key"], dict(record, path=item["path"]), dict(record, path=target))
 
         elif item["type"] == "d":
             if os.path.isfile(target):
                 os.remove(target)
                 tools.log("PackageSync: Deleted %s" % target)
 
-            try:
-                del last_run_data_local[item["key"]]
-                del last_run_data_remote[item["key"]]
-            except:
-                pass
+            sync_state.delete_item(item["key"])
 
             # Check if dir is empty and remove it if
             if os.path.isdir(target_dir) and not os.listdir(target_dir):
@@ -393,15 +646,253 @@ class Sync(threading.Thread):
         elif item["type"] == "m":
             if not os.path.isdir(target_dir):
                 os.mkdir(target_dir)
-            shutil.copy2(item["path"], target)
-            tools.log("PackageSync: Updated %s" % target)
-            #
-            last_run_data_local[item["key"]] = {
-                "path": item["path"], "dir": item["dir"], "version": item["version"]}
-            last_run_data_remote[item["key"]] = {
-                "path": target, "dir": item["dir"], "version": item["version"]}
+            digest, copied = self.sync_file(item["path"], target)
+            record = {"dir": item["dir"], "version": item["version"],
+                      "size": os.path.getsize(target), "hash": digest}
+            self.count_copy(target, record["size"], copied, item["type"])
+            sync_state.set_item(item["key"], dict(record, path=item["path"]), dict(record, path=target))
+
+    def get_pack_writer(self):
+        """Return the id under which this machine appends to packs of its own."""
+        sync_state = state.get_sync_state()
+        writer_id = sync_state.get("pack_writer")
+        if writer_id is None:
+            writer_id = packed.new_writer_id()
+            sync_state.update(pack_writer=writer_id)
+
+        return writer_id
+
+    def open_packed_folder(self):
+        """Return the PackedFolder of the online sync folder, packing its loose files first if needed."""
+        remote_dir = self.psync_settings["online_sync_folder"]
+
+        # The loose files are kept for the machines still syncing with them
+        if not packed.is_packed(remote_dir):
+            tools.log("PackageSync: Packing the online sync folder %s" % remote_dir, force=True)
+            with metrics.get_metrics().span("sync.pack_folder"):
+                return packed.pack_folder(
+                    remote_dir, tools.get_path_filter(self.psync_settings), self.get_pack_writer())
+
+        return packed.PackedFolder(remote_dir, self.get_pack_writer())
+
+    def find_packed_files(self):
+        """Read the index of the packed online sync folder into records like the ones of find_files.
+
+        The path of a record is where the file would be in a loose folder.
+        """
+        remote_dir = self.psync_settings["online_sync_folder"]
+
+        with metrics.get_metrics().span("sync.find_files") as span:
+            files = dict(
+                (key, {"version": record["version"], "size": record["size"], "hash": record["hash"],
+                       "dir": record["dir"], "path": os.path.join(remote_dir, key)})
+                for key, record in self.packed_folder.load().items())
+            span.count("files", len(files))
+
+        return files
+
+    def pull_packed(self):
+        local_dir = os.path.join(sublime.packages_path(), "User")
+
+        local_data = self.find_files(local_dir)
+        remote_data = self.find_packed_files()
+
+        # Get data of last sync
+        sync_state = state.get_sync_state()
+        last_run_data_local = sync_state.get("last_run_data_local", {})
+        last_run_data_remote = sync_state.get("last_run_data_remote", {})
+
+        hash_cache = hashing.get_hash_cache()
+        hash_cache.seed(last_run_data_local.values())
+
+        deleted_local_data = set(
+            key for key in last_run_data_local if key not in local_data)
+
+        # Files are only deleted for a tombstone newer than the local file, a
+        # file missing from the indexes may just not be downloaded yet
+        tombstones = self.packed_folder.tombstones()
+        diff = [{"type": "d", "key": key}
+                for key in last_run_data_remote if key in tombstones and (
+                    key not in local_data or tombstones[key]["version"] >= local_data[key]["version"])]
+
+        # The indexes hold the hash of every file, so unchanged files are
+        # recognized without reading the packs
+        for key, value in remote_data.items():
+            if key in deleted_local_data:
+                pass
+            elif key not in local_data:
+                diff += [dict({"type": "c", "key": key}, **value)]
+            elif int(value["version"]) > int(local_data[key]["version"]) or self.override:
+                if hash_cache.get(local_data[key]["path"]) == value["hash"]:
+                    self.copies_avoided += 1
+                else:
+                    diff += [dict({"type": "m", "key": key}, **value)]
+
+        self.extract_items(diff)
+
+        # Set data for next last sync
+        sync_state.update(
+            last_run_data_local=self.hash_files(self.find_files(local_dir)),
+            last_run_data_remote=remote_data)
+
+    def extract_items(self, items):
+        """Write the created & modified files of items from the packs, delete the rest."""
+        local_dir = os.path.join(sublime.packages_path(), "User")
+        records = self.packed_folder.files()
+
+        sync_state = state.get_sync_state()
+        with metrics.get_metrics().span("sync.extract", files=len(items)):
+            for item in items:
+                if item["type"] == "d":
+                    self.pull(item)
+                    continue
+
+                target = os.path.join(local_dir, item["key"])
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+
+                if item["key"] == "Package Control.sublime-settings":
+                    previous_installed_packages = tools.get_installed_packages_list(target)
+
+                try:
+                    self.packed_folder.extract(records[item["key"]], target)
+                except (IOError, OSError, KeyError) as e:
+                    tools.log("PackageSync: Error while extracting %s" % target, force=True)
+                    tools.log("PackageSync: Error message: %s" % str(e), force=True)
+                    continue
+
+                record = {"dir": item["dir"], "version": item["version"], "size": item["size"], "hash": item["hash"]}
+                hashing.get_hash_cache().set(target, item["hash"])
+                self.count_copy(target, record["size"], True, item["type"])
+                sync_state.set_item(item["key"], dict(record, path=target), dict(record, path=item["path"]))
+
+                if item["key"] == "Package Control.sublime-settings":
+                    with metrics.get_metrics().span("sync.package_control"):
+                        self.pull_package_control(
+                            previous_installed_packages, tools.get_installed_packages_list(target))
+
+    def push_all_packed(self):
+        local_dir = os.path.join(sublime.packages_path(), "User")
+
+        local_data = self.find_files(local_dir)
+        remote_data = self.find_packed_files()
+
+        # Get data of last sync
+        sync_state = state.get_sync_state()
+        last_run_data_local = sync_state.get("last_run_data_local", {})
+
+        hash_cache = hashing.get_hash_cache()
+        hash_cache.seed(last_run_data_local.values())
+
+        # Files older than their tombstone were deleted by another machine
+        tombstones = self.packed_folder.tombstones()
+        deleted_remote_data = set(
+            key for key in local_data
+            if key in tombstones and tombstones[key]["version"] >= local_data[key]["version"])
+
+        diff = [{"type": "d", "key": key}
+                for key in last_run_data_local if key not in local_data]
+        for key, value in local_data.items():
+            if key in deleted_remote_data:
+                pass
+            elif key not in remote_data:
+                diff += [dict({"type": "c", "key": key}, **value)]
+            elif int(value["version"]) > int(remote_data[key]["version"]) or self.override:
+                if hash_cache.get(value["path"]) == remote_data[key]["hash"]:
+                    self.copies_avoided += 1
+                else:
+                    diff += [dict({"type": "m", "key": key}, **value)]
+
+        self.push_packed(diff)
 
         # Set data for next last sync
-        tools.save_last_run_data(
-            last_run_data_local=last_run_data_local,
-            last_run_data_remote=last_run_data_remote)
+        sync_state.update(
+            last_run_data_local=self.hash_files(self.find_files(local_dir)),
+            last_run_data_remote=self.find_packed_files())
+
+    def push_packed(self, items):
+        """Append the created & modified files of items to the packs & save the index of this machine once."""
+        remote_dir = self.psync_settings["online_sync_folder"]
+
+        sync_state = state.get_sync_state()
+        last_run_data_remote = sync_state.get("last_run_data_remote", {})
+
+        # Work on the latest indexes, another machine may have pushed meanwhile
+        records = self.packed_folder.load()
+
+        pushed_items = []
+        deleted = []
+        for item in items:
+            if item["type"] == "d":
+                deleted += [item["key"]]
+            # Skip if the watcher detects a file that was just synced again
+            elif item["key"] in last_run_data_remote and \
+                    last_run_data_remote[item["key"]]["version"] == item["version"]:
+                continue
+            else:
+                pushed_items += [item]
+
+        if not pushed_items and not deleted:
+            return
+
+        # An overriding push must win the merge with the indexes of other machines
+        entries = []
+        for item in pushed_items:
+            version = item["version"]
+            if self.override and item["key"] in records:
+                version = max(version, records[item["key"]]["version"] + 1)
+            entries += [(item["key"], item["path"], {"version": version, "dir": item["dir"]})]
+
+        with metrics.get_metrics().span("sync.copy", files=len(entries)):
+            records = self.packed_folder.write(entries)
+
+        self.packed_folder.delete(deleted)
+        self.packed_folder.save()
+
+        for item, record in zip(pushed_items, records):
+            if record is None:
+                continue
+
+            target = os.path.join(remote_dir, item["key"])
+            record = {"dir": item["dir"], "version": item["version"], "size": record["size"], "hash": record["hash"]}
+            self.count_copy(target, record["size"], True, item["type"])
+            sync_state.set_item(item["key"], dict(record, path=item["path"]), dict(record, path=target))
+
+        for key in deleted:
+            tools.log("PackageSync: Deleted %s" % os.path.join(remote_dir, key))
+            sync_state.delete_item(key)
+
+        # Rewrite the packs once they mostly hold replaced contents
+        with metrics.get_metrics().span("sync.compact") as span:
+            span.count("freed_bytes", self.packed_folder.compact())
+
+
+class Migrate(Sync):
+
+    """Converts the online sync folder to the online_sync_format setting, then syncs with it.
+
+    Packing keeps the loose files unless remove_loose is set, as machines
+    which still use the "files" format would take their removal for
+    deletions. Their later changes to the loose files are only packed by
+    running it again.
+    """
+
+    def __init__(self, remove_loose=False):
+        Sync.__init__(self)
+        self.remove_loose = remove_loose
+
+    def run_sync(self):
+        remote_dir = self.psync_settings["online_sync_folder"]
+        path_filter = tools.get_path_filter(self.psync_settings)
+
+        tools.pause_watcher(local=False)
+        try:
+            with metrics.get_metrics().span("sync.migrate"):
+                if self.psync_settings["online_sync_format"] == "packed":
+                    packed.pack_folder(remote_dir, path_filter, self.get_pack_writer(), self.remove_loose)
+                elif packed.is_packed(remote_dir):
+                    packed.unpack_folder(remote_dir, path_filter)
+        finally:
+            tools.pause_watcher(False, local=False)
+
+        Sync.run_sync(self)
@@ -0,0 +1,452 @@
+import os
+import json
+import shutil
+import time
+import uuid
+
+try:
+    from . import tools
+    from . import hashing
+except ValueError:
+    from package_sync_helpers import tools
+    from package_sync_helpers import hashing
+
+#: Prefix of the indexes of a packed online sync folder, followed by the writer id
+INDEX_NAME = tools.PACKED_INDEX_NAME
+
+#: Folder holding the pack files, inside the online sync folder
+PACKS_NAME = "packs"
+
+#: A new pack is started once the current one grows beyond this size (in bytes)
+PACK_SIZE = 16 * 1024 * 1024
+
+#: Packs are rewritten once they hold more unused bytes than this & than used ones
+COMPACT_THRESHOLD = 1024 * 1024
+
+#: Size of the chunks in which files are copied into & out of packs
+CHUNK_SIZE = 1024 * 1024
+
+#: Tombstones are dropped this many seconds after the deletion, once no other index lists the file anymore
+TOMBSTONE_AGE = 30 * 24 * 60 * 60
+
+
+def index_writers(path):
+    """Return the writer ids of the indexes in a packed online sync folder."""
+    prefix = INDEX_NAME + "-"
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return []
+
+    return sorted(name[len(prefix):] for name in names if name.startswith(prefix) and not name.endswith(".tmp"))
+
+
+def is_packed(path):
+    return bool(index_writers(path))
+
+
+def new_writer_id():
+    return uuid.uuid4().hex[:12]
+
+
+class PackedFolder(object):
+
+    """Online sync folder holding the synced files in a few pack files & one index per machine.
+
+    Pack files in packs/ are only ever appended to, each by a single
+    machine. The index of a machine maps the relative path of every file it
+    pushed to the pack, offset & size of those contents, along with their
+    hash & version, and keeps a tombstone for every file it deleted. As
+    every machine only writes its own index, the indexes are merged on read
+    & the latest version of a file wins. An index is replaced atomically
+    once all data it refers to is written, so readers either see the
+    previous or the new state. Cloud clients then track a handful of files
+    instead of the whole User folder.
+    """
+
+    def __init__(self, path, writer_id):
+        self.path = path
+        self.index_path = os.path.join(path, "%s-%s" % (INDEX_NAME, writer_id))
+        self.packs_path = os.path.join(path, PACKS_NAME)
+        self.writer_id = writer_id
+        self.index = None
+
+        # Latest record of every file over all indexes, tombstones included
+        self.records = {}
+        self.record_writers = {}
+
+        # Relative paths listed in the index of every machine
+        self.index_files = {}
+
+    def load(self):
+        """Read & merge the indexes. Returns {relative path: record} of the files not deleted."""
+        self.index = {"version": 1, "files": {}, "packs": {}}
+        self.records = {}
+        self.record_writers = {}
+        self.index_files = {}
+
+        for writer_id in index_writers(self.path):
+            try:
+                with open(os.path.join(self.path, "%s-%s" % (INDEX_NAME, writer_id)), "r", encoding="utf8") as f:
+                    index = json.load(f)
+            except (IOError, OSError, ValueError) as e:
+                # An index the cloud client did not fully download yet is read again later
+                tools.log("PackageSync: Error while reading the index of %s: %s" % (writer_id, str(e)))
+                continue
+
+            if writer_id == self.writer_id:
+                self.index["files"] = index.get("files", {})
+                self.index["packs"] = index.get("packs", {})
+            self.index_files[writer_id] = set(index.get("files", {}))
+            self.merge(writer_id, index.get("files", {}))
+
+        return self.files()
+
+    def merge(self, writer_id, files):
+        for relative_path, record in files.items():
+            # Ties go to the greater writer id, so all machines pick the same record
+            latest = self.records.get(relative_path)
+            if latest is None or \
+                    (record["version"], writer_id) >= (latest["version"], self.record_writers[relative_path]):
+                self.records[relative_path] = record
+                self.record_writers[relative_path] = writer_id
+
+    def files(self):
+        """Return {relative path: record} of the files not deleted."""
+        if self.index is None:
+            self.load()
+        return dict((relative_path, record) for relative_path, record in self.records.items()
+                    if not record.get("deleted"))
+
+    def tombstones(self):
+        """Return {relative path: tombstone} of the deleted files."""
+        if self.index is None:
+            self.load()
+        return dict((relative_path, record) for relative_path, record in self.records.items()
+                    if record.get("deleted"))
+
+    def save(self):
+        """Write the index of this machine."""
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w", encoding="utf8") as f:
+            json.dump(self.index, f, sort_keys=True, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.index_path)
+
+    def pack_path(self, pack):
+        return os.path.join(self.packs_path, pack)
+
+    def is_own_pack(self, pack):
+        return pack.startswith(self.writer_id + "-")
+
+    def pack_number(self, pack):
+        return int(pack[len(self.writer_id) + 1:-len(".psync-pack")])
+
+    def new_pack(self):
+        """Return the name of a new pack of this machine."""
+        numbers = [self.pack_number(pack) for pack in self.index["packs"] if self.is_own_pack(pack)]
+        return "%s-%d.psync-pack" % (self.writer_id, max(numbers) + 1 if numbers else 1)
+
+    def current_pack(self):
+        """Return the name of the pack to append to, starting a new one if needed."""
+        own_packs = sorted((pack for pack in self.index["packs"] if self.is_own_pack(pack)), key=self.pack_number)
+        if own_packs and self.index["packs"][own_packs[-1]] < PACK_SIZE:
+            return own_packs[-1]
+
+        return self.new_pack()
+
+    def write(self, entries):
+        """Append files to the packs of this machine & return their new records.
+
+        entries are (relative path, absolute path, record) tuples. record
+        holds the version & dir of the file, the pack, offset, size & hash
+        are added. The record is None for files which could not be read.
+        The index is only changed in memory, see `save`.
+        """
+        return self.append([(relative_path, record, read_file(absolute_path))
+                            for relative_path, absolute_path, record in entries], skip_errors=True)
+
+    def append(self, sources, skip_errors=False, start_new=False):
+        """Append the chunks of sources to the packs of this machine & return their new records.
+
+        sources are (relative path, record, chunks) tuples. With skip_errors
+        the record of a source which can not be read is None, otherwise the
+        error is raised. start_new starts a new pack instead of appending to
+        the current one.
+        """
+        if self.index is None:
+            self.load()
+        if not sources:
+            return []
+
+        if not os.path.isdir(self.packs_path):
+            os.makedirs(self.packs_path)
+
+        records = []
+        pack = None
+        f = None
+        try:
+            for relative_path, record, chunks in sources:
+                # Start the next pack once the current one is full
+                if f is None or f.tell() >= PACK_SIZE:
+                    if f is not None:
+                        self.close_pack(pack, f)
+                    pack = self.new_pack() if start_new and f is None else self.current_pack()
+                    f = open(self.pack_path(pack), "ab")
+                    f.seek(0, os.SEEK_END)
+
+                offset = f.tell()
+                digest = hashing.new_hash()
+                try:
+                    for chunk in chunks:
+                        digest.update(chunk)
+                        f.write(chunk)
+                except (IOError, OSError) as e:
+                    if not skip_errors:
+                        raise
+
+                    # Anything written is left unused in the pack, for `compact`
+                    tools.log("PackageSync: Error while packing %s" % relative_path, force=True)
+                    tools.log("PackageSync: Error message: %s" % str(e), force=True)
+                    records += [None]
+                    continue
+
+                record = dict(record, pack=pack, offset=offset, size=f.tell() - offset, hash=digest.hexdigest())
+                self.index["files"][relative_path] = record
+                self.merge(self.writer_id, {relative_path: record})
+                records += [record]
+        finally:
+            if f is not None:
+                self.close_pack(pack, f)
+
+        return records
+
+    def close_pack(self, pack, f):
+        # The data must be on disk before the index refers to it
+        f.flush()
+        os.fsync(f.fileno())
+        self.index["packs"][pack] = f.tell()
+        f.close()
+
+    def delete(self, relative_paths):
+        """Record tombstones for relative_paths in the index of this machine.
+
+        The tombstone is newer than the record it replaces, so the deletion
+        wins the merge with the indexes of other machines.
+        """
+        if self.index is None:
+            self.load()
+        for relative_path in relative_paths:
+            version = time.time()
+            if relative_path in self.records:
+                version = max(version, self.records[relative_path]["version"] + 1)
+
+            tombstone = {"deleted": True, "version": version}
+            self.index["files"][relative_path] = tombstone
+            self.merge(self.writer_id, {relative_path: tombstone})
+
+    def read_record(self, record):
+        """Yield the contents of a record in chunks.
+
+        The data is checked against the size & hash of the record, so a pack
+        which the cloud client did not fully download yet raises an IOError.
+        """
+        digest = hashing.new_hash()
+        remaining = record["size"]
+        with open(self.pack_path(record["pack"]), "rb") as f:
+            f.seek(record["offset"])
+            while remaining:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                remaining -= len(chunk)
+                yield chunk
+
+        if remaining or digest.hexdigest() != record["hash"]:
+            raise IOError("The pack %s is incomplete, it may still be syncing" % record["pack"])
+
+    def extract(self, record, target):
+        """Write the contents of a record to target, through a temp file."""
+        temp_path = target + ".psync-tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                for chunk in self.read_record(record):
+                    f.write(chunk)
+
+            os.utime(temp_path, (record["version"], record["version"]))
+            os.replace(temp_path, target)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def prune(self):
+        """Drop the entries of the index of this machine which are not needed anymore.
+
+        Entries replaced by a newer one of another machine are dropped, and
+        so are tombstones older than TOMBSTONE_AGE once no other index lists
+        the file, as an older record would otherwise win again. Returns the
+        number of entries dropped.
+        """
+        other_files = set()
+        for writer_id, files in self.index_files.items():
+            if writer_id != self.writer_id:
+                other_files.update(files)
+
+        expired = time.time() - TOMBSTONE_AGE
+        pruned = [relative_path for relative_path, record in self.index["files"].items()
+                  if self.record_writers.get(relative_path) != self.writer_id or (
+                      record.get("deleted") and record["version"] < expired and relative_path not in other_files)]
+
+        for relative_path in pruned:
+            del self.index["files"][relative_path]
+            if self.record_writers.get(relative_path) == self.writer_id:
+                del self.records[relative_path]
+                del self.record_writers[relative_path]
+
+        return len(pruned)
+
+    def compact(self):
+        """Prune the index of this machine & rewrite its packs into new ones once they are mostly unused.
+
+        Packs of other machines are never touched, as their machines may
+        still append to them. The contents are copied as they are & checked
+        against their records; the packs are left alone if one does not
+        match. Returns the number of bytes freed.
+        """
+        if self.index is None:
+            self.load()
+
+        if self.prune():
+            self.save()
+
+        own_packs = [pack for pack in self.index["packs"] if self.is_own_pack(pack)]
+        own_files = sorted((relative_path, record) for relative_path, record in self.index["files"].items()
+                           if record.get("pack") in own_packs)
+
+        total = sum(self.index["packs"][pack] for pack in own_packs)
+        unused = total - sum(record["size"] for relative_path, record in own_files)
+        if unused < COMPACT_THRESHOLD or unused < total - unused:
+            return 0
+
+        files = dict(self.index["files"])
+        packs = dict(self.index["packs"])
+        records = dict(self.records)
+        try:
+            self.append([(relative_path, record, self.read_record(record)) for relative_path, record in own_files],
+                        start_new=True)
+        except (IOError, OSError) as e:
+            # Drop the new packs, the index keeps referring to the old ones
+            for pack in self.index["packs"]:
+                if pack not in packs and os.path.exists(self.pack_path(pack)):
+                    os.remove(self.pack_path(pack))
+            self.index["files"] = files
+            self.index["packs"] = packs
+            self.records = records
+            tools.log("PackageSync: Packed online sync folder not compacted: %s" % str(e), force=True)
+            return 0
+
+        for pack in own_packs:
+            del self.index["packs"][pack]
+        self.save()
+
+        for pack in own_packs:
+            try:
+                os.remove(self.pack_path(pack))
+            except OSError:
+                pass
+
+        tools.log("PackageSync: Packed online sync folder compacted, %d bytes freed" % unused)
+        return unused
+
+
+def read_file(path):
+    """Yield the contents of the file at path in chunks."""
+    with open(path, "rb") as f:
+        chunk = f.read(CHUNK_SIZE)
+        while chunk:
+            yield chunk
+            chunk = f.read(CHUNK_SIZE)
+
+
+def pack_folder(path, path_filter, writer_id, remove_loose=False):
+    """Move the loose files of an online sync folder into packs.
+
+    Loose files missing from the indexes or newer than their record are
+    packed, so running it again picks up the changes of machines still
+    syncing with the loose files. Syncs only read the indexes, so they do
+    not pick these changes up themselves. Loose files older than their
+    tombstone stay deleted. They are only removed with remove_loose, once
+    no machine uses them anymore.
+    Returns the PackedFolder.
+    """
+    packed_folder = PackedFolder(path, writer_id)
+    packed_folder.load()
+
+    entries = []
+    loose_files = []
+    for absolute_path, relative_path, entry in path_filter.scan(path):
+        record = packed_folder.records.get(relative_path)
+        file_stat = entry.stat()
+        if record is None or file_stat.st_mtime > record["version"]:
+            entries += [(relative_path, absolute_path,
+                         {"version": file_stat.st_mtime, "dir": os.path.dirname(relative_path)})]
+        else:
+            loose_files += [relative_path]
+
+    records = packed_folder.write(entries)
+    packed_folder.save()
+    tools.log("PackageSync: %d files packed in %s" % (len(entries), path), force=True)
+
+    if remove_loose:
+        loose_files += [entry[0] for entry, record in zip(entries, records) if record is not None]
+        for relative_path in loose_files:
+            os.remove(os.path.join(path, relative_path))
+
+            # Remove the folders left empty, but not the online sync folder
+            relative_dir = os.path.dirname(relative_path)
+            while relative_dir:
+                try:
+                    os.rmdir(os.path.join(path, relative_dir))
+                except OSError:
+                    break
+                relative_dir = os.path.dirname(relative_dir)
+
+    return packed_folder
+
+
+def unpack_folder(path, path_filter):
+    """Write the files of a packed online sync folder back as loose files & remove the packs.
+
+    Loose files left from before packing which have a newer tombstone were
+    deleted meanwhile, so they are removed as well.
+    """
+    packed_folder = PackedFolder(path, None)
+    files = packed_folder.load()
+
+    unchanged_files = set()
+    for absolute_path, relative_path, entry in path_filter.scan(path):
+        record = packed_folder.records.get(relative_path)
+        if record is None:
+            continue
+        elif record.get("deleted"):
+            if entry.stat().st_mtime <= record["version"]:
+                os.remove(absolute_path)
+        elif entry.stat().st_mtime == record["version"] and entry.stat().st_size == record["size"]:
+            unchanged_files.add(relative_path)
+
+    for relative_path, record in sorted(files.items()):
+        if relative_path in unchanged_files:
+            continue
+
+        target = os.path.join(path, relative_path)
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        packed_folder.extract(record, target)
+
+    for writer_id in index_writers(path):
+        os.remove(os.path.join(path, "%s-%s" % (INDEX_NAME, writer_id)))
+    shutil.rmtree(packed_folder.packs_path, True)
+    tools.log("PackageSync: %d files unpacked in %s" % (len(files), path), force=True)
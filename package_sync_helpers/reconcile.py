@@ -0,0 +1,72 @@
+import sublime
+
+import collections
+
+#: Packages which are never removed as part of a sync
+PROTECTED_PACKAGES = ("Package Control",)
+
+#: Packages to install & remove to get from one installed_packages list to another
+PackagePlan = collections.namedtuple("PackagePlan", ["install", "remove", "keep"])
+
+
+def unique(packages):
+    """Return packages without duplicates, in the order they first appear."""
+    seen = set()
+    return [package for package in packages if not (package in seen or seen.add(package))]
+
+
+def plan_packages(current_packages, target_packages):
+    """Compare two installed_packages lists.
+
+    install holds the packages of target_packages missing in current_packages
+    & keep the ones in both, in the order of target_packages. remove holds
+    the packages of current_packages missing in target_packages, in their
+    order. Every membership test is done against a set.
+    """
+    current = set(current_packages)
+    target = set(target_packages)
+
+    return PackagePlan(
+        install=[package for package in unique(target_packages) if package not in current],
+        remove=[package for package in unique(current_packages) if package not in target],
+        keep=[package for package in unique(target_packages) if package in current])
+
+
+def merge_packages(current_packages, *new_packages):
+    """Return current_packages followed by the packages of new_packages it misses."""
+    merged = unique(current_packages)
+    known = set(merged)
+    for packages in new_packages:
+        for package in packages:
+            if package not in known:
+                known.add(package)
+                merged.append(package)
+
+    return merged
+
+
+def load_installed_packages():
+    package_control_settings = sublime.load_settings("Package Control.sublime-settings")
+    return list(package_control_settings.get("installed_packages") or [])
+
+
+def save_installed_packages(installed_packages):
+    """Set the installed_packages of Package Control. Returns the plan applied.
+
+    The settings are only written, once, if the list actually changed.
+    """
+    package_control_settings = sublime.load_settings("Package Control.sublime-settings")
+    current_packages = list(package_control_settings.get("installed_packages") or [])
+    installed_packages = unique(installed_packages)
+
+    plan = plan_packages(current_packages, installed_packages)
+    if installed_packages != current_packages:
+        package_control_settings.set("installed_packages", installed_packages)
+        sublime.save_settings("Package Control.sublime-settings")
+
+    return plan
+
+
+def merge_installed_packages(*new_packages):
+    """Add the packages of one or more installed_packages lists to the ones of Package Control."""
+    return save_installed_packages(merge_packages(load_installed_packages(), *new_packages))
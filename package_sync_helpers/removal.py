@@ -0,0 +1,230 @@
+import sublime
+
+import os
+import shutil
+import threading
+import concurrent.futures
+
+try:
+    from . import tools
+    from . import metrics
+    from . import reconcile
+except ValueError:
+    from package_sync_helpers import tools
+    from package_sync_helpers import metrics
+    from package_sync_helpers import reconcile
+
+#: Milliseconds Sublime Text is given to unload the packages once they are ignored
+UNLOAD_DELAY = 1000
+
+#: Seconds to wait for the main thread to update ignored_packages
+MAIN_THREAD_TIMEOUT = 30
+
+#: Number of packages deleted at the same time
+REMOVE_WORKERS = 4
+
+_package_remover = None
+_package_remover_lock = threading.Lock()
+
+
+def get_package_remover():
+    global _package_remover
+
+    with _package_remover_lock:
+        if _package_remover is None:
+            _package_remover = PackageRemover()
+
+    return _package_remover
+
+
+def remove_package(package):
+    """Delete the files of package. Returns whether all of them are gone."""
+    package_files = [
+        os.path.join(sublime.installed_packages_path(), package + ".sublime-package"),
+        os.path.join(os.path.dirname(sublime.packages_path()), "Pristine Packages", package + ".sublime-package"),
+    ]
+    for package_file in package_files:
+        try:
+            if os.path.exists(package_file):
+                os.remove(package_file)
+        except OSError:
+            return False
+
+    package_dir = os.path.join(sublime.packages_path(), package)
+    if os.path.isdir(package_dir):
+        shutil.rmtree(package_dir, True)
+        if os.path.exists(package_dir):
+            # Some files are still in use, let Package Control remove the
+            # rest on the next start
+            try:
+                open(os.path.join(package_dir, "package-control.cleanup"), "w").close()
+            except (IOError, OSError):
+                pass
+            return False
+
+    return True
+
+
+def ignore_packages(packages):
+    """Add packages to ignored_packages. Returns the packages which were not ignored yet."""
+    settings = sublime.load_settings("Preferences.sublime-settings")
+    ignored_packages = settings.get("ignored_packages") or []
+
+    added = reconcile.plan_packages(ignored_packages, packages).install
+    if added:
+        settings.set("ignored_packages", ignored_packages + added)
+        sublime.save_settings("Preferences.sublime-settings")
+
+    return added
+
+
+def unignore_packages(packages):
+    """Remove packages from ignored_packages again."""
+    settings = sublime.load_settings("Preferences.sublime-settings")
+    ignored_packages = settings.get("ignored_packages") or []
+
+    packages = set(packages)
+    remaining = [package for package in ignored_packages if package not in packages]
+    if len(remaining) != len(ignored_packages):
+        settings.set("ignored_packages", remaining)
+        sublime.save_settings("Preferences.sublime-settings")
+
+
+class PackageRemover(object):
+
+    """Removes packages on a thread of its own.
+
+    `remove` only queues the packages, so the sync calling it goes on with
+    its files while the packages are ignored, deleted in parallel & finally
+    unignored. Requests made while a removal is running are handled together
+    in the next one. The ignored_packages setting is only changed on the main
+    thread, which signals the remover thread through events once done.
+    """
+
+    def __init__(self, max_workers=REMOVE_WORKERS):
+        self.max_workers = max(1, int(max_workers))
+
+        self.condition = threading.Condition()
+        self.pending = []
+        self.running = False
+        self.stopped = False
+        self.thread = None
+
+    def remove(self, packages, on_done=None):
+        """Queue packages for removal.
+
+        on_done is called on the remover thread with the packages which
+        were removed completely.
+        """
+        with self.condition:
+            self.pending.append((list(packages), on_done))
+            self.stopped = False
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.work, name="PackageSync package remover")
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify_all()
+
+    def wait(self, timeout=None):
+        """Wait until all queued removals are done. Returns False on timeout."""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.running, timeout)
+
+    def stop(self):
+        """Drop the queued removals. A running one is finished."""
+        with self.condition:
+            self.pending = []
+            self.stopped = True
+            self.condition.notify_all()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    self.thread = None
+                    return
+                requests, self.pending = self.pending, []
+                self.running = True
+
+            try:
+                removed_packages = set(self.remove_packages(
+                    reconcile.merge_packages([], *[packages for packages, on_done in requests])))
+            except Exception as e:
+                tools.log("PackageSync: Error while removing packages", force=True)
+                tools.log("PackageSync: Error message: %s" % str(e), force=True)
+                removed_packages = set()
+
+            for packages, on_done in requests:
+                if on_done is None:
+                    continue
+                try:
+                    on_done([package for package in packages if package in removed_packages])
+                except Exception as e:
+                    tools.log("PackageSync: Error after removing packages: %s" % str(e), force=True)
+
+            with self.condition:
+                self.running = False
+                self.condition.notify_all()
+
+    def remove_packages(self, packages):
+        """Ignore, delete & unignore packages. Returns the packages removed completely."""
+        if not packages:
+            return []
+
+        tools.log("PackageSync: remove packages %s" % packages)
+
+        with metrics.get_metrics().span("packages.remove", packages=len(packages)) as span:
+            # Let Sublime Text unload the packages before their files are deleted
+            ignored = self.on_main_thread(lambda: ignore_packages(packages)) or []
+            self.on_main_thread(lambda: None, UNLOAD_DELAY)
+
+            executor = concurrent.futures.ThreadPoolExecutor(min(self.max_workers, len(packages)))
+            try:
+                results = list(executor.map(remove_package, packages))
+            finally:
+                executor.shutdown()
+
+            self.on_main_thread(lambda: unignore_packages(ignored))
+
+            removed_packages = [package for package, removed in zip(packages, results) if removed]
+            span.count("removed", len(removed_packages))
+
+        return removed_packages
+
+    def on_main_thread(self, callback, delay=0):
+        """Run callback on the main thread & return its result once it is done.
+
+        A callback which did not start before the timeout is cancelled, so
+        that e.g. packages are not ignored once nothing unignores them anymore.
+        """
+        done = threading.Event()
+        lock = threading.Lock()
+        status = {"started": False, "cancelled": False}
+        result = []
+
+        def run():
+            with lock:
+                if status["cancelled"]:
+                    return
+                status["started"] = True
+
+            try:
+                result.append(callback())
+            finally:
+                done.set()
+
+        sublime.set_timeout(run, delay)
+        if not done.wait(MAIN_THREAD_TIMEOUT + delay / 1000.0):
+            with lock:
+                status["cancelled"] = not status["started"]
+
+            if status["cancelled"]:
+                tools.log("PackageSync: Timed out waiting for the main thread", force=True)
+                return None
+
+            # The callback is running already, let it finish
+            done.wait()
+
+        return result[0] if result else None
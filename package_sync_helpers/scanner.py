@@ -0,0 +1,195 @@
+import os
+import json
+import threading
+import time
+
+try:
+    from . import tools
+except ValueError:
+    from package_sync_helpers import tools
+
+#: Version of the on-disk layout of PackageSync.scan-index
+INDEX_VERSION = 1
+
+#: Directories modified within this many seconds of being listed are listed
+#: again on the next scan, since a change in the same mtime tick would go unseen
+RACY_INTERVAL = 2
+
+_scan_index = None
+_scan_index_lock = threading.Lock()
+
+
+def get_scan_index():
+    global _scan_index
+
+    with _scan_index_lock:
+        if _scan_index is None:
+            _scan_index = ScanIndex(tools.get_state_path("PackageSync.scan-index"))
+
+    return _scan_index
+
+
+class ScanIndex(object):
+
+    """Persistent index of the folders scanned by `Sync.find_files`.
+
+    For every scanned root the index keeps the mtime and the filtered listing
+    of each directory, plus the mtime, size & inode of each file. A directory
+    whose mtime did not change is not listed or matched against the filters
+    again, and its files are not stat-ed either.
+
+    Writing a file in place does not update the mtime of its directory, so
+    the files of a root are all stat-ed on its first scan by this process,
+    to catch changes made while Sublime was closed. Afterwards the watchers
+    & syncs report the files they see changed through `invalidate`.
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.roots = None
+        self.dirty = False
+        self.lock = threading.RLock()
+
+        # Roots scanned by this process & directories whose files must be stat-ed again
+        self.verified_roots = set()
+        self.stale_dirs = set()
+
+    def load(self):
+        try:
+            with open(self.index_path, "r", encoding="utf8") as f:
+                data = json.load(f)
+            if data.get("version") != INDEX_VERSION:
+                raise ValueError("Unsupported scan index version")
+            self.roots = data.get("roots", {})
+        except Exception:
+            self.roots = {}
+
+        self.dirty = False
+
+    def save(self):
+        with self.lock:
+            if not self.dirty or self.roots is None:
+                return
+
+            temp_path = self.index_path + ".tmp"
+            try:
+                with open(temp_path, "w", encoding="utf8") as f:
+                    json.dump({"version": INDEX_VERSION, "roots": self.roots},
+                              f, separators=(",", ":"))
+                os.replace(temp_path, self.index_path)
+                self.dirty = False
+            except Exception as e:
+                tools.log("PackageSync: Error while updating PackageSync.scan-index", force=True)
+                tools.log("PackageSync: Error message %s" % str(e), force=True)
+
+    def clear(self):
+        with self.lock:
+            self.roots = {}
+            self.verified_roots = set()
+            self.dirty = True
+
+    def invalidate(self, path):
+        """Have the next scan stat the file at path, which may have been written in place."""
+        with self.lock:
+            self.stale_dirs.add(os.path.normpath(os.path.dirname(path)))
+
+    def scan(self, path, path_filter):
+        """Return the files below path which match path_filter.
+
+        The result has the same layout as `Sync.find_files`.
+        """
+        with self.lock:
+            if self.roots is None:
+                self.load()
+
+            patterns = [list(patterns) for patterns in path_filter.patterns]
+            root = self.roots.get(path)
+            if root is None or root.get("filter") != patterns:
+                root = {"filter": patterns, "dirs": {}, "files": {}}
+                self.roots[path] = root
+                self.dirty = True
+
+            dirs_index = root["dirs"]
+            files_index = root["files"]
+            verified = path in self.verified_roots
+
+            resources = {}
+            seen_dirs = set()
+            pending_dirs = [""]
+
+            while pending_dirs:
+                relative_dir = pending_dirs.pop()
+                absolute_dir = os.path.join(path, relative_dir)
+
+                try:
+                    dir_mtime = os.stat(absolute_dir).st_mtime
+                except OSError:
+                    continue
+
+                seen_dirs.add(relative_dir)
+
+                normalized_dir = os.path.normpath(absolute_dir)
+                stale = not verified or normalized_dir in self.stale_dirs
+                self.stale_dirs.discard(normalized_dir)
+
+                entry = dirs_index.get(relative_dir)
+                if entry is None or entry["mtime"] is None or entry["mtime"] != dir_mtime:
+                    entry = self.list_dir(absolute_dir, relative_dir, path_filter)
+                    # Do not trust listings of directories which might still
+                    # change within the same mtime tick
+                    entry["mtime"] = dir_mtime if time.time() - dir_mtime > RACY_INTERVAL else None
+                    dirs_index[relative_dir] = entry
+                    self.dirty = True
+                    stale = True
+
+                pending_dirs += [os.path.join(relative_dir, dir) for dir in entry["dirs"]]
+
+                for file in entry["files"]:
+                    relative_path = os.path.join(relative_dir, file)
+                    absolute_path = os.path.join(absolute_dir, file)
+
+                    record = files_index.get(relative_path)
+                    if stale or record is None:
+                        try:
+                            stat = os.stat(absolute_path)
+                        except OSError:
+                            continue
+
+                        # Files which might still change within the same mtime
+                        # tick are stat-ed again on the next scan
+                        if time.time() - stat.st_mtime <= RACY_INTERVAL:
+                            self.stale_dirs.add(normalized_dir)
+
+                        record = [stat.st_mtime, stat.st_size, stat.st_ino]
+                        if files_index.get(relative_path) != record:
+                            files_index[relative_path] = record
+                            self.dirty = True
+
+                    resources[relative_path] = {"version": record[0], "size": record[1],
+                                                "path": absolute_path, "dir": relative_dir}
+
+            # Forget about directories & files which do not exist anymore
+            for relative_dir in [key for key in dirs_index if key not in seen_dirs]:
+                del dirs_index[relative_dir]
+                self.dirty = True
+
+            for relative_path in [key for key in files_index if key not in resources]:
+                del files_index[relative_path]
+                self.dirty = True
+
+            self.verified_roots.add(path)
+
+        return resources
+
+    def list_dir(self, absolute_dir, relative_dir, path_filter):
+        entry = {"dirs": [], "files": []}
+
+        for name, is_dir in tools.list_dir(absolute_dir):
+            relative_path = os.path.join(relative_dir, name)
+            if is_dir:
+                if path_filter.match_dir(relative_path):
+                    entry["dirs"] += [name]
+            elif path_filter.match_file(relative_path):
+                entry["files"] += [name]
+
+        return entry
@@ -0,0 +1,256 @@
+import os
+import json
+import threading
+import time
+
+try:
+    from . import tools
+    from . import hashing
+    from . import copier
+    from . import metrics
+except ValueError:
+    from package_sync_helpers import tools
+    from package_sync_helpers import hashing
+    from package_sync_helpers import copier
+    from package_sync_helpers import metrics
+
+#: Number of snapshots kept, unless configured otherwise
+DEFAULT_RETENTION = 48
+
+#: Size of the chunks in which files are copied into the repository
+CHUNK_SIZE = 1024 * 1024
+
+
+def get_snapshot_repository(psync_settings=None):
+    if psync_settings is None:
+        psync_settings = tools.get_psync_settings()
+
+    return SnapshotRepository(psync_settings.get("snapshot_backup_path") or tools.default_snapshot_backup_path)
+
+
+def store_file(source, target):
+    """Copy source to target through a temp file & return the hash of the copied data.
+
+    The data is hashed while it is copied, so the object is named after the
+    content actually stored even if the file changed since it was scanned.
+    """
+    digest = hashing.new_hash()
+    temp_path = "%s.%d.tmp" % (target, threading.current_thread().ident)
+    try:
+        with open(source, "rb") as fsrc:
+            with open(temp_path, "wb") as fdst:
+                chunk = fsrc.read(CHUNK_SIZE)
+                while chunk:
+                    digest.update(chunk)
+                    fdst.write(chunk)
+                    chunk = fsrc.read(CHUNK_SIZE)
+
+        # target is the object path for the hash expected by the caller
+        digest = digest.hexdigest()
+        object_path = os.path.join(os.path.dirname(os.path.dirname(target)), digest[:2], digest[2:])
+        if not os.path.isdir(os.path.dirname(object_path)):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        os.replace(temp_path, object_path)
+        return digest
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class SnapshotRepository(object):
+
+    """History of backups of the User folder, deduplicated by content.
+
+    The contents of every file are stored once in objects/, named after
+    their hash. A snapshot is a small JSON manifest in snapshots/ mapping
+    the relative paths of the backed up files to [hash, size, mtime].
+    Taking a snapshot only stores the files whose contents are not in the
+    repository yet, and hashes only the files whose size or mtime changed
+    since the previous snapshot. Objects no snapshot refers to anymore are
+    removed by `collect_garbage`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.objects_path = os.path.join(path, "objects")
+        self.snapshots_path = os.path.join(path, "snapshots")
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_path, digest[:2], digest[2:])
+
+    def snapshot_path(self, snapshot_id):
+        return os.path.join(self.snapshots_path, snapshot_id + ".json")
+
+    def list_snapshots(self):
+        """Return the ids of all snapshots, oldest first."""
+        try:
+            names = os.listdir(self.snapshots_path)
+        except OSError:
+            return []
+
+        return sorted(name[:-len(".json")] for name in names if name.endswith(".json"))
+
+    def load_snapshot(self, snapshot_id):
+        with open(self.snapshot_path(snapshot_id), "r", encoding="utf8") as f:
+            return json.load(f)
+
+    def save_snapshot(self, snapshot_id, snapshot):
+        snapshot_path = self.snapshot_path(snapshot_id)
+        temp_path = snapshot_path + ".tmp"
+        with open(temp_path, "w", encoding="utf8") as f:
+            json.dump(snapshot, f, sort_keys=True, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, snapshot_path)
+
+    def new_snapshot_id(self):
+        """Return an id which sorts after the ids of all earlier snapshots.
+
+        Ids are taken in UTC, so daylight saving time does not reorder them,
+        & the suffix telling snapshots of the same second apart is padded.
+        """
+        snapshot_id = time.strftime("%Y-%m-%d_%H-%M-%SZ", time.gmtime())
+        existing = set(self.list_snapshots())
+
+        suffix = 1
+        candidate = snapshot_id
+        while candidate in existing:
+            suffix += 1
+            candidate = "%s_%03d" % (snapshot_id, suffix)
+
+        return candidate
+
+    def create(self, source_dir, path_filter, copy_engine=None):
+        """Take a snapshot of the files below source_dir matching path_filter.
+
+        Returns the id of the new snapshot.
+        """
+        start = time.time()
+        if copy_engine is None:
+            copy_engine = copier.get_copy_engine()
+        hash_cache = hashing.get_hash_cache()
+
+        for folder in (self.objects_path, self.snapshots_path):
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+
+        # Files unchanged since the previous snapshot keep their hash
+        previous_files = {}
+        snapshot_ids = self.list_snapshots()
+        if snapshot_ids:
+            try:
+                previous_files = self.load_snapshot(snapshot_ids[-1])["files"]
+            except Exception as e:
+                tools.log("PackageSync: Could not read snapshot %s: %s" % (snapshot_ids[-1], str(e)))
+
+        files = {}
+        jobs = []
+        queued = set()
+        for absolute_path, relative_path, entry in path_filter.scan(source_dir):
+            file_stat = entry.stat()
+            previous = previous_files.get(relative_path)
+            if previous is not None and previous[1] == file_stat.st_size and previous[2] == file_stat.st_mtime:
+                files[relative_path] = previous
+                continue
+
+            digest = hash_cache.get(absolute_path, file_stat)
+            files[relative_path] = [digest, file_stat.st_size, file_stat.st_mtime]
+            if digest not in queued and not os.path.exists(self.object_path(digest)):
+                queued.add(digest)
+                jobs += [(absolute_path, self.object_path(digest), relative_path)]
+
+        for job, digest, error in copy_engine.run(jobs, store_file):
+            if error is not None:
+                raise error
+            # The file changed after it was hashed
+            files[job[2]][0] = digest
+
+        snapshot_id = self.new_snapshot_id()
+        self.save_snapshot(snapshot_id, {"version": 1, "created": time.time(), "files": files})
+
+        tools.log("PackageSync: Snapshot %s created, %d of %d files stored" % (snapshot_id, len(jobs), len(files)))
+        metrics.get_metrics().record("backup.snapshot", time.time() - start, files=len(files), stored_files=len(jobs))
+        return snapshot_id
+
+    def restore(self, snapshot_id, target_dir, copy_engine=None):
+        """Write the files of a snapshot to target_dir, which is only read & removed afterwards.
+
+        The files may be hardlinks to the objects of the repository, see
+        `copier.link_file`. Objects shared by several files are copied, as
+        each file needs a modification time of its own. Returns the relative
+        paths of the files that could not be restored.
+        """
+        if copy_engine is None:
+            copy_engine = copier.get_copy_engine()
+
+        files = self.load_snapshot(snapshot_id)["files"]
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+
+        jobs = []
+        mtimes = {}
+        sources = set()
+        shared_objects = set()
+        for relative_path, (digest, size, mtime) in files.items():
+            source = self.object_path(digest)
+            if source in sources:
+                shared_objects.add(source)
+            sources.add(source)
+
+            target_path = os.path.join(target_dir, relative_path)
+            mtimes[target_path] = mtime
+            jobs += [(source, target_path, relative_path)]
+
+        def restore_file(source, target):
+            if source in shared_objects:
+                copier.copy_data(source, target)
+            else:
+                copier.link_file(source, target)
+            os.utime(target, (mtimes[target], mtimes[target]))
+
+        with metrics.get_metrics().span("restore.snapshot", files=len(jobs)) as span:
+            failed = [job[2] for job, result, error in copy_engine.run(jobs, restore_file) if error is not None]
+            span.count("failed_files", len(failed))
+
+        return failed
+
+    def describe(self, snapshot_id):
+        """Return a short summary of a snapshot for display."""
+        files = self.load_snapshot(snapshot_id)["files"]
+        size = sum(record[1] for record in files.values())
+        return "%d files, %.1f KB" % (len(files), size / 1024.0)
+
+    def prune(self, retention=DEFAULT_RETENTION):
+        """Remove all but the latest `retention` snapshots & collect the garbage."""
+        snapshot_ids = self.list_snapshots()
+        if retention <= 0 or len(snapshot_ids) <= retention:
+            return 0
+
+        for snapshot_id in snapshot_ids[:-retention]:
+            os.remove(self.snapshot_path(snapshot_id))
+
+        return self.collect_garbage()
+
+    def collect_garbage(self):
+        """Remove the objects no snapshot refers to. Returns the number of bytes freed."""
+        referenced = set()
+        for snapshot_id in self.list_snapshots():
+            referenced.update(record[0] for record in self.load_snapshot(snapshot_id)["files"].values())
+
+        freed = 0
+        if not os.path.isdir(self.objects_path):
+            return freed
+
+        for prefix in os.listdir(self.objects_path):
+            prefix_path = os.path.join(self.objects_path, prefix)
+            for name in os.listdir(prefix_path):
+                if prefix + name not in referenced:
+                    object_path = os.path.join(prefix_path, name)
+                    freed += os.path.getsize(object_path)
+                    os.remove(object_path)
+
+            if not os.listdir(prefix_path):
+                os.rmdir(prefix_path)
+
+        return freed
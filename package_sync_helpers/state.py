@@ -0,0 +1,184 @@
+import os
+import json
+import threading
+import time
+
+try:
+    from . import tools
+    from . import metrics
+except ValueError:
+    from package_sync_helpers import tools
+    from package_sync_helpers import metrics
+
+#: Compact the journal into PackageSync.last-run once it grows beyond this size (in bytes)
+COMPACT_SIZE = 256 * 1024
+
+#: Compact the journal at the latest this many seconds after the last compaction
+COMPACT_INTERVAL = 60
+
+_sync_state = None
+_sync_state_lock = threading.Lock()
+
+
+def get_sync_state():
+    global _sync_state
+
+    with _sync_state_lock:
+        if _sync_state is None:
+            tools.get_state_path("PackageSync.last-run.journal")
+            _sync_state = SyncState(tools.get_state_path("PackageSync.last-run"))
+
+    return _sync_state
+
+
+class SyncState(object):
+
+    """In-memory copy of PackageSync.last-run with a write-behind journal.
+
+    Changes are applied in memory & appended as single JSON lines to
+    PackageSync.last-run.journal. The journal is compacted into the last-run
+    file before it grows beyond COMPACT_SIZE, on `flush` once it is older
+    than COMPACT_INTERVAL & on `close`. The last-run file is only ever
+    replaced through an atomic rename & the journal is replayed on load, so
+    a crash loses at most the line that was being written.
+    """
+
+    def __init__(self, last_run_path):
+        self.last_run_path = last_run_path
+        self.journal_path = last_run_path + ".journal"
+
+        self.lock = threading.RLock()
+        self.data = None
+        self.journal_size = 0
+        self.compacted_at = time.time()
+
+    def load(self):
+        with self.lock:
+            try:
+                with open(self.last_run_path, "r", encoding="utf8") as f:
+                    self.data = json.load(f)
+            except Exception:
+                self.data = {}
+
+            self.journal_size = 0
+            torn = False
+            try:
+                with open(self.journal_path, "rb") as f:
+                    for line in f:
+                        try:
+                            if not line.endswith(b"\n"):
+                                raise ValueError("Incomplete line")
+                            entry = json.loads(line.decode("utf8"))
+                        except ValueError:
+                            # Incomplete last line of an interrupted write
+                            torn = True
+                            break
+                        self.apply(entry)
+                        self.journal_size += len(line)
+
+                # Cut the incomplete line off, so that new entries are not
+                # appended to it & lost on the next load
+                if torn:
+                    with open(self.journal_path, "r+b") as f:
+                        f.truncate(self.journal_size)
+            except (IOError, OSError):
+                pass
+
+    def ensure_loaded(self):
+        if self.data is None:
+            with metrics.get_metrics().span("state.load"):
+                self.load()
+
+    def get(self, name, default=None):
+        """Return a top level value. It must not be modified by the caller."""
+        with self.lock:
+            self.ensure_loaded()
+            return self.data.get(name, default)
+
+    def snapshot(self):
+        """Return a copy of the whole state, as stored in PackageSync.last-run."""
+        with self.lock:
+            self.ensure_loaded()
+            return json.loads(json.dumps(self.data))
+
+    def set_item(self, key, local, remote):
+        self.record({"op": "set", "key": key, "local": local, "remote": remote})
+
+    def delete_item(self, key):
+        self.record({"op": "delete", "key": key})
+
+    def update(self, **values):
+        self.record({"op": "update", "values": values})
+
+    def reset(self):
+        with self.lock:
+            self.data = {}
+            self.compact()
+
+    def apply(self, entry):
+        if entry["op"] == "set":
+            self.data.setdefault("last_run_data_local", {})[entry["key"]] = entry["local"]
+            self.data.setdefault("last_run_data_remote", {})[entry["key"]] = entry["remote"]
+
+        elif entry["op"] == "delete":
+            self.data.get("last_run_data_local", {}).pop(entry["key"], None)
+            self.data.get("last_run_data_remote", {}).pop(entry["key"], None)
+
+        elif entry["op"] == "update":
+            self.data.update(entry["values"])
+
+    def record(self, entry):
+        with self.lock:
+            self.ensure_loaded()
+            self.apply(entry)
+
+            line = json.dumps(entry, separators=(",", ":")) + "\n"
+
+            # Large changes (e.g. after a complete sync) are written out
+            # directly instead of growing the journal
+            if self.journal_size + len(line) > COMPACT_SIZE:
+                self.compact()
+                return
+
+            try:
+                with open(self.journal_path, "a", encoding="utf8") as f:
+                    f.write(line)
+                self.journal_size += len(line)
+            except Exception as e:
+                tools.log("PackageSync: Error while updating PackageSync.last-run.journal", force=True)
+                tools.log("PackageSync: Error message %s" % str(e), force=True)
+                self.compact()
+
+    def flush(self):
+        """Compact the journal if it is old enough."""
+        with self.lock:
+            if self.journal_size and time.time() - self.compacted_at > COMPACT_INTERVAL:
+                self.compact()
+
+    def close(self):
+        with self.lock:
+            if self.journal_size:
+                self.compact()
+
+    def compact(self):
+        with self.lock:
+            self.ensure_loaded()
+
+            temp_path = self.last_run_path + ".tmp"
+            try:
+                with metrics.get_metrics().span("state.compact") as span:
+                    with open(temp_path, "w", encoding="utf8") as f:
+                        json.dump(self.data, f, sort_keys=True, indent=4)
+                        f.flush()
+                        os.fsync(f.fileno())
+                        span.count("bytes", f.tell())
+                    os.replace(temp_path, self.last_run_path)
+
+                # The journal is only dropped once its entries are on disk
+                if os.path.exists(self.journal_path):
+                    os.remove(self.journal_path)
+                self.journal_size = 0
+                self.compacted_at = time.time()
+            except Exception as e:
+                tools.log("PackageSync: Error while updating PackageSync.last-run", force=True)
+                tools.log("PackageSync: Error message %s" % str(e), force=True)
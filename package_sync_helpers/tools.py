@@ -2,18 +2,68 @@ import sublime
 import sublime_plugin
 
 import os
-import sys
+import shutil
 import tempfile
 import time
 import json
 import fnmatch
+import re
+import stat
 import threading
+import collections
+import collections.abc
+import types
+
+try:
+    from . import inotify
+    from . import metrics
+    from . import reconcile
+except ValueError:
+    from package_sync_helpers import inotify
+    from package_sync_helpers import metrics
+    from package_sync_helpers import reconcile
 
 local_watcher = None
 remote_watcher = None
 
+#: Seconds to wait for further watcher events before syncing a batch
+BATCH_DELAY = 0.5
+
+#: Longest time (in seconds) a batch is held back while events keep coming in
+BATCH_MAX_DELAY = 5
+
+#: Prefix of the indexes of an online sync folder in the packed format, one per machine, see packed.PackedFolder
+PACKED_INDEX_NAME = "PackageSync.pack-index"
+
+_path_filter = None
+
+_psync_settings = None
+_psync_settings_lock = threading.Lock()
+
 
 def get_psync_settings():
+    """Return the settings snapshot, rebuilt only after the settings changed."""
+    global _psync_settings
+
+    psync_settings = _psync_settings
+    if psync_settings is None:
+        with _psync_settings_lock:
+            if _psync_settings is None:
+                _psync_settings = load_psync_settings()
+            psync_settings = _psync_settings
+
+    return psync_settings
+
+
+def invalidate_psync_settings():
+    """Drop the settings snapshot, so the next access reads the settings again."""
+    global _psync_settings
+
+    with _psync_settings_lock:
+        _psync_settings = None
+
+
+def load_psync_settings():
     s = sublime.load_settings("PackageSync.sublime-settings")
 
     psync_settings = {
@@ -22,18 +72,81 @@ def get_psync_settings():
         "list_backup_path": s.get("list_backup_path", ""),
         "zip_backup_path": s.get("zip_backup_path", ""),
         "folder_backup_path": s.get("folder_backup_path", ""),
-        "ignore_files": s.get("ignore_files", []) + ["PackageSync.last-run"],
+        "incremental_folder_backup": s.get("incremental_folder_backup", True),
+        "snapshot_backup_path": s.get("snapshot_backup_path", ""),
+        "snapshot_retention": s.get("snapshot_retention", 48),
+        "ignore_files": s.get("ignore_files", []) + ["PackageSync.last-run*", "PackageSync.scan-index*",
+                                                         "PackageSync.metrics*", PACKED_INDEX_NAME + "*",
+                                                         "*.psync-pack", "*.psync-tmp"],
         "include_files": s.get("include_files", []),
         "ignore_dirs": s.get("ignore_dirs", []),
         "preserve_packages": s.get("preserve_packages", True),
         "online_sync_enabled": s.get("online_sync_enabled", False),
         "online_sync_folder": s.get("online_sync_folder", ""),
         "online_sync_interval": s.get("online_sync_interval", 10),
+        "online_sync_watcher": s.get("online_sync_watcher", "auto"),
+        "online_sync_format": s.get("online_sync_format", "files"),
+        "copy_workers": s.get("copy_workers", 4),
+        "delta_sync_threshold": s.get("delta_sync_threshold", 1048576),
+        "zip_compression": s.get("zip_compression", {}),
     }
     if s.get("sync_package_sync_settings") is not True:
         psync_settings['ignore_files'].append("PackageSync.sublime-settings")
 
-    return psync_settings
+    return PsyncSettings(psync_settings)
+
+
+def freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, dict):
+        return types.MappingProxyType(dict((key, freeze(item)) for key, item in value.items()))
+    return value
+
+
+class PsyncSettings(collections.abc.Mapping):
+
+    """Read-only snapshot of the PackageSync settings.
+
+    The snapshot is shared by the watchers, the syncs, the logger & the
+    commands until the settings change, so lists are stored as tuples &
+    dicts as read-only views. The compiled path filter of the sync patterns
+    is built along with it.
+    """
+
+    def __init__(self, values):
+        self._values = dict((key, freeze(value)) for key, value in values.items())
+        self.path_filter = get_path_filter(self._values)
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+
+def get_path_filter(psync_settings=None):
+    global _path_filter
+
+    if psync_settings is None:
+        psync_settings = get_psync_settings()
+
+    if isinstance(psync_settings, PsyncSettings):
+        return psync_settings.path_filter
+
+    include_files = psync_settings.get("include_files", [])
+    ignore_files = psync_settings.get("ignore_files", [])
+    ignore_dirs = psync_settings.get("ignore_dirs", [])
+
+    # Reuse the compiled filter (and its match cache) while the patterns
+    # stay the same
+    if _path_filter is None or not _path_filter.has_patterns(include_files, ignore_files, ignore_dirs):
+        _path_filter = PathFilter(include_files, ignore_files, ignore_dirs)
+
+    return _path_filter
 
 
 def set_psync_settings(**kwargs):
@@ -41,11 +154,11 @@ def set_psync_settings(**kwargs):
     for setting, value in kwargs.items():
         s.set(setting, value)
     sublime.save_settings("PackageSync.sublime-settings")
+    invalidate_psync_settings()
 
 
 def log(*args, force=False, **kwargs):
-    psync_settings = get_psync_settings()
-    if force or psync_settings.get('debug'):
+    if force or get_psync_settings()["debug"]:
         print(*args, **kwargs)
 
 
@@ -71,10 +184,10 @@ def init_paths():
     default_zip_backup_path = os.path.join(
         desktop_path, "SublimePackagesBackup.zip")
 
-    #: Path to be used as temporary location to store files during backup operation
-    global temp_backup_folder
-    temp_backup_folder = os.path.join(
-        tempfile.gettempdir(), "backup_" + str(time.time()))
+    #: Path of the snapshot repository keeping the history of backups of the "/packages/user" folder
+    global default_snapshot_backup_path
+    default_snapshot_backup_path = os.path.join(
+        desktop_path, "SublimePackagesSnapshots")
 
     #: Path to be used as temporary location to store files during restore operation
     global temp_restore_folder
@@ -82,164 +195,85 @@ def init_paths():
         tempfile.gettempdir(), "restore_" + str(time.time()))
 
 
-def add_packagesync_to_installed_packages():
-    package_control_settings = sublime.load_settings(
-        "Package Control.sublime-settings")
-    installed_packages = package_control_settings.get("installed_packages", [])
-
-    if "PackageSync" not in installed_packages:
-        log("PackageSync: Adding self to installed packages list")
-        installed_packages.append("PackageSync")
-
-    package_control_settings.set("installed_packages", installed_packages)
-    sublime.save_settings("Package Control.sublime-settings")
-
-
-def install_new_packages():
-    try:
-        def run_package_control_cleanup():
-            # Remove the last-run file in order to trigger the package
-            # installation
-            pkg_control_last_run = os.path.join(
-                sublime.packages_path(), "User", "Package Control.last-run")
-            if os.path.isfile(pkg_control_last_run):
-                os.remove(pkg_control_last_run)
-
-            # Import package control cleanup
-            pkg_control_cleanup = sys.modules["Package Control.package_control.package_cleanup"] if sublime.version(
-            )[0] == "3" else sys.modules["package_control.package_cleanup"]
-            pkg_control_cleanup.PackageCleanup().start()
-
-        # TODO: Verify whether this function call is actually needed. Added as
-        # a hack only to cater to a user issue
-        # Add PackageSync to the installed packages list if it has been removed
-        add_packagesync_to_installed_packages()
-
-        sublime.set_timeout(run_package_control_cleanup, 1000)
-
-    except Exception as e:
-        log(
-            "PackageSync: Error while installing packages via Package Control.", force=True)
-        log("PackageSync: Error message: %s" % str(e), force=True)
-
-
-def remove_packages(packages_to_remove):
-    log("PackageSync: remove packages %s" % packages)
-
-    # Reset wait_flag
-    wait_flag = [True]
+def get_state_path(name):
+    """Return the path of a file PackageSync keeps for this machine only, like PackageSync.last-run.
 
-    # At first ignore packages on main thread
-    def ignore_packages():
-        settings = sublime.load_settings("Preferences.sublime-settings")
-        ignored_packages = settings.get('ignored_packages')
-        settings.set("ignored_packages", [item for item in packages_to_remove])
-        sublime.save_settings("Preferences.sublime-settings")
-        #
-        wait_flag[0] = False
+    These files live in Local/PackageSync next to the Packages folder, so
+    that writing them does not count as a change of the User folder. A file
+    left in the User folder by an older version is moved there.
+    """
+    state_folder = os.path.join(os.path.dirname(sublime.packages_path()), "Local", "PackageSync")
+    if not os.path.isdir(state_folder):
+        os.makedirs(state_folder)
 
-    sublime.set_timeout(ignore_packages, 0)
+    path = os.path.join(state_folder, name)
+    legacy_path = os.path.join(sublime.packages_path(), "User", name)
+    if not os.path.exists(path) and os.path.exists(legacy_path):
+        try:
+            shutil.move(legacy_path, path)
+        except (IOError, OSError) as e:
+            log("PackageSync: Could not move %s to %s" % (legacy_path, path), force=True)
+            log("PackageSync: Error message: %s" % str(e), force=True)
 
-    # Wait to complete writing ignored_packages
-    while wait_flag[0]:
-        time.sleep(0.25)
+    return path
 
-    # wait for sublime text to ignore packages
-    time.sleep(1)
 
-    removed_packages = []
-    for package in packages_to_remove[:]:
-        status = remove_package(package)
-        if status:
-            removed_packages += [package]
-
-    # Reset wait flag
-    wait_flag[0] = True
-
-    # Update ignore packages on main thread
-    def unignore_packages():
-        settings = sublime.load_settings("Preferences.sublime-settings")
-        settings.set("ignored_packages", [])
-        sublime.save_settings("Preferences.sublime-settings")
-        #
-        wait_flag[0] = False
-
-    sublime.set_timeout(unignore_packages, 1000)
-
-    # Wait to complete writing ignored_packages
-    while wait_flag[0]:
-        time.sleep(0.25)
-
-    return removed_packages
+def add_packagesync_to_installed_packages():
+    # Only writes the Package Control settings if PackageSync is missing
+    if reconcile.merge_installed_packages(["PackageSync"]).install:
+        log("PackageSync: Adding self to installed packages list")
 
 
-def remove_package(package):
-    # Check for installed_package path
+def get_installed_packages_list(settings_path):
     try:
-        installed_package_path = os.path.join(
-            sublime.installed_packages_path(), package + ".sublime-package")
-        if os.path.exists(installed_package_path):
-            os.remove(installed_package_path)
+        with open(settings_path, "r", encoding="utf8") as f:
+            package_control_settings = json.load(f)
     except:
-        return False
+        package_control_settings = {}
 
-    # Check for pristine_package_path path
-    try:
-        pristine_package_path = os.path.join(os.path.dirname(
-            sublime.packages_path()), "Pristine Packages", package + ".sublime-package")
-        if os.path.exists(pristine_package_path):
-            os.remove(pristine_package_path)
-    except:
-        return False
+    return package_control_settings.get("installed_packages", [])
 
-    # Check for package dir
-    try:
-        os.chdir(sublime.packages_path())
-        package_dir = os.path.join(sublime.packages_path(), package)
-        if os.path.exists(package_dir):
-            if shutil.rmtree(package_dir):
-                open(
-                    os.path.join(package_dir, 'package-control.cleanup'), 'w').close()
-    except:
-        return False
 
-    return True
+class _DirEntry(object):
 
+    """Stand-in for os.DirEntry on Pythons without os.scandir."""
 
-def load_last_run_data():
-    try:
-        with open(os.path.join(sublime.packages_path(), "User", "PackageSync.last-run"), "r", encoding="utf8") as f:
-            last_run_data = json.load(f)
-    except:
-        last_run_data = {}
+    def __init__(self, root, name):
+        self.name = name
+        self.path = os.path.join(root, name)
+        self._stat = None
 
-    return last_run_data
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
 
+    def is_dir(self):
+        return stat.S_ISDIR(self.stat().st_mode)
 
-def save_last_run_data(**kwargs):
-    # Load current last run data
-    last_run_data = load_last_run_data()
+    def is_symlink(self):
+        return os.path.islink(self.path)
 
-    # Update with new values
-    for key, value in kwargs.items():
-        last_run_data[key] = value
 
-    try:
-        with open(os.path.join(sublime.packages_path(), "User", "PackageSync.last-run"), "w", encoding="utf8") as f:
-            json.dump(last_run_data, f, sort_keys=True, indent=4)
-    except Exception as e:
-        log("PackageSync: Error while updating PackageSync.last-run", force=True)
-        log("PackageSync: Error message %s" % str(e), force=True)
+def scandir(path):
+    """Iterate over the entries of the folder at path, like os.scandir."""
+    if hasattr(os, "scandir"):
+        return os.scandir(path)
 
+    return [_DirEntry(path, name) for name in os.listdir(path)]
 
-def get_installed_packages_list(settings_path):
-    try:
-        with open(settings_path, "r", encoding="utf8") as f:
-            package_control_settings = json.load(f)
-    except:
-        package_control_settings = {}
 
-    return package_control_settings.get("installed_packages", [])
+def list_dir(path):
+    """Return (name, is_dir) for every entry of the folder at path."""
+    entries = []
+
+    for entry in scandir(path):
+        try:
+            entries += [(entry.name, entry.is_dir())]
+        except OSError:
+            pass
+
+    return entries
 
 
 def packagesync_cancelled():
@@ -263,17 +297,31 @@ def start_watcher(psync_settings, local=True, remote=True):
 
     # Create local watcher
     if local:
-        local_watcher = WatcherThread(
-            local_dir, "psync_online_push_item", sync_interval, include_files, ignore_files, ignore_dirs)
+        local_watcher = create_watcher_thread(
+            psync_settings, local_dir, "psync_online_push_items", sync_interval, include_files, ignore_files, ignore_dirs)
         local_watcher.start()
 
-    # Create remote watcher
+    # Create remote watcher. Packed sync folders only change through their index.
     if remote:
-        remote_watcher = WatcherThread(
-            remote_dir, "psync_online_pull_item", sync_interval, include_files, ignore_files, ignore_dirs)
+        if psync_settings.get("online_sync_format") == "packed":
+            include_files, ignore_files, ignore_dirs = [PACKED_INDEX_NAME + "-*"], ["*.tmp"], ["packs"]
+        remote_watcher = create_watcher_thread(
+            psync_settings, remote_dir, "psync_online_pull_items", sync_interval, include_files, ignore_files, ignore_dirs)
         remote_watcher.start()
 
 
+def create_watcher_thread(psync_settings, *args):
+    # Prefer inotify events and fall back to polling if they are unavailable
+    if psync_settings.get("online_sync_watcher", "auto") != "poll" and inotify.is_supported():
+        try:
+            return InotifyWatcherThread(*args)
+        except Exception as e:
+            log("PackageSync: inotify watcher unavailable for %s, falling back to polling" % args[0])
+            log("PackageSync: Error message: %s" % str(e))
+
+    return WatcherThread(*args)
+
+
 def pause_watcher(status=True, local=True, remote=True):
     global local_watcher
     global remote_watcher
@@ -288,6 +336,8 @@ def pause_watcher(status=True, local=True, remote=True):
 
 
 def restart_watcher():
+    # Called whenever the settings change
+    invalidate_psync_settings()
     psync_settings = get_psync_settings()
 
     pause_watcher(local=False)
@@ -312,6 +362,198 @@ def stop_watcher(local=True, remote=True):
         remote_watcher.stop = True
 
 
+def merge_events(previous, current):
+    """Collapse two events for the same key into one, None if they cancel out."""
+    if previous is None:
+        return current
+
+    if previous["type"] == "c":
+        # A file created & deleted in between two syncs never existed
+        if current["type"] == "d":
+            return None
+        return dict(current, type="c")
+
+    if previous["type"] == "d" and current["type"] != "d":
+        # A file deleted & created again has been replaced
+        return dict(current, type="m")
+
+    return current
+
+
+class EventBatcher(object):
+
+    """Groups watcher events & runs a single sync command for each batch.
+
+    Events for the same key are merged with `merge_events`. A batch is sent
+    once no event arrived for BATCH_DELAY seconds, or at the latest
+    BATCH_MAX_DELAY seconds after its first event.
+    """
+
+    def __init__(self, callback, delay=BATCH_DELAY, max_delay=BATCH_MAX_DELAY):
+        self.callback = callback
+        self.delay = delay
+        self.max_delay = max_delay
+
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict()
+        self.timer = None
+        self.started = None
+
+    def add(self, item):
+        with self.lock:
+            key = item["key"]
+            merged = merge_events(self.items.pop(key, None), item)
+            if merged is not None:
+                self.items[key] = merged
+
+            now = time.time()
+            if self.started is None:
+                self.started = now
+
+            # Hold the batch back while events keep coming in, within limits
+            if self.timer is not None:
+                self.timer.cancel()
+            delay = min(self.delay, max(0, self.started + self.max_delay - now))
+            self.timer = threading.Timer(delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            items = list(self.items.values())
+            self.items = collections.OrderedDict()
+            self.timer = None
+            self.started = None
+
+        if items:
+            sublime.set_timeout(
+                lambda: sublime.run_command(self.callback, {"items": items}), 0)
+
+
+class PathFilter(object):
+
+    """Matches relative paths against the include/ignore settings.
+
+    Every pattern list is compiled into a single regular expression and the
+    outcome for each relative path is cached, so repeated walks over the same
+    tree only pay for the patterns once. `ignore_dirs` entries match either
+    the bare directory name or its path relative to the walked folder.
+    """
+
+    def __init__(self, include_files=[], ignore_files=[], ignore_dirs=[]):
+        self.patterns = (tuple(include_files), tuple(ignore_files), tuple(ignore_dirs))
+
+        self._include_re = self.compile(include_files)
+        self._ignore_re = self.compile(ignore_files)
+        self._ignore_dirs_re = self.compile(ignore_dirs)
+
+        self._file_cache = {}
+        self._dir_cache = {}
+
+    @staticmethod
+    def compile(patterns):
+        if not patterns:
+            return None
+
+        translated = []
+        for pattern in patterns:
+            regex = fnmatch.translate(os.path.normcase(pattern))
+            # Older Pythons append the global flags to the translated pattern,
+            # which can not be used inside an alternation
+            if regex.endswith("(?ms)"):
+                regex = regex[:-5]
+            translated += ["(?:%s)" % regex]
+
+        return re.compile("|".join(translated), re.S)
+
+    def has_patterns(self, include_files, ignore_files, ignore_dirs):
+        return self.patterns == (tuple(include_files), tuple(ignore_files), tuple(ignore_dirs))
+
+    def match_file(self, relative_path):
+        try:
+            return self._file_cache[relative_path]
+        except KeyError:
+            pass
+
+        path = os.path.normcase(relative_path)
+        matched = self._include_re is not None and self._include_re.match(path) is not None and (
+            self._ignore_re is None or self._ignore_re.match(path) is None)
+
+        self._file_cache[relative_path] = matched
+        return matched
+
+    def match_dir(self, relative_path):
+        try:
+            return self._dir_cache[relative_path]
+        except KeyError:
+            pass
+
+        matched = True
+        if self._ignore_dirs_re is not None:
+            path = os.path.normcase(relative_path)
+            name = os.path.basename(path)
+            matched = self._ignore_dirs_re.match(name) is None and self._ignore_dirs_re.match(path) is None
+
+        self._dir_cache[relative_path] = matched
+        return matched
+
+    def scan(self, path, relative_dir=""):
+        """Yield (absolute_path, relative_path, entry) of every file to be synced.
+
+        The tree is read in a single scandir pass & ignored directories are
+        never listed. `entry.stat()` costs at most one stat call per file.
+        relative_dir is the location of path below the synced folder, the
+        patterns are matched against paths relative to the synced folder.
+        """
+        pending_dirs = [(relative_dir, path)]
+        while pending_dirs:
+            relative_root, root = pending_dirs.pop()
+
+            try:
+                entries = scandir(root)
+            except OSError:
+                continue
+
+            for entry in entries:
+                relative_path = os.path.join(relative_root, entry.name)
+                try:
+                    if entry.is_dir():
+                        # Like os.walk, do not follow symlinks to folders
+                        if not entry.is_symlink() and self.match_dir(relative_path):
+                            pending_dirs += [(relative_path, entry.path)]
+                    elif self.match_file(relative_path):
+                        yield entry.path, relative_path, entry
+                except OSError:
+                    pass
+
+    def walk(self, path, relative_dir=""):
+        """Yield (absolute_path, relative_path) of every file to be synced."""
+        for absolute_path, relative_path, entry in self.scan(path, relative_dir):
+            yield absolute_path, relative_path
+
+    def copytree_ignore(self, base_path):
+        """Build an `ignore` callable for shutil.copytree rooted at base_path."""
+        def ignore(root, names):
+            relative_root = os.path.relpath(root, base_path)
+            if relative_root == os.curdir:
+                relative_root = ""
+
+            ignored = []
+            for name in names:
+                relative_path = os.path.join(relative_root, name)
+                if os.path.isdir(os.path.join(root, name)):
+                    if not self.match_dir(relative_path):
+                        ignored += [name]
+                elif not self.match_file(relative_path):
+                    ignored += [name]
+
+            return ignored
+
+        return ignore
+
+
 class WatcherThread(threading.Thread):
 
     stop = False
@@ -343,6 +585,164 @@ class WatcherThread(threading.Thread):
         self.watcher.pause = status
 
 
+class InotifyWatcherThread(WatcherThread):
+
+    """Watcher thread driven by Linux inotify events instead of polling.
+
+    The polling Watcher is kept to hold the known files and to run the
+    callbacks, but it is only asked to check the paths reported by inotify.
+    A full poll is done only when the kernel event queue overflows.
+    """
+
+    def __init__(self, *args, **kwargs):
+        WatcherThread.__init__(self, *args, **kwargs)
+
+        self.lock = threading.RLock()
+        self.watch_descriptors = {}
+
+        # Set once the watched folder itself was deleted or moved away
+        self.root_lost = False
+
+        self.inotify = inotify.Inotify()
+        try:
+            self.add_watches("")
+        except Exception:
+            self.inotify.close()
+            raise
+
+    def add_watches(self, relative_dir):
+        path_filter = self.watcher.path_filter
+
+        pending_dirs = [relative_dir]
+        while pending_dirs:
+            relative_dir = pending_dirs.pop()
+            absolute_dir = os.path.join(self.dir_to_watch, relative_dir)
+
+            try:
+                wd = self.inotify.add_watch(absolute_dir)
+            except OSError:
+                # Folders might vanish while being walked, any other error
+                # (e.g. the user watch limit) means inotify can not be used
+                if os.path.isdir(absolute_dir):
+                    raise
+                continue
+
+            self.watch_descriptors[wd] = relative_dir
+
+            for name, is_dir in list_dir(absolute_dir):
+                relative_path = os.path.join(relative_dir, name)
+                if is_dir and path_filter.match_dir(relative_path):
+                    pending_dirs += [relative_path]
+
+    def remove_watches(self, relative_dir):
+        prefix = relative_dir + os.sep
+        for wd, watched_dir in list(self.watch_descriptors.items()):
+            if watched_dir == relative_dir or watched_dir.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.watch_descriptors[wd]
+
+    def watch_root(self):
+        """Watch the folder at dir_to_watch anew, e.g. after it was swapped for another one.
+
+        Returns False if there is no folder to watch (yet).
+        """
+        for wd in list(self.watch_descriptors):
+            self.inotify.rm_watch(wd)
+        self.watch_descriptors = {}
+
+        if not os.path.isdir(self.dir_to_watch):
+            return False
+
+        self.add_watches("")
+        return True
+
+    def run(self):
+        try:
+            while not self.stop:
+                events = self.inotify.read_events(timeout=0.5)
+                if events:
+                    self.handle_events(events)
+                elif self.root_lost:
+                    # Wait for the folder to be back before polling it
+                    with self.lock:
+                        if self.watch_root():
+                            self.root_lost = False
+                            self.watcher.loop()
+        finally:
+            with self.lock:
+                self.inotify.close()
+
+    def handle_events(self, events):
+        with self.lock:
+            changed_paths = []
+            rescan = False
+
+            for wd, mask, cookie, name in events:
+                if mask & inotify.IN_Q_OVERFLOW:
+                    rescan = True
+                    continue
+
+                relative_dir = self.watch_descriptors.get(wd)
+                if relative_dir is None:
+                    continue
+
+                if mask & inotify.IN_IGNORED:
+                    del self.watch_descriptors[wd]
+                    continue
+
+                if mask & (inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF):
+                    if relative_dir == "":
+                        self.root_lost = True
+                    continue
+
+                relative_path = os.path.join(relative_dir, name)
+
+                if mask & inotify.IN_ISDIR:
+                    if not self.watcher.path_filter.match_dir(relative_path):
+                        continue
+
+                    if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                        # Files might have been added before the folder was
+                        # watched, so check everything inside it
+                        self.add_watches(relative_path)
+                        absolute_dir = os.path.join(self.dir_to_watch, relative_path)
+                        changed_paths += [path for _, path in
+                                          self.watcher.path_filter.walk(absolute_dir, relative_path)]
+
+                    elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                        self.remove_watches(relative_path)
+                        prefix = relative_path + os.sep
+                        changed_paths += [key for key in self.watcher.files_map if key.startswith(prefix)]
+
+                elif relative_path not in changed_paths:
+                    changed_paths += [relative_path]
+
+            # The watches stay with the old folder, so the new one needs
+            # watches of its own. Without a folder nothing is polled, which
+            # would report all files as deleted.
+            if self.root_lost:
+                if not self.watch_root():
+                    return
+                self.root_lost = False
+                rescan = True
+
+            if rescan:
+                self.watcher.loop()
+            else:
+                for relative_path in changed_paths:
+                    self.watcher.check_path(relative_path)
+
+    def pause(self, status=True):
+        with self.lock:
+            # Take in the changes made while paused before running callbacks
+            # again, there is no need to poll the whole folder
+            if not status and not self.stop:
+                events = self.inotify.read_events(timeout=0)
+                if events:
+                    self.handle_events(events)
+            self.watcher.pause = status
+
+
 class Watcher(object):
 
     pause = True
@@ -356,9 +756,16 @@ class Watcher(object):
         self.ignore_files = ignore_files
         self.ignore_dirs = ignore_dirs
 
+        self.path_filter = get_path_filter({
+            "include_files": include_files, "ignore_files": ignore_files, "ignore_dirs": ignore_dirs})
+
+        self.batcher = EventBatcher(callback)
+
         self.files_map = {}
 
-        self.update_files()
+        # Take the initial snapshot without running any callbacks
+        for key, (path, version) in self.snapshot().items():
+            self.files_map[key] = {"key": key, "path": path, "dir": os.path.dirname(key), "version": version}
         self.pause = False
 
     def __del__(self):
@@ -367,65 +774,68 @@ class Watcher(object):
             pass
             # log("PackageSync: Stopped watching %s" % value["path"])
 
-    def get_sync_items(self, walk=False):
-        sync_items = []
-        for root, dirs, files in os.walk(self.dir_to_watch):
-            [dirs.remove(dir)
-             for dir in dirs if dir in self.ignore_dirs]
-
-            for file in files:
-                absolute_path = os.path.join(root, file)
-                relative_path = os.path.relpath(
-                    absolute_path, self.dir_to_watch)
-
-                include_matches = [
-                    fnmatch.fnmatch(relative_path, p) for p in self.include_files]
-                ignore_matches = [
-                    fnmatch.fnmatch(relative_path, p) for p in self.ignore_files]
-
-                if any(ignore_matches) or not any(include_matches):
-                    continue
-
-                sync_items += [{"key": relative_path, "path": absolute_path, "dir":
-                                os.path.dirname(relative_path), "version": os.path.getmtime(absolute_path)}]
+    def snapshot(self):
+        """Return {relative_path: (absolute_path, mtime)} of the files to sync."""
+        snapshot = {}
+        for absolute_path, relative_path, entry in self.path_filter.scan(self.dir_to_watch):
+            try:
+                snapshot[relative_path] = (absolute_path, entry.stat().st_mtime)
+            except OSError:
+                pass
 
-        return sync_items
+        return snapshot
 
     def loop(self):
-        self.update_files()
-        for key, value in self.files_map.items():
-            self.check_file(key, value)
+        with metrics.get_metrics().span("watcher.loop") as span:
+            # Diff a single snapshot of the folder against the known files
+            snapshot = self.snapshot()
+            span.count("files", len(snapshot))
+
+            for key, value in list(self.files_map.items()):
+                if key not in snapshot:
+                    self.unwatch(value)
+
+            for key, (path, version) in snapshot.items():
+                value = self.files_map.get(key)
+                if value is None:
+                    self.watch({"key": key, "path": path, "dir": os.path.dirname(key), "version": version})
+                else:
+                    self.check_file(key, value, version)
+
+    def check_file(self, key, value, file_mod_time=None):
+        if file_mod_time is None:
+            file_mod_time = os.path.getmtime(value["path"])
 
-    def check_file(self, key, value):
-        file_mod_time = os.path.getmtime(value["path"])
         if file_mod_time != value["version"]:
             self.files_map[key]["version"] = file_mod_time
             item = dict({"type": "m"}, **value)
 
             # Run callback if file changed
             if not self.pause:
-                sublime.set_timeout(
-                    lambda: sublime.run_command(self.callback, {"item": item}), 0)
+                self.batcher.add(item)
             else:
                 pass
                 # log(
                 #     "PackageSync: Inside check_file - Callback skipped for %s" % item)
 
-    def update_files(self):
-        sync_items = []
+    def check_path(self, relative_path):
+        absolute_path = os.path.join(self.dir_to_watch, relative_path)
+        value = self.files_map.get(relative_path)
 
-        for item in self.get_sync_items():
-            if item["key"] not in self.files_map:
-                sync_items += [item]
+        try:
+            file_stat = os.stat(absolute_path)
+            file_mod_time = file_stat.st_mtime if stat.S_ISREG(file_stat.st_mode) else None
+        except OSError:
+            file_mod_time = None
 
-        # check non-existent files
-        for key, value in self.files_map.copy().items():
-            if not os.path.exists(value["path"]):
+        if file_mod_time is None or not self.path_filter.match_file(relative_path):
+            if value:
                 self.unwatch(value)
-
-        for item in sync_items:
-            if item["key"] not in self.files_map:
-                self.watch(item)
+        elif value is None:
+            self.watch({"key": relative_path, "path": absolute_path,
+                        "dir": os.path.dirname(relative_path), "version": file_mod_time})
+        else:
+            self.check_file(relative_path, value, file_mod_time)
 
     def watch(self, item):
         # log("PackageSync: Started watching %s" % item["path"])
@@ -434,8 +844,7 @@ class Watcher(object):
 
         # Run callback if file created
         if not self.pause:
-            sublime.set_timeout(
-                lambda: sublime.run_command(self.callback, {"item": item}), 0)
+            self.batcher.add(item)
         else:
             pass
             # log("PackageSync: Inside watch - Callback skipped for %s" % item)
@@ -447,8 +856,7 @@ class Watcher(object):
 
         # Run callback if file deleted
         if not self.pause:
-            sublime.set_timeout(
-                lambda: sublime.run_command(self.callback, {"item": item}), 0)
+            self.batcher.add(item)
         else:
             pass
             # log(